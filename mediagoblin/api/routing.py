@@ -60,6 +60,13 @@ add_route(
     match_slash=False
 )
 
+add_route(
+    "mediagoblin.api.user.upload_session",
+    "/api/user/<string:username>/uploads/<string:session>/",
+    "mediagoblin.api.views:upload_session_endpoint",
+    match_slash=False
+)
+
 add_route(
     "mediagoblin.api.inbox",
     "/api/user/<string:username>/inbox/",
@@ -15,22 +15,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
-import io
 import mimetypes
+from urllib.parse import urlencode
 
 from werkzeug.datastructures import FileStorage
+from werkzeug.http import parse_content_range_header
 
 from mediagoblin.decorators import oauth_required
 from mediagoblin.api.decorators import user_has_privilege
 from mediagoblin.db.models import (
     LocalUser, MediaEntry, TextComment, Activity, Location)
+from mediagoblin.db.util import preload_references
 from mediagoblin.tools.federation import create_activity, create_generator
 from mediagoblin.tools.routing import extract_url_arguments
 from mediagoblin.tools.response import (
-    redirect, json_response, json_error, render_to_response)
+    redirect, json_response, json_error, render_to_response, CacheValidators)
 from mediagoblin.meddleware.csrf import csrf_exempt
 from mediagoblin.submit.lib import new_upload_entry, api_upload_request, \
-                                    api_add_to_feed
+                                    api_add_to_feed, FileUploadLimit
+from mediagoblin.submit.resumable import UploadSession, UploadSessionError
 
 # MediaTypes
 from mediagoblin.media_types.image import MEDIA_TYPE as IMAGE_MEDIA_TYPE
@@ -126,8 +129,31 @@ def uploads_endpoint(request):
                                   status=415)
             filename = f'unknown{filenames[0]}'
 
+        # The file is sent in chunks, see upload_session_endpoint
+        if "X-Upload-Content-Length" in request.headers:
+            try:
+                size = int(request.headers["X-Upload-Content-Length"])
+            except ValueError:
+                return json_error(
+                    "X-Upload-Content-Length must be a number of bytes."
+                )
+
+            try:
+                session = UploadSession.start(
+                    request.app.queue_store,
+                    request.user,
+                    filename,
+                    size=size,
+                    content_type=mimetype,
+                    md5=request.headers.get("X-Upload-Content-MD5"),
+                    sha256=request.headers.get("X-Upload-Content-SHA256")
+                )
+            except FileUploadLimit:
+                return json_error("File is too large.", status=413)
+            return upload_session_response(request, session, status=201)
+
         file_data = FileStorage(
-            stream=io.BytesIO(request.data),
+            stream=request.stream,
             filename=filename,
             content_type=mimetype
         )
@@ -139,6 +165,91 @@ def uploads_endpoint(request):
 
     return json_error("Not yet implemented", 501)
 
+def upload_session_response(request, session, status=200):
+    """ Tells the client how far its upload session got """
+    return json_response({
+        "id": session.id,
+        "offset": session.offset,
+        "size": session.size,
+        "url": request.urlgen(
+            "mediagoblin.api.user.upload_session",
+            username=request.user.username,
+            session=session.id,
+            qualified=True
+        ),
+    }, status=status)
+
+@oauth_required
+@csrf_exempt
+@user_has_privilege('uploader')
+def upload_session_endpoint(request):
+    """ Endpoint for resumable uploads
+
+    A session is started by a POST to the uploads endpoint with a
+    X-Upload-Content-Length header.  The chunks are then PUT here, with a
+    Content-Range header, in order.  If the connection drops, a GET tells
+    from which offset to go on.  The response to the last chunk is that
+    of a whole upload to the uploads endpoint.
+    """
+    # One request at a time gets to change the session
+    with UploadSession.lock(request.app.queue_store,
+                            request.matchdict["session"]):
+        return _upload_session_request(request)
+
+def _upload_session_request(request):
+    session = UploadSession.load(
+        request.app.queue_store,
+        request.matchdict["session"]
+    )
+    if session is None or session.state["user"] != request.user.id:
+        return json_error("No such upload session.", 404)
+
+    if request.method == "DELETE":
+        session.delete()
+        return json_response({})
+
+    if request.method == "PUT":
+        content_range = parse_content_range_header(
+            request.headers.get("Content-Range")
+        )
+        if content_range is None:
+            offset = session.offset
+        else:
+            offset = content_range.start
+
+        try:
+            session.append(
+                offset,
+                request.stream,
+                md5=request.headers.get("X-Upload-Chunk-MD5")
+            )
+        except FileUploadLimit:
+            session.delete()
+            return json_error("File is too large.", status=413)
+        except UploadSessionError as exc:
+            return json_error(str(exc), status=409)
+
+        if session.complete:
+            try:
+                data = session.finish()
+            except UploadSessionError as exc:
+                session.delete()
+                return json_error(str(exc), status=422)
+
+            with data:
+                file_data = FileStorage(
+                    stream=data,
+                    filename=session.state["filename"],
+                    content_type=session.state["content_type"]
+                )
+                entry = new_upload_entry(request.user)
+                entry.media_type = IMAGE_MEDIA_TYPE
+                response = api_upload_request(request, file_data, entry)
+            session.delete()
+            return response
+
+    return upload_session_response(request, session)
+
 @oauth_required
 @csrf_exempt
 def inbox_endpoint(request, inbox=None):
@@ -200,7 +311,8 @@ def inbox_endpoint(request, inbox=None):
         "totalItems": total_items,
     }
 
-    for activity in inbox:
+    for activity in preload_references(inbox, "object_helper",
+                                       "target_helper"):
         try:
             feed["items"].append(activity.serialize(request))
         except AttributeError:
@@ -604,7 +716,8 @@ def feed_endpoint(request, outbox=None):
     outbox = outbox.offset(offset)
 
     # Build feed.
-    for activity in outbox:
+    for activity in preload_references(outbox, "object_helper",
+                                       "target_helper"):
         try:
             feed["items"].append(activity.serialize(request))
         except AttributeError:
@@ -673,7 +786,12 @@ def object_endpoint(request):
             status=404
         )
 
-    return json_response(media.serialize(request))
+    validators = CacheValidators(media.updated, media.comment_count)
+    response = validators.not_modified(request)
+    if response is not None:
+        return response
+
+    return validators.apply(json_response(media.serialize(request)))
 
 @oauth_required
 def object_comments(request):
@@ -691,24 +809,40 @@ def object_comments(request):
             request.matchdict["id"]
         ), 404)
 
-    comments = media.serialize(request)
-    comments = comments.get("replies", {
-        "totalItems": 0,
-        "items": [],
-        "url": request.urlgen(
-            "mediagoblin.api.object.comments",
-            object_type=media.object_type,
-            id=media.id,
-            qualified=True
-        )
-    })
+    validators = CacheValidators(media.updated, media.comment_count)
+    response = validators.not_modified(request)
+    if response is not None:
+        return response
+
+    # Limit by the "count" (default: 20), which may be no more than 200
+    try:
+        limit = int(request.args.get("count", 20))
+    except ValueError:
+        limit = 20
+    limit = min(max(limit, 1), 200)
+
+    # Offset (default: no offset - first <count> comments)
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+    except ValueError:
+        offset = 0
+
+    comments = media.serialize_replies(request, limit=limit, offset=offset)
+
+    def page_url(page_offset):
+        return "{}?{}".format(request.base_url, urlencode(
+            {"count": limit, "offset": page_offset}))
 
     comments["displayName"] = "Replies to {}".format(comments["url"])
     comments["links"] = {
-        "first": comments["url"],
-        "self": comments["url"],
+        "first": request.base_url,
+        "self": request.url,
     }
-    return json_response(comments)
+    if offset + limit < comments["totalItems"]:
+        comments["links"]["next"] = page_url(offset + limit)
+    if offset:
+        comments["links"]["prev"] = page_url(max(offset - limit, 0))
+    return validators.apply(json_response(comments))
 
 ##
 # RFC6415 - Web Host Metadata
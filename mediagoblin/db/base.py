@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import copy
+from collections import Counter
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import inspect
@@ -95,7 +96,11 @@ class GMGTableBase:
         # cause issues if it isn't. See #5382.
         # Import here to prevent cyclic imports.
         from mediagoblin.db.models import CollectionItem, GenericModelReference, \
-                                          Report, Notification, Comment
+                                          Report, Notification, Comment, \
+                                          Collection, MediaEntry, \
+                                          update_collection_counts, \
+                                          update_comment_counts, \
+                                          expire_counters
         
         # Some of the models don't have an "id" field which means they can't be
         # used with GMR, these models won't be in collections because they
@@ -114,7 +119,14 @@ class GMGTableBase:
                 items = CollectionItem.query.filter_by(
                     object_id=gmr.id
                 )
+                # The bulk delete skips the session, count it ourselves
+                collections = Counter(
+                    c for (c,) in items.with_entities(CollectionItem.collection))
+                collections = update_collection_counts(
+                    self._session, {c: -n for c, n in collections.items()})
                 items.delete()
+                expire_counters(
+                    self._session, Collection, collections, "num_items")
 
                 # Delete notifications found
                 notifications = Notification.query.filter_by(
@@ -126,15 +138,18 @@ class GMGTableBase:
                 comments = Comment.query.filter_by(
                     comment_id=gmr.id
                 )
+                targets = Counter(
+                    t for (t,) in comments.with_entities(Comment.target_id))
+                media = update_comment_counts(
+                    self._session, {t: -n for t, n in targets.items()})
                 comments.delete()
+                expire_counters(
+                    self._session, MediaEntry, media, "comment_count")
 
                 # Set None on reports found
-                reports = Report.query.filter_by(
+                Report.query.filter_by(
                     object_id=gmr.id
-                )
-                for report in reports:
-                    report.object_id = None
-                    report.save(commit=commit)
+                ).update({"object_id": None})
 
         # Hand off to the correct deletion function.
         if deletion == self.HARD_DELETE:
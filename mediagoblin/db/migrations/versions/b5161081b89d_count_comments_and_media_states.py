@@ -0,0 +1,58 @@
+"""count comments per media entry and media entries per user and state
+
+Revision ID: b5161081b89d
+Revises: e6f6b5c9e2a1
+Create Date: 2026-10-18 14:02:17.530412
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5161081b89d'
+down_revision = 'e6f6b5c9e2a1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import MetaData, and_, func, select
+from mediagoblin.db.migration_tools import inspect_table
+
+
+def upgrade():
+    """
+    Media entries keep count of their comments and users of their media
+    entries in each processing state, so pages don't have to count them
+    over and over.  Both start out counted from what is there.
+    """
+    op.add_column('core__media_entries', sa.Column(
+        'comment_count', sa.Integer(), nullable=False, server_default='0'))
+    state_count_table = op.create_table(
+        'core__media_state_counts',
+        sa.Column('actor', sa.Integer(), nullable=False),
+        sa.Column('state', sa.Unicode(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor'], ['core__users.id']),
+        sa.PrimaryKeyConstraint('actor', 'state'))
+
+    db = op.get_bind()
+    metadata = MetaData(bind=db)
+    media_table = inspect_table(metadata, 'core__media_entries')
+    comment_table = inspect_table(metadata, 'core__comment_links')
+    gmr_table = inspect_table(metadata, 'core__generic_model_reference')
+
+    comment_count = select([func.count(comment_table.c.id)]).where(and_(
+        comment_table.c.target_id == gmr_table.c.id,
+        gmr_table.c.model_type == 'core__media_entries',
+        gmr_table.c.obj_pk == media_table.c.id)).as_scalar()
+    db.execute(media_table.update().values(comment_count=comment_count))
+
+    db.execute(state_count_table.insert().from_select(
+        ['actor', 'state', 'count'],
+        select([media_table.c.actor, media_table.c.state, func.count()])
+        .group_by(media_table.c.actor, media_table.c.state)))
+
+
+def downgrade():
+    op.drop_table('core__media_state_counts')
+    with op.batch_alter_table('core__media_entries') as batch_op:
+        batch_op.drop_column('comment_count')
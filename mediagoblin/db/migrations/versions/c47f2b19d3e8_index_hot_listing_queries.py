@@ -0,0 +1,41 @@
+"""index hot listing queries
+
+Revision ID: c47f2b19d3e8
+Revises: b5161081b89d
+Create Date: 2026-10-18 17:05:12.402871
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c47f2b19d3e8'
+down_revision = 'b5161081b89d'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+INDEXES = [
+    # The front page and site feed: processed media, newest first
+    ('ix_core__media_entries_state_created',
+     'core__media_entries', ['state', 'created']),
+    # A user's gallery and feed: their processed media, newest first
+    ('ix_core__media_entries_actor_state_created',
+     'core__media_entries', ['actor', 'state', 'created']),
+    # The previous/next links on media pages step through ids
+    ('ix_core__media_entries_actor_state_id',
+     'core__media_entries', ['actor', 'state', 'id']),
+    # The unseen notifications of a user, shown on every page
+    ('ix_core__notifications_user_id_seen',
+     'core__notifications', ['user_id', 'seen']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in INDEXES:
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,31 @@
+"""index comment links by target and date
+
+Revision ID: e6f6b5c9e2a1
+Revises: cc3651803714
+Create Date: 2026-10-18 10:12:41.118216
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6f6b5c9e2a1'
+down_revision = 'cc3651803714'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    """
+    Comments on an object are listed (and their page looked up when
+    jumping to one) ordered by the date they were added.
+    """
+    op.create_index(
+        'ix_core__comment_links_target_id_added',
+        'core__comment_links', ['target_id', 'added'])
+
+
+def downgrade():
+    op.drop_index(
+        'ix_core__comment_links_target_id_added',
+        table_name='core__comment_links')
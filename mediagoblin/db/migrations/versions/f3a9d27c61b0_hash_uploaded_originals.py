@@ -0,0 +1,40 @@
+"""hash uploaded originals
+
+Revision ID: f3a9d27c61b0
+Revises: c47f2b19d3e8
+Create Date: 2026-10-18 19:41:08.113562
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9d27c61b0'
+down_revision = 'c47f2b19d3e8'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    """
+    Uploads are looked up by the sha256 of their data, so that one seen
+    before can reuse the files of its processed copy.  Files may then
+    belong to several entries, which are found by their paths.
+    Entries uploaded before stay without a hash.
+    """
+    op.add_column('core__media_entries', sa.Column(
+        'file_hash', sa.Unicode(), nullable=True))
+    op.create_index('ix_core__media_entries_file_hash_state',
+                    'core__media_entries', ['file_hash', 'state'])
+    op.create_index('ix_core__mediafiles_file_path',
+                    'core__mediafiles', ['file_path'])
+
+
+def downgrade():
+    op.drop_index('ix_core__mediafiles_file_path',
+                  table_name='core__mediafiles')
+    op.drop_index('ix_core__media_entries_file_hash_state',
+                  table_name='core__media_entries')
+    with op.batch_alter_table('core__media_entries') as batch_op:
+        batch_op.drop_column('file_hash')
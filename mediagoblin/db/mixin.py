@@ -507,10 +507,7 @@ class CollectionMixin(GenerateSlugMixin, GeneratePublicIDMixin):
         if content is not None:
             item.note = content
 
-        self.num_items = self.num_items + 1
-
-        # Save both!
-        self.save(commit=commit)
+        # num_items is counted when the item is saved
         item.save(commit=commit)
         return item
 
@@ -21,17 +21,22 @@ TODO: indexes on foreignkeys, where useful.
 
 import logging
 import datetime
+from collections import Counter, defaultdict
 
 from sqlalchemy import (
     Column, Integer, Unicode, UnicodeText, DateTime, Boolean, ForeignKey,
-    UniqueConstraint, PrimaryKeyConstraint, SmallInteger, Date, Float)
-from sqlalchemy.orm import relationship, backref, class_mapper
+    UniqueConstraint, PrimaryKeyConstraint, SmallInteger, Date, Float, Index,
+    event, func, inspect, select)
+from sqlalchemy.orm import relationship, backref, class_mapper, joinedload, \
+    column_property, Session as ORMSession
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.sql import and_
 from sqlalchemy.sql.expression import desc
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.util import memoized_property
 
+from mediagoblin import mg_globals
 from mediagoblin.db.extratypes import (PathTupleWithSlashes, JSONEncoded,
                                        MutationDict)
 from mediagoblin.db.base import Base, DictReadAttrProxy
@@ -73,8 +78,14 @@ class GenericModelReference(Base):
         if self.model_type is None or self.obj_pk is None:
             return None
 
+        # What resolve() found, unless the reference was changed since
+        resolved = getattr(self, '_resolved_object', None)
+        if resolved is not None and \
+                resolved[:2] == (self.model_type, self.obj_pk):
+            return resolved[2]
+
         model = self._get_model_from_type(self.model_type)
-        return model.query.filter_by(id=self.obj_pk).first()
+        return model.query.get(self.obj_pk)
 
     def set_object(self, obj):
         model = obj.__class__
@@ -103,21 +114,55 @@ class GenericModelReference(Base):
         self.obj_pk = getattr(obj, pk_column.key)
         self.model_type = obj.__tablename__
 
-    def _get_model_from_type(self, model_type):
+    @classmethod
+    def _get_model_from_type(cls, model_type):
         """ Gets a model from a tablename (model type) """
-        if getattr(type(self), "_TYPE_MAP", None) is None:
+        if getattr(cls, "_TYPE_MAP", None) is None:
             # We want to build on the class (not the instance) a map of all the
             # models by the table name (type) for easy lookup, this is done on
             # the class so it can be shared between all instances
 
             # to prevent circular imports do import here
             registry = dict(Base._decl_class_registry).values()
-            self._TYPE_MAP = {
+            cls._TYPE_MAP = {
                 m.__tablename__: m for m in registry if hasattr(m, "__tablename__")
             }
-            setattr(type(self), "_TYPE_MAP",  self._TYPE_MAP)
 
-        return self.__class__._TYPE_MAP[model_type]
+        return cls._TYPE_MAP[model_type]
+
+    @classmethod
+    def resolve(cls, references):
+        """
+        Gets the objects of all REFERENCES with one query per model type
+
+        Returns a list of the objects in the order of REFERENCES, with None
+        for references which are None or point to objects that are gone.
+        Each reference keeps hold of its object, so get_object() returns
+        it instead of querying for it again.
+        """
+        references = list(references)
+        pks_by_type = defaultdict(set)
+        for reference in references:
+            if reference is None or reference.model_type is None \
+                    or reference.obj_pk is None:
+                continue
+            pks_by_type[reference.model_type].add(reference.obj_pk)
+
+        objects = {}
+        for model_type, pks in pks_by_type.items():
+            model = cls._get_model_from_type(model_type)
+            for obj in model.query.filter(model.id.in_(pks)):
+                objects[(model_type, obj.id)] = obj
+
+        resolved = []
+        for reference in references:
+            obj = None
+            if reference is not None:
+                obj = objects.get((reference.model_type, reference.obj_pk))
+                reference._resolved_object = (
+                    reference.model_type, reference.obj_pk, obj)
+            resolved.append(obj)
+        return resolved
 
     @classmethod
     def find_for_obj(cls, obj):
@@ -276,16 +321,12 @@ class User(Base, UserMixin):
         """Deletes a User and all related entries/comments/files/..."""
         # Collections get deleted by relationships.
 
-        media_entries = MediaEntry.query.filter(MediaEntry.actor == self.id)
-        for media in media_entries:
-            # TODO: Make sure that "MediaEntry.delete()" also deletes
-            # all related files/Comments
-            media.delete(del_orphan_tags=False, commit=False)
-
-        # Delete now unused tags
+        # Deletes unused tags and, once committed, the files too
         # TODO: import here due to cyclic imports!!! This cries for refactoring
-        from mediagoblin.db.util import clean_orphan_tags
-        clean_orphan_tags(commit=False)
+        from mediagoblin.db.util import delete_media_entries
+        media_ids = [media_id for (media_id,) in self._session.query(
+            MediaEntry.id).filter(MediaEntry.actor == self.id)]
+        delete_media_entries(media_ids, commit=False)
 
         # Delete user, pass through commit=False/True in kwargs
         username = self.username
@@ -306,10 +347,13 @@ class User(Base, UserMixin):
                                 even if the user hasn't been given the
                                 privilege. (defaults to True)
         """
-        priv = Privilege.query.filter_by(privilege_name=privilege).one()
-        if priv in self.all_privileges:
+        # all_privileges is loaded once per session and is changed in place
+        # by give_privileges() and take_away_privileges(), so checking
+        # against it needs neither a query per call nor invalidation.
+        privileges = {priv.privilege_name for priv in self.all_privileges}
+        if privilege in privileges:
             return True
-        elif allow_admin and self.has_privilege('admin', allow_admin=False):
+        elif allow_admin and 'admin' in privileges:
             return True
 
         return False
@@ -527,7 +571,10 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
     slug = Column(Unicode)
     description = Column(UnicodeText) # ??
     media_type = Column(Unicode, nullable=False)
-    state = Column(Unicode, default='unprocessed', nullable=False)
+    # The old state is needed to move the entry between MediaStateCounts
+    state = column_property(
+        Column(Unicode, default='unprocessed', nullable=False),
+        active_history=True)
         # or use sqlalchemy.types.Enum?
     license = Column(Unicode)
     file_size = Column(Integer, default=0)
@@ -536,7 +583,8 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
 
     created = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
         index=True)
-    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     fail_error = Column(Unicode)
     fail_metadata = Column(JSONEncoded)
@@ -544,12 +592,26 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
     transcoding_progress = Column(Float, default=0)
     main_transcoding_progress = Column(Float, default=0)
 
+    # Kept up to date by _count_flushed(), see "Counters" below
+    comment_count = Column(Integer, nullable=False, default=0)
+
     queued_media_file = Column(PathTupleWithSlashes)
 
     queued_task_id = Column(Unicode)
 
+    # sha256 of the uploaded data, to find other uploads of it
+    file_hash = Column(Unicode)
+
+    # Serve the listings of processed media (see the migration adding them)
     __table_args__ = (
         UniqueConstraint('actor', 'slug'),
+        Index('ix_core__media_entries_state_created', 'state', 'created'),
+        Index('ix_core__media_entries_actor_state_created',
+              'actor', 'state', 'created'),
+        Index('ix_core__media_entries_actor_state_id',
+              'actor', 'state', 'id'),
+        Index('ix_core__media_entries_file_hash_state',
+              'file_hash', 'state'),
         {})
 
     deletion_mode = Base.SOFT_DELETE
@@ -623,40 +685,72 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
             GenericModelReference.model_type == self.__tablename__
         ))
 
+        # Comment.id breaks ties, see Pagination's keys
         if ascending:
-            query = query.order_by(Comment.added.asc())
+            query = query.order_by(Comment.added.asc(), Comment.id.asc())
         else:
-            query = query.order_by(Comment.added.desc())
+            query = query.order_by(Comment.added.desc(), Comment.id.desc())
 
         return query
 
+    @classmethod
+    def neighbours_statement(cls, actor, media_id):
+        """
+        Select the (id, slug) of the processed entries by ACTOR right
+        after and before the one with MEDIA_ID, see neighbours
+        """
+        by_actor = select([cls.id, cls.slug]).where(and_(
+            cls.actor == actor,
+            cls.state == 'processed'))
+        newer = by_actor.where(cls.id > media_id) \
+            .order_by(cls.id).limit(1).alias()
+        older = by_actor.where(cls.id < media_id) \
+            .order_by(desc(cls.id)).limit(1).alias()
+        return select([newer]).union_all(select([older]))
+
+    @memoized_property
+    def neighbours(self):
+        """
+        The (id, slug) of the next 'newer' and 'older' processed entries
+        by this user, or None where there is none
+
+        Both are looked up in one query, without loading the entries.
+        """
+        rows = MediaEntry.query.session.execute(
+            self.neighbours_statement(self.actor, self.id))
+
+        newer = older = None
+        for media_id, slug in rows:
+            if media_id > self.id:
+                newer = (media_id, slug)
+            else:
+                older = (media_id, slug)
+        return newer, older
+
+    def _url_to_neighbour(self, urlgen, neighbour):
+        if neighbour is not None:
+            media_id, slug = neighbour
+            # Our neighbours share our uploader
+            return urlgen(
+                'mediagoblin.user_pages.media_home',
+                user=self.get_actor.username,
+                media=slug or 'id:%s' % media_id)
+
     def url_to_prev(self, urlgen):
         """get the next 'newer' entry by this user"""
-        media = MediaEntry.query.filter(
-            (MediaEntry.actor == self.actor)
-            & (MediaEntry.state == 'processed')
-            & (MediaEntry.id > self.id)).order_by(MediaEntry.id).first()
-
-        if media is not None:
-            return media.url_for_self(urlgen)
+        return self._url_to_neighbour(urlgen, self.neighbours[0])
 
     def url_to_next(self, urlgen):
         """get the next 'older' entry by this user"""
-        media = MediaEntry.query.filter(
-            (MediaEntry.actor == self.actor)
-            & (MediaEntry.state == 'processed')
-            & (MediaEntry.id < self.id)).order_by(desc(MediaEntry.id)).first()
-
-        if media is not None:
-            return media.url_for_self(urlgen)
+        return self._url_to_neighbour(urlgen, self.neighbours[1])
 
     def get_file_metadata(self, file_key, metadata_key=None):
         """
         Return the file_metadata dict of a MediaFile. If metadata_key is given,
         return the value of the key.
         """
-        media_file = MediaFile.query.filter_by(media_entry=self.id,
-                                               name=str(file_key)).first()
+        # Read from the loaded files, see db.util.preload_media_files
+        media_file = self.media_files_helper.get(str(file_key))
 
         if media_file:
             if metadata_key:
@@ -668,8 +762,7 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
         """
         Update the file_metadata of a MediaFile.
         """
-        media_file = MediaFile.query.filter_by(media_entry=self.id,
-                                               name=str(file_key)).first()
+        media_file = self.media_files_helper.get(str(file_key))
 
         file_metadata = media_file.file_metadata or {}
 
@@ -701,6 +794,26 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
             for field, value in kwargs.items():
                 setattr(media_data, field, value)
 
+    def reuse_files_of(self, other):
+        """
+        Take over the files and media data of OTHER, a processed entry
+        of the same upload, instead of processing this one
+
+        The files are shared, see tools.files.shared_file_paths.
+        """
+        for name, media_file in other.media_files_helper.items():
+            self.media_files_helper[name] = MediaFile(
+                name=name,
+                file_path=media_file.file_path,
+                file_metadata=dict(media_file.file_metadata or {}))
+
+        media_data = other.media_data
+        if media_data is not None:
+            self.media_data_init(**{
+                column.key: getattr(media_data, column.key)
+                for column in media_data.__table__.columns
+                if not column.primary_key})
+
     @memoized_property
     def media_data_ref(self):
         return import_component(self.media_type + '.models:BACKREF_NAME')
@@ -797,19 +910,10 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
             context["tags"] = []
 
         if show_comments:
-            comments = [
-                l.comment().serialize(request) for l in self.get_comments()]
-            total = len(comments)
-            context["replies"] = {
-                "totalItems": total,
-                "items": comments,
-                "url": request.urlgen(
-                        "mediagoblin.api.object.comments",
-                        object_type=self.object_type,
-                        id=self.id,
-                        qualified=True
-                        ),
-            }
+            # Only the newest comments are embedded, the rest can be had
+            # from the replies url
+            context["replies"] = self.serialize_replies(
+                request, limit=mg_globals.app_config['api_comments_limit'])
 
         # Add image height and width if possible. We didn't use to store this
         # data and we're not able (and maybe not willing) to re-process all
@@ -829,6 +933,58 @@ class MediaEntry(Base, MediaEntryMixin, CommentingMixin):
 
         return context
 
+    def serialize_replies(self, request, limit=None, offset=0):
+        """
+        Serialize the collection of comments on this entry, newest first
+
+        Only LIMIT of them, if given, are included, starting at OFFSET.
+        """
+        comments = self.get_comments()
+        if offset:
+            comments = comments.offset(offset)
+        if limit:
+            comments = comments.limit(limit)
+        return {
+            "totalItems": self.comment_count,
+            "items": self._serialize_comments(request, comments),
+            "url": request.urlgen(
+                    "mediagoblin.api.object.comments",
+                    object_type=self.object_type,
+                    id=self.id,
+                    qualified=True
+                    ),
+        }
+
+    def _serialize_comments(self, request, comments):
+        """
+        Serialize the comments from the Comment query COMMENTS.
+
+        Text comments are loaded with their authors in one query and share
+        one serialization of this entry for what they reply to.
+        """
+        links = comments.options(joinedload(Comment.comment_helper)).all()
+        text_comment_ids = [
+            link.comment_helper.obj_pk for link in links
+            if link.comment_helper.model_type == TextComment.__tablename__]
+        text_comments = {}
+        if text_comment_ids:
+            text_comments = {
+                comment.id: comment for comment in TextComment.query.options(
+                    joinedload(TextComment.get_actor)).filter(
+                        TextComment.id.in_(text_comment_ids))}
+
+        in_reply_to = self.serialize(request, show_comments=False)
+        items = []
+        for link in links:
+            if link.comment_helper.model_type == TextComment.__tablename__:
+                comment = text_comments.get(link.comment_helper.obj_pk)
+                if comment is not None:
+                    items.append(
+                        comment.serialize(request, in_reply_to=in_reply_to))
+            else:
+                items.append(link.comment().serialize(request))
+        return items
+
     def unserialize(self, data):
         """ Takes API objects and unserializes on existing MediaEntry """
         if "displayName" in data:
@@ -884,6 +1040,9 @@ class MediaFile(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('media_entry', 'name_id'),
+        # Files may be shared by copies of an upload, see
+        # MediaEntry.reuse_files_of
+        Index('ix_core__mediafiles_file_path', 'file_path'),
         {})
 
     def __repr__(self):
@@ -990,6 +1149,12 @@ class Comment(Base):
     """
     __tablename__ = "core__comment_links"
 
+    # Serves listing an object's comments in order (get_comments)
+    __table_args__ = (
+        Index("ix_core__comment_links_target_id_added",
+              "target_id", "added"),
+        {})
+
     id = Column(Integer, primary_key=True)
 
     # The GMR to the object the comment is on.
@@ -1051,7 +1216,8 @@ class TextComment(Base, TextCommentMixin, CommentingMixin):
     public_id = Column(Unicode, unique=True)
     actor = Column(Integer, ForeignKey(User.id), nullable=False)
     created = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
-    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
     content = Column(UnicodeText, nullable=False)
     location = Column(Integer, ForeignKey("core__locations.id"))
     get_location = relationship("Location", lazy="joined")
@@ -1065,14 +1231,22 @@ class TextComment(Base, TextCommentMixin, CommentingMixin):
                                               cascade="all, delete-orphan"))
     deletion_mode = Base.SOFT_DELETE
 
-    def serialize(self, request):
-        """ Unserialize to python dictionary for API """
-        target = self.get_reply_to()
-        # If this is target just.. give them nothing?
-        if target is None:
-            target = {}
+    def serialize(self, request, in_reply_to=None):
+        """
+        Unserialize to python dictionary for API
+
+        in_reply_to is the serialized object this is a reply to, if the
+        caller already has it.
+        """
+        if in_reply_to is not None:
+            target = in_reply_to
         else:
-            target = target.serialize(request, show_comments=False)
+            target = self.get_reply_to()
+            # If this is target just.. give them nothing?
+            if target is None:
+                target = {}
+            else:
+                target = target.serialize(request, show_comments=False)
 
 
         author = self.get_actor
@@ -1155,9 +1329,11 @@ class Collection(Base, CollectionMixin, CommentingMixin):
     slug = Column(Unicode)
     created = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
                      index=True)
-    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
     description = Column(UnicodeText)
     actor = Column(Integer, ForeignKey(User.id), nullable=False)
+    # Kept up to date by _count_flushed(), see "Counters" below
     num_items = Column(Integer, default=0)
 
     # There are lots of different special types of collections in the pump.io API
@@ -1207,7 +1383,10 @@ class Collection(Base, CollectionMixin, CommentingMixin):
 
     def serialize(self, request):
         # Get all serialized output in a list
-        items = [i.serialize(request) for i in self.get_collection_items()]
+        items = self.get_collection_items().options(
+            joinedload(CollectionItem.object_helper)).all()
+        GenericModelReference.resolve(item.object_helper for item in items)
+        items = [i.serialize(request) for i in items]
         return {
             "totalItems": self.num_items,
             "url": self.url_for_self(request.urlgen, qualified=True),
@@ -1332,6 +1511,11 @@ class Notification(Base):
         User,
         backref=backref('notifications', cascade='all, delete-orphan'))
 
+    # A user's unseen notifications are looked up on every page
+    __table_args__ = (
+        Index('ix_core__notifications_user_id_seen', 'user_id', 'seen'),
+        {})
+
     def __repr__(self):
         return '<{klass} #{id}: {user}: {subject} ({seen})>'.format(
             id=self.id,
@@ -1636,12 +1820,189 @@ class Graveyard(Base):
             context["actor"] = self.actor().serialize(request)
 
         return context
+
+
+class MediaStateCount(Base):
+    """
+    How many media entries a user has in a processing state
+
+    Kept up to date by _count_flushed(), see "Counters" below.
+    """
+    __tablename__ = "core__media_state_counts"
+
+    actor = Column(Integer, ForeignKey(User.id), nullable=False)
+    state = Column(Unicode, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    get_actor = relationship(User,
+                             backref=backref("media_state_counts",
+                                             cascade="all, delete-orphan"))
+
+    __table_args__ = (
+        PrimaryKeyConstraint('actor', 'state'),
+        {})
+
+    @classmethod
+    def for_user(cls, user_id):
+        """ Returns a dict of state: media entry count for a user """
+        counts = cls.query.filter_by(actor=user_id).with_entities(
+            cls.state, cls.count)
+        return dict(counts)
+
+
+######################################################
+# Counters
+#
+# Comments per media entry, items per collection and media entries per
+# user and state are counted as rows come and go, in the same
+# transaction, so pages showing them don't have to COUNT(*) anything.
+# Bulk query updates and deletes bypass the session and have to call
+# the update_*_counts() functions themselves.  "gmg rebuild_counters"
+# recounts everything.
+######################################################
+
+def update_comment_counts(session, changes):
+    """
+    Applies CHANGES, a dict of comment link target (GenericModelReference
+    id): number of comments gained (or lost, if negative), to the media
+    entries the targets point to.  Returns the ids of those entries.
+    """
+    changes = {target: delta for target, delta in changes.items() if delta}
+    if not changes:
+        return []
+
+    targets = session.query(
+        GenericModelReference.id, GenericModelReference.obj_pk).filter(
+            GenericModelReference.id.in_(changes),
+            GenericModelReference.model_type == MediaEntry.__tablename__)
+    media_ids = []
+    for target, media_id in targets:
+        session.execute(MediaEntry.__table__.update().where(
+            MediaEntry.id == media_id).values(
+                comment_count=MediaEntry.comment_count + changes[target]))
+        media_ids.append(media_id)
+    return media_ids
+
+
+def update_collection_counts(session, changes):
+    """
+    Applies CHANGES, a dict of collection id: number of items gained (or
+    lost, if negative).  Returns the ids of the collections.
+    """
+    collection_ids = []
+    for collection_id, delta in changes.items():
+        if not delta:
+            continue
+        session.execute(Collection.__table__.update().where(
+            Collection.id == collection_id).values(
+                num_items=func.coalesce(Collection.num_items, 0) + delta))
+        collection_ids.append(collection_id)
+    return collection_ids
+
+
+def update_media_state_counts(session, changes):
+    """
+    Applies CHANGES, a dict of (actor, state): number of media entries
+    the user gained (or lost, if negative) in that state
+    """
+    table = MediaStateCount.__table__
+    connection = session.connection()
+
+    def add_to_count(actor, state, delta):
+        return connection.execute(table.update().where(and_(
+            table.c.actor == actor, table.c.state == state)).values(
+                count=table.c.count + delta)).rowcount
+
+    for (actor, state), delta in changes.items():
+        # Nothing to take away from if the user is on their way out
+        if not delta or add_to_count(actor, state, delta) or delta < 0:
+            continue
+
+        # Another transaction may be adding the row too, in which case
+        # the insert fails and the row it added is updated instead.  The
+        # savepoint keeps the failed insert from aborting this transaction.
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert().values(
+                actor=actor, state=state, count=delta))
+        except IntegrityError:
+            savepoint.rollback()
+            add_to_count(actor, state, delta)
+        else:
+            savepoint.commit()
+
+
+def expire_counters(session, model, ids, counter):
+    """ Makes the objects of MODEL with ids IDS reload COUNTER """
+    for obj_id in ids:
+        obj = session.identity_map.get(session.identity_key(model, obj_id))
+        if obj is not None:
+            session.expire(obj, [counter])
+
+
+def _load_counted_attributes(session, flush_context, instances):
+    """
+    Loads what _count_flushed() needs of objects that are going to be
+    deleted, while they still exist
+    """
+    for obj in session.deleted:
+        if isinstance(obj, Comment):
+            obj.target_id
+        elif isinstance(obj, CollectionItem):
+            obj.collection
+        elif isinstance(obj, MediaEntry):
+            obj.actor, obj.state
+
+
+def _count_flushed(session, flush_context):
+    """ Counts the objects the session just inserted and deleted """
+    comments = Counter()
+    items = Counter()
+    states = Counter()
+
+    flushed = [(obj, 1) for obj in session.new] + \
+        [(obj, -1) for obj in session.deleted]
+    for obj, delta in flushed:
+        if isinstance(obj, Comment):
+            comments[obj.target_id] += delta
+        elif isinstance(obj, CollectionItem):
+            items[obj.collection] += delta
+        elif isinstance(obj, MediaEntry):
+            states[(obj.actor, obj.state)] += delta
+
+    for obj in session.dirty:
+        if isinstance(obj, MediaEntry):
+            history = inspect(obj).attrs.state.history
+            if history.added and history.deleted:
+                states[(obj.actor, history.deleted[0])] -= 1
+                states[(obj.actor, history.added[0])] += 1
+
+    update_media_state_counts(session, states)
+    # Objects can only be expired once the flush is done with them
+    session.info.setdefault('flushed_counters', []).extend([
+        (MediaEntry, update_comment_counts(session, comments),
+         'comment_count'),
+        (Collection, update_collection_counts(session, items),
+         'num_items')])
+
+
+def _expire_flushed_counters(session, flush_context):
+    for model, ids, counter in session.info.pop('flushed_counters', []):
+        expire_counters(session, model, ids, counter)
+
+
+event.listen(ORMSession, 'before_flush', _load_counted_attributes)
+event.listen(ORMSession, 'after_flush', _count_flushed)
+event.listen(ORMSession, 'after_flush_postexec', _expire_flushed_counters)
+
+
 MODELS = [
     LocalUser, RemoteUser, User, MediaEntry, Tag, MediaTag, Comment, TextComment,
     Collection, CollectionItem, MediaFile, FileKeynames, MediaAttachmentFile, MediaSubtitleFile,
     ProcessingMetaData, Notification, Client, CommentSubscription, Report,
     UserBan, Privilege, PrivilegeUserAssociation, RequestToken, AccessToken,
-    NonceTimestamp, Activity, Generator, Location, GenericModelReference, Graveyard]
+    NonceTimestamp, Activity, Generator, Location, GenericModelReference, Graveyard,
+    MediaStateCount]
 
 """
  Foundations are the default rows that are created immediately after the tables
@@ -15,9 +15,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+from collections import Counter, defaultdict
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session as ORMSession
+from sqlalchemy.orm.attributes import set_committed_value
 
 from mediagoblin import mg_globals as mgg
-from mediagoblin.db.models import MediaEntry, Tag, MediaTag, Collection
+from mediagoblin.db.base import Base
+from mediagoblin.db.models import MediaEntry, MediaFile, Tag, MediaTag, \
+    Collection, CollectionItem, Comment, GenericModelReference, \
+    MediaStateCount, MediaAttachmentFile, MediaSubtitleFile, Notification, \
+    Report, Graveyard, User, update_collection_counts, \
+    update_comment_counts, update_media_state_counts, expire_counters
 from mediagoblin.gmg_commands.dbupdate import gather_database_data
 
 from mediagoblin.tools.transition import DISABLE_GLOBALS
@@ -36,6 +46,67 @@ def atomic_update(table, query_dict, update_values):
     Session.commit()
 
 
+def preload_media_files(entries):
+    """
+    Load the media files of all the media entries in ENTRIES in one query
+
+    Otherwise every entry loads its own files when they are first used,
+    by its thumbnail or get_file_metadata for instance.  ENTRIES may hold
+    other objects too, they are left alone.  Returns ENTRIES as a list.
+    """
+    entries = list(entries)
+    unloaded = {
+        entry.id: entry for entry in entries
+        if isinstance(entry, MediaEntry)
+        and 'media_files_helper' in inspect(entry).unloaded}
+    if not unloaded:
+        return entries
+
+    media_files = defaultdict(list)
+    for media_file in MediaFile.query.filter(
+            MediaFile.media_entry.in_(unloaded)):
+        media_files[media_file.media_entry].append(media_file)
+
+    for entry_id, entry in unloaded.items():
+        set_committed_value(entry, 'media_files_helper',
+                            media_files[entry_id])
+    return entries
+
+
+def preload_references(objects, *helpers):
+    """
+    Resolve the GenericModelReference HELPERS of all OBJECTS in bulk
+
+    HELPERS are relationship names such as "object_helper".  References
+    which aren't loaded yet are fetched in one query, then
+    GenericModelReference.resolve gets what they point to with one query
+    per model type.  Returns OBJECTS as a list.
+    """
+    objects = list(objects)
+    unloaded = []
+    for obj in objects:
+        state = inspect(obj)
+        for helper in helpers:
+            if helper in state.unloaded:
+                column, = state.mapper.relationships[helper].local_columns
+                key = state.mapper.get_property_by_column(column).key
+                unloaded.append((obj, helper, getattr(obj, key)))
+
+    pks = {pk for obj, helper, pk in unloaded if pk is not None}
+    references = {}
+    if pks:
+        references = {
+            reference.id: reference for reference in
+            GenericModelReference.query.filter(
+                GenericModelReference.id.in_(pks))}
+    for obj, helper, pk in unloaded:
+        set_committed_value(obj, helper, references.get(pk))
+
+    GenericModelReference.resolve(
+        getattr(obj, helper) for obj in objects for helper in helpers)
+    return objects
+
+
 def check_media_slug_used(uploader_id, slug, ignore_m_id):
     query = MediaEntry.query.filter_by(actor=uploader_id, slug=slug)
     if ignore_m_id is not None:
@@ -55,13 +126,231 @@ def media_entries_for_tag_slug(dummy_db, tag_slug):
 
 def clean_orphan_tags(commit=True):
     """Search for unused MediaTags and delete them"""
-    q1 = Session.query(Tag).outerjoin(MediaTag).filter(MediaTag.id==None)
-    for t in q1:
-        Session.delete(t)
-    # The "let the db do all the work" version:
-    # q1 = Session.query(Tag.id).outerjoin(MediaTag).filter(MediaTag.id==None)
-    # q2 = Session.query(Tag).filter(Tag.id.in_(q1))
-    # q2.delete(synchronize_session = False)
+    q1 = Session.query(Tag.id).outerjoin(MediaTag).filter(MediaTag.id==None)
+    q2 = Session.query(Tag).filter(Tag.id.in_(q1.subquery()))
+    q2.delete(synchronize_session='fetch')
+    if commit:
+        Session.commit()
+
+
+#################
+# Bulk deletion
+#################
+
+# Ids per statement, well below the variable limit of SQLite
+DELETE_BATCH_SIZE = 500
+
+# Files queued for deletion from storage per celery task
+FILE_DELETE_BATCH_SIZE = 100
+
+
+def _batches(ids, size=DELETE_BATCH_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _clear_references(session, model_type, ids):
+    """
+    Does what Base.delete does before deleting an object, for the
+    objects of table MODEL_TYPE with IDS: drops the collection items,
+    notifications and comment links about them and unlinks reports.
+    Returns {id: GenericModelReference id} of those that had one.
+    """
+    refs = dict(session.query(
+        GenericModelReference.obj_pk, GenericModelReference.id).filter(
+            GenericModelReference.model_type == model_type,
+            GenericModelReference.obj_pk.in_(ids)))
+    ref_ids = list(refs.values())
+    if not ref_ids:
+        return refs
+
+    items = CollectionItem.query.filter(CollectionItem.object_id.in_(ref_ids))
+    collections = Counter(
+        c for (c,) in items.with_entities(CollectionItem.collection))
+    collections = update_collection_counts(
+        session, {c: -n for c, n in collections.items()})
+    items.delete(synchronize_session=False)
+    expire_counters(session, Collection, collections, 'num_items')
+
+    Notification.query.filter(Notification.object_id.in_(ref_ids)).delete(
+        synchronize_session=False)
+
+    comments = Comment.query.filter(Comment.comment_id.in_(ref_ids))
+    targets = Counter(t for (t,) in comments.with_entities(Comment.target_id))
+    media = update_comment_counts(
+        session, {t: -n for t, n in targets.items()})
+    comments.delete(synchronize_session=False)
+    expire_counters(session, MediaEntry, media, 'comment_count')
+
+    Report.query.filter(Report.object_id.in_(ref_ids)).update(
+        {'object_id': None}, synchronize_session=False)
+    return refs
+
+
+def _bury(session, rows, refs):
+    """
+    Leaves a Graveyard tombstone for each of ROWS, (id, actor,
+    public_id, object_type) of soft deleted objects, and points
+    their GenericModelReferences (REFS, by id) at it, like soft_delete
+    """
+    actors = {actor for (obj_id, actor, public_id, object_type) in rows}
+    actor_refs = dict(session.query(
+        GenericModelReference.obj_pk, GenericModelReference.id).filter(
+            GenericModelReference.model_type == User.__tablename__,
+            GenericModelReference.obj_pk.in_(actors)))
+    new_refs = {
+        actor: GenericModelReference(
+            obj_pk=actor, model_type=User.__tablename__)
+        for actor in actors - set(actor_refs)}
+    session.add_all(new_refs.values())
+    session.flush()
+    actor_refs.update((actor, ref.id) for actor, ref in new_refs.items())
+
+    tombstones = {
+        obj_id: Graveyard(public_id=public_id, object_type=object_type,
+                          actor_id=actor_refs[actor])
+        for (obj_id, actor, public_id, object_type) in rows}
+    session.add_all(tombstones.values())
+    session.flush()
+
+    session.bulk_update_mappings(GenericModelReference, [
+        {'id': ref_id, 'obj_pk': tombstones[obj_id].id,
+         'model_type': Graveyard.__tablename__}
+        for obj_id, ref_id in refs.items()])
+
+
+def _delete_dependents(session, model, ids):
+    """Deletes the rows of every table with a foreign key to MODEL's ids"""
+    for table in reversed(Base.metadata.sorted_tables):
+        for fk in table.foreign_keys:
+            if fk.references(model.__table__):
+                session.execute(table.delete().where(fk.parent.in_(ids)))
+
+
+def _delete_media_batch(session, ids):
+    # Locked so no new entry takes over their files before they are
+    # gone, see submit.lib.reuse_processed_media
+    entries = session.query(
+        MediaEntry.id, MediaEntry.actor, MediaEntry.public_id,
+        MediaEntry.media_type, MediaEntry.state).filter(
+            MediaEntry.id.in_(ids)).with_for_update().all()
+    ids = [entry.id for entry in entries]
+    if not ids:
+        return
+
+    # Removed from storage once this is committed, unless entries which
+    # stay share them, see MediaEntry.reuse_files_of
+    media_files = MediaFile.query.filter(MediaFile.media_entry.in_(ids))
+    shared = MediaFile.query.filter(
+        MediaFile.file_path.in_(
+            media_files.with_entities(MediaFile.file_path).subquery()),
+        ~MediaFile.media_entry.in_(ids))
+    shared = {tuple(path) for (path,) in shared.with_entities(
+        MediaFile.file_path)}
+    filepaths = list({tuple(path): path for (path,) in
+                      media_files.with_entities(MediaFile.file_path)
+                      if path and tuple(path) not in shared}.values())
+    for model in (MediaAttachmentFile, MediaSubtitleFile):
+        filepaths.extend(path for (path,) in session.query(
+            model.filepath).filter(model.media_entry.in_(ids)))
+    session.info.setdefault('deleted_files', []).extend(
+        path for path in filepaths if path)
+
+    refs = _clear_references(session, MediaEntry.__tablename__, ids)
+
+    # The comments on the entries go with them, see
+    # MediaEntry.soft_delete
+    if refs:
+        comment_ids = [comment_id for (comment_id,) in session.query(
+            Comment.id).filter(Comment.target_id.in_(refs.values()))]
+        _clear_references(session, Comment.__tablename__, comment_ids)
+        Comment.query.filter(Comment.id.in_(comment_ids)).delete(
+            synchronize_session=False)
+
+    _bury(session,
+          [(entry.id, entry.actor, entry.public_id,
+            entry.media_type.split('.')[-1]) for entry in entries],
+          refs)
+
+    states = Counter((entry.actor, entry.state) for entry in entries)
+    update_media_state_counts(
+        session, {key: -count for key, count in states.items()})
+
+    _delete_dependents(session, MediaEntry, ids)
+    MediaEntry.query.filter(MediaEntry.id.in_(ids)).delete(
+        synchronize_session=False)
+
+    # Whatever of them was loaded is gone
+    for entry_id in ids:
+        entry = session.identity_map.get(
+            session.identity_key(MediaEntry, entry_id))
+        if entry is not None:
+            session.expunge(entry)
+
+
+def delete_media_entries(media_ids, commit=True):
+    """
+    Delete the media entries with MEDIA_IDS, like MediaEntry.delete
+    does, but with a few statements per table for each batch of entries
+    instead of loading and deleting everything about them one by one
+
+    Their files are deleted from storage by celery tasks once the
+    deletion is committed.
+    """
+    session = Session()
+    for ids in _batches(media_ids):
+        _delete_media_batch(session, ids)
+    clean_orphan_tags(commit=False)
+    if commit:
+        session.commit()
+
+
+def _queue_file_deletions(session):
+    # Import here to prevent cyclic imports.
+    from mediagoblin.tools.files import delete_files_task
+
+    filepaths = session.info.pop('deleted_files', None)
+    for paths in _batches(filepaths or [], FILE_DELETE_BATCH_SIZE):
+        delete_files_task.delay(paths)
+
+
+def _forget_file_deletions(session):
+    session.info.pop('deleted_files', None)
+
+
+event.listen(ORMSession, 'after_commit', _queue_file_deletions)
+event.listen(ORMSession, 'after_rollback', _forget_file_deletions)
+
+
+def rebuild_counters(commit=True):
+    """
+    Recount the comments of every media entry, the items of every
+    collection and the media entries of every user in each state
+    """
+    comment_count = Session.query(func.count(Comment.id)).join(
+        Comment.target_helper).filter(
+            GenericModelReference.model_type == MediaEntry.__tablename__,
+            GenericModelReference.obj_pk == MediaEntry.id).\
+        correlate(MediaEntry).as_scalar()
+    MediaEntry.query.update({MediaEntry.comment_count: comment_count},
+                            synchronize_session=False)
+
+    num_items = Session.query(func.count(CollectionItem.id)).filter(
+        CollectionItem.collection == Collection.id).\
+        correlate(Collection).as_scalar()
+    Collection.query.update({Collection.num_items: num_items},
+                            synchronize_session=False)
+
+    MediaStateCount.query.delete(synchronize_session=False)
+    state_counts = Session.query(
+        MediaEntry.actor, MediaEntry.state, func.count(MediaEntry.id)).\
+        group_by(MediaEntry.actor, MediaEntry.state)
+    Session.execute(MediaStateCount.__table__.insert().from_select(
+        ['actor', 'state', 'count'], state_counts.statement))
+
+    # What's in the session may be counted wrong
+    Session.expire_all()
     if commit:
         Session.commit()
 
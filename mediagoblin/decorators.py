@@ -25,6 +25,8 @@ from mediagoblin import mg_globals as mgg
 from mediagoblin import messages
 from mediagoblin.db.models import (
     MediaEntry, LocalUser, AccessToken, Comment)
+from mediagoblin.tools.pagination import (
+    PAGINATION_TOKEN_PARAM, decode_pagination_token)
 from mediagoblin.tools.response import (
     redirect, render_404,
     render_user_banned, json_response)
@@ -156,7 +158,7 @@ def user_may_alter_collection(controller):
 
 def uses_pagination(controller):
     """
-    Check request GET 'page' key for wrong values
+    Check request GET 'page' and pagination token keys for wrong values
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
@@ -164,6 +166,10 @@ def uses_pagination(controller):
             page = int(request.GET.get('page', 1))
             if page < 0:
                 return render_404(request)
+
+            token = request.GET.get(PAGINATION_TOKEN_PARAM)
+            if token:
+                decode_pagination_token(token)
         except ValueError:
             return render_404(request)
 
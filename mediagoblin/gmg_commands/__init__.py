@@ -78,6 +78,14 @@ SUBCOMMAND_MAP = {
         'setup': 'mediagoblin.gmg_commands.batchaddmedia:parser_setup',
         'func': 'mediagoblin.gmg_commands.batchaddmedia:batchaddmedia',
         'help': 'Add many media entries at once'},
+    'rebuild_counters': {
+        'setup': 'mediagoblin.gmg_commands.counters:parser_setup',
+        'func': 'mediagoblin.gmg_commands.counters:rebuild_counters',
+        'help': 'Recount comments, collection items and media states'},
+    'explain': {
+        'setup': 'mediagoblin.gmg_commands.explain:parser_setup',
+        'func': 'mediagoblin.gmg_commands.explain:explain_queries',
+        'help': 'Check the busiest queries are served by indexes'},
     'alembic': {
         'setup': 'mediagoblin.gmg_commands.alembic_commands:parser_setup',
         'func': 'mediagoblin.gmg_commands.alembic_commands:raw_alembic_cli',
@@ -15,18 +15,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+
+import collections
 import csv
+import functools
 import os
 import shutil
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from urllib.parse import urlparse
 
+from mediagoblin.db.base import Session
 from mediagoblin.db.models import LocalUser, MediaEntry
 from mediagoblin.gmg_commands import util as commands_util
+from mediagoblin.media_types import sniff_media, FileTypeNotSupported
 from mediagoblin.submit.lib import (
-    submit_media, FileUploadLimit, UserUploadLimit, UserPastUploadLimit)
+    queue_media, submit_queued_media, start_processing, discard_queued_file,
+    get_upload_file_limits, get_upload_byte_limits,
+    UploadLimitError, FileUploadLimit, UserUploadLimit, UserPastUploadLimit)
 from mediagoblin.tools.metadata import compact_and_validate
 from mediagoblin.tools.translate import pass_to_ugettext as _
 from jsonschema.exceptions import ValidationError
@@ -50,6 +59,218 @@ documentation page on command line uploading
         '--celery',
         action='store_true',
         help=_("Don't process eagerly, pass off to celery"))
+    subparser.add_argument(
+        '--parallel',
+        type=int,
+        default=1,
+        metavar='N',
+        help=_("Read, hash and queue the files of N rows at a time"))
+    subparser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        metavar='N',
+        help=_("Commit the new media entries to the database N at a time"))
+    subparser.add_argument(
+        '--checkpoint',
+        metavar='PATH',
+        help=_("Keep track of the rows done in this file, and continue "
+               "after them if it exists"))
+    subparser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help=_("Only check the rows could be submitted"))
+
+
+def _failure_message(row, exc):
+    """What to tell about EXC, which kept the file of ROW out"""
+    if isinstance(exc, OSError):
+        return _("""\
+FAIL: Local file {filename} could not be accessed.
+{filename} will not be uploaded.""".format(filename=row['filename']))
+    elif isinstance(exc, FileTypeNotSupported):
+        return 'FAIL: {}: {}'.format(row['filename'], exc)
+    elif isinstance(exc, FileUploadLimit):
+        return _(
+"FAIL: This file is larger than the upload limits for this site.")
+    elif isinstance(exc, UserUploadLimit):
+        return _(
+"FAIL: This file will put this user past their upload limits.")
+    else:
+        return _("FAIL: This user is already past their upload limits.")
+
+
+def _read_rows(user, metadata_path, start=0):
+    """
+    Yield a dict for each row of the csv file from index START on, with
+    an 'error' to report if its metadata is no good
+    """
+    abs_metadata_dir = os.path.dirname(metadata_path)
+    # The slugs of this run, which may not be in the database yet
+    slugs = set()
+
+    with open(metadata_path) as all_metadata:
+        media_metadata = csv.DictReader(all_metadata)
+        for index, file_metadata in enumerate(media_metadata):
+            if index < start:
+                continue
+
+            # Get all metadata entries starting with 'media' as variables and
+            # then delete them because those are for internal use only.
+            original_location = file_metadata['location']
+            url = urlparse(original_location)
+
+            ### Pull the important media information for mediagoblin from the
+            ### metadata, if it is provided.
+            row = {
+                'index': index,
+                'url': url,
+                'filename': url.path.split()[-1],
+                'metadata_dir': abs_metadata_dir,
+                'slug': file_metadata.get('slug'),
+                'title': (file_metadata.get('title') or
+                          file_metadata.get('dc:title')),
+                'description': (file_metadata.get('description') or
+                                file_metadata.get('dc:description')),
+                'collection_slug': file_metadata.get('collection-slug'),
+                'license': file_metadata.get('license'),
+            }
+
+            try:
+                row['metadata'] = compact_and_validate(file_metadata)
+            except ValidationError as exc:
+                media_id = file_metadata.get('id') or index
+                row['error'] = _("""Error with media '{media_id}' value '{error_path}': {error_msg}
+Metadata was not uploaded.""".format(
+                    media_id=media_id,
+                    error_path=exc.path[0],
+                    error_msg=exc.message))
+                yield row
+                continue
+
+            slug = row['slug']
+            if slug and (slug in slugs or MediaEntry.query.filter_by(
+                    actor=user.id, slug=slug).count()):
+                # Avoid re-importing media from a previous batch run. Note
+                # that this check isn't quite robust enough, since it
+                # requires that a slug is specified. Probably needs to be
+                # based on "location" since this is the only required field.
+                row['error'] = '{}: {}'.format(
+                    slug,
+                    _('An entry with that slug already exists for this user.'))
+            elif slug:
+                slugs.add(slug)
+            yield row
+
+
+def _open_media(row):
+    """Open the media of ROW for reading, downloading it if need be"""
+    url = row['url']
+    if url.scheme.startswith('http'):
+        res = requests.get(url.geturl(), stream=True)
+        if res.headers.get('content-encoding'):
+            # The requests library's "raw" method does not deal with content
+            # encoding. Alternative could be to use iter_content(), and
+            # write chunks to the temporary file.
+            raise NotImplementedError('URL-based media with content-encoding (eg. gzip) are not currently supported.')
+
+        # To avoid loading the media into memory all at once, we write it to
+        # a file before importing. This currently requires free space up to
+        # twice the size of the media file. Memory use can be tested by
+        # running something like `ulimit -Sv 200000` before running
+        # `batchaddmedia` to upload a file larger than 200MB.
+        media_file = tempfile.TemporaryFile()
+        shutil.copyfileobj(res.raw, media_file)
+        media_file.seek(0)
+        return media_file
+
+    path = url.path
+    if not os.path.isabs(path):
+        path = os.path.join(row['metadata_dir'], path)
+    return open(os.path.abspath(path), 'rb')
+
+
+def _queue_row(app, dry_run, job):
+    """
+    Copy the media of a row from _read_rows to the queue store, keeping
+    to the byte limits given with it, or only check it could be with
+    DRY_RUN
+
+    This runs in the worker threads, so it may not use the database, nor
+    translate messages: what goes wrong is left in 'failure' for later.
+    """
+    row, limits = job
+    if row.get('error'):
+        return row
+
+    try:
+        media_file = _open_media(row)
+    except OSError as exc:
+        row['failure'] = exc
+        return row
+
+    try:
+        if dry_run:
+            size = os.fstat(media_file.fileno()).st_size
+            for limit, error in limits:
+                if size >= limit:
+                    raise error()
+            sniff_media(media_file, row['filename'])
+            row['file_size'] = size / (1024.0 * 1024)
+        else:
+            row['entry'] = queue_media(
+                app, media_file, row['filename'], limits)
+    except (UploadLimitError, FileTypeNotSupported) as exc:
+        row['failure'] = exc
+    finally:
+        media_file.close()
+    return row
+
+
+def _imap(function, items, workers, discard=None):
+    """
+    Like map, with FUNCTION called by WORKERS threads at once
+
+    The results come in the order of ITEMS, which are taken a few at a
+    time only, as the results are consumed.  If the consumer stops
+    early, the results computed for it all the same are passed to
+    DISCARD.
+    """
+    if workers <= 1:
+        yield from map(function, items)
+        return
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Those which started can't be cancelled any more
+            for future in pending:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                if discard is not None:
+                    discard(future.result())
+
+
+def _read_checkpoint(path):
+    """The index of the first row not done yet, kept in the file at PATH"""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint:
+        return int(checkpoint.read().strip() or 0)
+
+
+def _write_checkpoint(path, index):
+    # Replace the file in one go, so it can't be left half written
+    with open(path + '.tmp', 'w') as checkpoint:
+        checkpoint.write('%d\n' % index)
+    os.replace(path + '.tmp', path)
 
 
 def batchaddmedia(args):
@@ -80,114 +301,131 @@ def batchaddmedia(args):
         return
 
     abs_metadata_filename = os.path.abspath(metadata_path)
-    abs_metadata_dir = os.path.dirname(abs_metadata_filename)
-
-    all_metadata = open(abs_metadata_filename)
-    media_metadata = csv.DictReader(all_metadata)
-    for index, file_metadata in enumerate(media_metadata):
-        files_attempted += 1
-        # In case the metadata was not uploaded initialize an empty dictionary.
-        json_ld_metadata = compact_and_validate({})
-
-        # Get all metadata entries starting with 'media' as variables and then
-        # delete them because those are for internal use only.
-        original_location = file_metadata['location']
-
-        ### Pull the important media information for mediagoblin from the
-        ### metadata, if it is provided.
-        slug = file_metadata.get('slug')
-        title = file_metadata.get('title') or file_metadata.get('dc:title')
-        description = (file_metadata.get('description') or
-            file_metadata.get('dc:description'))
-        collection_slug = file_metadata.get('collection-slug')
-
-        license = file_metadata.get('license')
-        try:
-            json_ld_metadata = compact_and_validate(file_metadata)
-        except ValidationError as exc:
-            media_id = file_metadata.get('id') or index
-            error = _("""Error with media '{media_id}' value '{error_path}': {error_msg}
-Metadata was not uploaded.""".format(
-                media_id=media_id,
-                error_path=exc.path[0],
-                error_msg=exc.message))
-            print(error)
-            continue
-
-        if slug and MediaEntry.query.filter_by(actor=user.id, slug=slug).count():
-            # Avoid re-importing media from a previous batch run. Note that this
-            # check isn't quite robust enough, since it requires that a slug is
-            # specified. Probably needs to be based on "location" since this is
-            # the only required field.
-            error = '{}: {}'.format(
-                slug, _('An entry with that slug already exists for this user.'))
-            print(error)
-            continue
-
-        url = urlparse(original_location)
-        filename = url.path.split()[-1]
-
-        if url.scheme.startswith('http'):
-            res = requests.get(url.geturl(), stream=True)
-            if res.headers.get('content-encoding'):
-                # The requests library's "raw" method does not deal with content
-                # encoding. Alternative could be to use iter_content(), and
-                # write chunks to the temporary file.
-                raise NotImplementedError('URL-based media with content-encoding (eg. gzip) are not currently supported.')
-
-            # To avoid loading the media into memory all at once, we write it to
-            # a file before importing. This currently requires free space up to
-            # twice the size of the media file. Memory use can be tested by
-            # running something like `ulimit -Sv 200000` before running
-            # `batchaddmedia` to upload a file larger than 200MB.
-            media_file = tempfile.TemporaryFile()
-            shutil.copyfileobj(res.raw, media_file)
-
-        elif url.scheme == '':
-            path = url.path
-            if os.path.isabs(path):
-                file_abs_path = os.path.abspath(path)
-            else:
-                file_path = os.path.join(abs_metadata_dir, path)
-                file_abs_path = os.path.abspath(file_path)
+
+    checkpoint = None if args.dry_run else args.checkpoint
+    start = 0
+    if checkpoint:
+        start = _read_checkpoint(checkpoint)
+        if start:
+            print(_("Continuing from row {row}, as recorded in {path}".format(
+                row=start + 1, path=checkpoint)))
+
+    upload_limit, max_file_size = get_upload_file_limits(user)
+    batch_size = max(args.batch_size, 1)
+    report_progress = batch_size > 1 or args.parallel > 1
+    # Of the rows which are not committed yet
+    batch = []
+    rows_done = start
+    # Megabytes submitted, or which would be with --dry-run
+    submitted_size = 0
+    started = time.time()
+
+    def report():
+        elapsed = max(time.time() - started, 0.001)
+        print(_(
+"{rows} rows done, {files} files at {rate:.1f} files/s, {speed:.1f} MB/s".format(
+            rows=rows_done, files=files_uploaded,
+            rate=files_uploaded / elapsed,
+            speed=submitted_size / elapsed)))
+
+    def commit_batch():
+        Session.commit()
+        # Their files are theirs to keep from now on, whatever happens
+        committed = batch[:]
+        del batch[:]
+        if checkpoint:
+            _write_checkpoint(checkpoint, rows_done)
+        # Only now may processing see the entries
+        for entry in committed:
             try:
-                media_file = open(file_abs_path, 'rb')
-            except OSError:
-                print(_("""\
-FAIL: Local file {filename} could not be accessed.
-{filename} will not be uploaded.""".format(filename=filename)))
-                continue
-        try:
-            entry = submit_media(
-                mg_app=app,
-                user=user,
-                submitted_file=media_file,
-                filename=filename,
-                title=title,
-                description=description,
-                collection_slug=collection_slug,
-                license=license,
-                metadata=json_ld_metadata,
-                tags_string="")
-            if slug:
-                # Slug is automatically set by submit_media, so overwrite it
-                # with the desired slug.
-                entry.slug = slug
-                entry.save()
-            print(_("""Successfully submitted {filename}!
+                start_processing(app, entry)
+            except Exception as exc:
+                # The entry is marked as failed, the others may do better
+                Session.rollback()
+                print(_('FAIL: Media "{id}" could not be processed: '
+                        '{error}'.format(id=entry.id, error=exc)))
+
+    # The limits are taken here, as the rows are handed to the workers,
+    # since the database may only be used from this thread
+    jobs = ((row, get_upload_byte_limits(user))
+            for row in _read_rows(user, abs_metadata_filename, start))
+    def discard_row(row):
+        if row.get('entry') is not None:
+            discard_queued_file(app, row['entry'])
+
+    results = _imap(functools.partial(_queue_row, app, args.dry_run),
+                    jobs, args.parallel, discard_row)
+
+    try:
+        for row in results:
+            files_attempted += 1
+            rows_done = row['index'] + 1
+            filename = row['filename']
+
+            if row.get('error'):
+                print(row['error'])
+            elif row.get('failure'):
+                print(_failure_message(row, row['failure']))
+            elif args.dry_run:
+                if upload_limit and (user.uploaded + submitted_size +
+                                     row['file_size']) >= upload_limit:
+                    print(_failure_message(row, UserUploadLimit()))
+                    continue
+                submitted_size += row['file_size']
+                files_uploaded += 1
+                print(_("{filename} can be submitted.".format(
+                    filename=filename)))
+            elif upload_limit and user.uploaded >= upload_limit:
+                discard_queued_file(app, row['entry'])
+                print(_failure_message(row, UserPastUploadLimit()))
+            else:
+                entry = row['entry']
+                try:
+                    submit_queued_media(
+                        app, user, entry,
+                        title=row['title'],
+                        description=row['description'],
+                        collection_slug=row['collection_slug'],
+                        license=row['license'],
+                        metadata=row['metadata'],
+                        tags_string="",
+                        commit=False)
+                except UploadLimitError as exc:
+                    print(_failure_message(row, exc))
+                    continue
+                if row['slug']:
+                    # Slug is automatically set by submit_queued_media, so
+                    # overwrite it with the desired slug.
+                    entry.slug = row['slug']
+                    entry.save(commit=False)
+                batch.append(entry)
+                submitted_size += entry.file_size
+                print(_("""Successfully submitted {filename}!
 Be sure to look at the Media Processing Panel on your website to be sure it
 uploaded successfully.""".format(filename=filename)))
-            files_uploaded += 1
-        except FileUploadLimit:
-            print(_(
-"FAIL: This file is larger than the upload limits for this site."))
-        except UserUploadLimit:
-            print(_(
-"FAIL: This file will put this user past their upload limits."))
-        except UserPastUploadLimit:
-            print(_("FAIL: This user is already past their upload limits."))
-        finally:
-            media_file.close()
+                files_uploaded += 1
+
+                if len(batch) >= batch_size:
+                    commit_batch()
+                    if report_progress:
+                        report()
+
+        if batch:
+            commit_batch()
+    except BaseException:
+        # Discards the files queued for the rows not handled yet
+        results.close()
+        # Nothing of the batch is in the database, so its files are of no use
+        Session.rollback()
+        for entry in batch:
+            discard_queued_file(app, entry)
+        raise
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    if report_progress:
+        report()
+
     print(_(
 "{files_uploaded} out of {files_attempted} files successfully submitted".format(
         files_uploaded=files_uploaded,
@@ -16,6 +16,7 @@
 
 import sys
 
+from mediagoblin.db.util import delete_media_entries
 from mediagoblin.gmg_commands import util as commands_util
 
 
@@ -31,13 +32,12 @@ def deletemedia(args):
     if not media_ids:
         print('Can\'t find any valid media ID(s).')
         sys.exit(1)
-    found_medias = set()
     filter_ids = app.db.MediaEntry.id.in_(media_ids)
-    medias = app.db.MediaEntry.query.filter(filter_ids).all()
-    for media in medias:
-        found_medias.add(media.id)
-        media.delete()
-        print('Media ID %d has been deleted.' % media.id)
+    found_medias = {media_id for (media_id,) in app.db.MediaEntry.query.filter(
+        filter_ids).with_entities(app.db.MediaEntry.id)}
+    delete_media_entries(sorted(found_medias))
+    for media in sorted(found_medias):
+        print('Media ID %d has been deleted.' % media)
     for media in media_ids - found_medias:
         print('Can\'t find a media with ID %d.' % media)
     print('Done.')
@@ -0,0 +1,130 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import sys
+
+from sqlalchemy import and_
+
+from mediagoblin.db.base import Session
+from mediagoblin.db.models import (
+    MediaEntry, Comment, GenericModelReference, Notification)
+from mediagoblin.db.util import media_entries_for_tag_slug
+from mediagoblin.gmg_commands import util as commands_util
+
+# What is explained is the plan, so any value does for parameters
+SAMPLE_ID = 1
+
+
+def hot_queries(db):
+    """
+    The (name, query) of the queries behind the busiest pages
+    """
+    processed = MediaEntry.query.filter_by(state='processed')
+    return [
+        ('front page',
+         processed.order_by(MediaEntry.created.desc()).limit(20)),
+        ('user gallery',
+         processed.filter_by(actor=SAMPLE_ID)
+         .order_by(MediaEntry.created.desc()).limit(20)),
+        ('previous and next media',
+         MediaEntry.neighbours_statement(SAMPLE_ID, SAMPLE_ID)),
+        ('tag listing',
+         media_entries_for_tag_slug(db, 'sample')
+         .order_by(MediaEntry.created.desc()).limit(20)),
+        ('media comments',
+         Comment.query.join(Comment.target_helper).filter(and_(
+             GenericModelReference.obj_pk == SAMPLE_ID,
+             GenericModelReference.model_type == MediaEntry.__tablename__))
+         .order_by(Comment.added.desc(), Comment.id.desc()).limit(50)),
+        ('unseen notifications',
+         Notification.query.filter_by(user_id=SAMPLE_ID, seen=False)
+         .limit(20)),
+    ]
+
+
+def explain(connection, query):
+    """
+    Return the lines of the database's plan for QUERY, an ORM query or
+    a select, and the tables it reads row by row or sorts without an
+    index
+    """
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=connection.dialect)
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+    else:
+        params = compiled.params
+
+    if connection.dialect.name == 'sqlite':
+        rows = connection.execute(
+            'EXPLAIN QUERY PLAN ' + str(compiled), params)
+        plan = [row[-1] for row in rows]
+        # Reading through the few rows of a subquery is no table scan
+        subqueries = {match.group(1) for match in
+                      (re.match(r'(?:CO-ROUTINE|MATERIALIZE) (\w+)', line)
+                       for line in plan)
+                      if match}
+        scans = [match.group(1) for match in
+                 (re.match(r'SCAN (?:TABLE )?(\w+)$', line) for line in plan)
+                 if match and match.group(1) not in subqueries]
+        sorts = [line for line in plan if 'TEMP B-TREE' in line]
+    else:
+        rows = connection.execute('EXPLAIN ' + str(compiled), params)
+        plan = [row[0] for row in rows]
+        scans = [match.group(1) for match in
+                 (re.search(r'Seq Scan on (\w+)', line) for line in plan)
+                 if match]
+        sorts = [line for line in plan if line.strip().startswith('Sort')]
+
+    missing = ['full scan of {}'.format(table) for table in scans]
+    if sorts:
+        missing.append('sorting without an index')
+    return plan, missing
+
+
+def parser_setup(subparser):
+    subparser.add_argument(
+        '--verbose', '-v', action='store_true',
+        help='Print the whole plan of every query')
+
+
+def explain_queries(args):
+    """
+    Explain the hot queries on the configured database and report those
+    an index is missing for
+    """
+    app = commands_util.setup_app(args)
+
+    slow = 0
+    connection = Session.connection()
+    for name, query in hot_queries(app.db):
+        plan, missing = explain(connection, query)
+        if missing:
+            slow += 1
+            print('{}: missing index ({})'.format(name, ', '.join(missing)))
+        else:
+            print(f'{name}: ok')
+        if args.verbose or missing:
+            for line in plan:
+                print('    ' + line)
+
+    # Small tables get scanned whatever the indexes, so mind the size
+    if slow:
+        print('{} of the queries may need an index; plans of tables with '
+              'few rows are not telling.'.format(slow))
+        sys.exit(1)
+    print('Done.')
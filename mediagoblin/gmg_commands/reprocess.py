@@ -16,16 +16,52 @@
 
 
 import argparse
+import collections
+import json
 import os
+import time
+
+import celery
 
 from mediagoblin import mg_globals
+from mediagoblin.db.base import Session
 from mediagoblin.db.models import MediaEntry
 from mediagoblin.gmg_commands import util as commands_util
 from mediagoblin.submit.lib import run_process_media
 from mediagoblin.processing import (
-    ProcessorDoesNotExist, ProcessorNotEligible,
+    ProcessorDoesNotExist, ProcessorNotEligible, ProcessingKeyError,
     get_entry_and_processing_manager, get_processing_manager_for_type,
     ProcessingManagerDoesNotExist)
+from mediagoblin.processing.task import ProcessMedia
+
+
+def add_scheduler_arguments(parser):
+    """Options of the commands reprocessing many media through a scheduler"""
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=100,
+        help="How many media entries to read from the database at a time."
+             " Defaults to 100")
+
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        default=10,
+        help="How many media may be waiting for or in processing at once,"
+             " 0 for no limit. Defaults to 10")
+
+    parser.add_argument(
+        '--rate',
+        type=float,
+        help="The most media to pass off to processing per second")
+
+    parser.add_argument(
+        '--journal',
+        metavar='PATH',
+        help="Record what became of each media in this file and, if it"
+             " exists, carry on from where it stops: media which failed"
+             " or were not seen to be processed are done again")
 
 
 def reprocess_parser_setup(subparser):
@@ -92,13 +128,17 @@ def reprocess_parser_setup(subparser):
         type=int,
         metavar=('max_width', 'max_height'))
 
+    add_scheduler_arguments(thumbs)
+
     #################
     # initial command
     #################
-    subparsers.add_parser(
+    initial_parser = subparsers.add_parser(
         'initial',
         help='Reprocess all failed media')
 
+    add_scheduler_arguments(initial_parser)
+
     ##################
     # bulk_run command
     ##################
@@ -121,6 +161,8 @@ def reprocess_parser_setup(subparser):
         'reprocess_command',
         help='The reprocess command you intend to run')
 
+    add_scheduler_arguments(bulk_run_parser)
+
     bulk_run_parser.add_argument(
         'reprocess_args',
         nargs=argparse.REMAINDER,
@@ -206,6 +248,215 @@ def run(args, media_id=None):
         print(f'No such processing manager for {entry.media_type}')
 
 
+class ReprocessScheduler:
+    """
+    Pass many media entries off to a reprocessing action
+
+    The entries of a query are read a chunk at a time in order of id,
+    checked against the processor of their media type and, if eligible,
+    sent to celery.  No more than max_in_flight of them are left
+    unfinished at once, and no more than rate are sent per second.
+
+    What becomes of each entry is printed and, with a journal, recorded
+    there as a line of json, so that a run which stopped can be picked
+    up again.  The entries it did not see processed or skip are done
+    again.
+    """
+    poll_interval = 1
+
+    def __init__(self, action, get_request=None, chunk_size=100,
+                 max_in_flight=10, rate=None, journal=None):
+        """
+        GET_REQUEST gives the reprocess_info for a processor class, for
+        ACTION to be run with
+        """
+        self.action = action
+        self.get_request = get_request
+        self.chunk_size = max(chunk_size, 1)
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.journal = journal
+        self.outcomes = collections.Counter()
+        # media type: (processor class, reprocess_info), or why there is none
+        self._processors = {}
+        # media id: celery result
+        self._in_flight = {}
+
+        conf = celery.app.default_app.conf
+        self._eager = conf['CELERY_ALWAYS_EAGER']
+        # Without results, there is no telling when processing is done
+        if conf.get('CELERY_IGNORE_RESULT') and not self._eager:
+            self.max_in_flight = 0
+
+    @classmethod
+    def from_args(cls, action, args, get_request=None):
+        return cls(action, get_request,
+                   chunk_size=args.chunk_size,
+                   max_in_flight=args.max_in_flight,
+                   rate=args.rate,
+                   journal=args.journal)
+
+    def run(self, query):
+        """Reprocess the media entries of QUERY"""
+        last_id, done = self._resume_point()
+        if last_id or done:
+            print('Carrying on from where {} stops'.format(self.journal))
+
+        self._started = time.time()
+        self._dispatched = 0
+        while True:
+            chunk = query.filter(MediaEntry.id > last_id).order_by(
+                MediaEntry.id).limit(self.chunk_size).all()
+            if not chunk:
+                break
+            for entry in chunk:
+                if entry.id not in done:
+                    self._dispatch(entry)
+                last_id = entry.id
+            self._reap()
+            print(self._summary())
+            # Don't keep every entry seen around in the session
+            Session.expunge_all()
+
+        if self._in_flight:
+            while self._in_flight:
+                time.sleep(self.poll_interval)
+                self._reap()
+            print(self._summary())
+        elif not self.outcomes:
+            print('No media to reprocess')
+
+    def _summary(self):
+        return ', '.join(
+            '{} {}'.format(count, outcome)
+            for outcome, count in sorted(self.outcomes.items()))
+
+    def _resume_point(self):
+        """
+        The id to carry on after, and the ids past it which are done,
+        according to the journal
+
+        Media whose last outcome is "failed", or "dispatched" with no
+        word of how processing went, are not done.
+        """
+        if not (self.journal and os.path.exists(self.journal)):
+            return 0, set()
+        outcomes = {}
+        with open(self.journal) as journal:
+            for line in journal:
+                if line.strip():
+                    record = json.loads(line)
+                    outcomes[record['id']] = record['outcome']
+
+        undone = [media_id for media_id, outcome in outcomes.items()
+                  if outcome not in ('processed', 'skipped')]
+        if undone:
+            last_id = min(undone) - 1
+        else:
+            last_id = max(outcomes, default=0)
+        return last_id, {media_id for media_id in outcomes
+                         if media_id > last_id and
+                         outcomes[media_id] in ('processed', 'skipped')}
+
+    def _record(self, media_id, outcome, message=None):
+        self.outcomes[outcome] += 1
+        if message:
+            print(message)
+        if self.journal:
+            record = {'id': media_id, 'outcome': outcome}
+            if message:
+                record['message'] = message
+            with open(self.journal, 'a') as journal:
+                journal.write(json.dumps(record) + '\n')
+
+    def _processor_for(self, media_type):
+        if media_type not in self._processors:
+            try:
+                manager = get_processing_manager_for_type(media_type)
+                processor_class = manager.get_processor(self.action)
+            except ProcessingKeyError as exc:
+                self._processors[media_type] = exc
+            else:
+                request = None
+                if self.get_request is not None:
+                    request = self.get_request(processor_class)
+                self._processors[media_type] = (processor_class, request)
+        return self._processors[media_type]
+
+    def _dispatch(self, entry):
+        processor = self._processor_for(entry.media_type)
+        if isinstance(processor, ProcessingManagerDoesNotExist):
+            return self._record(
+                entry.id, 'skipped',
+                f'No such processing manager for {entry.media_type}')
+        elif isinstance(processor, ProcessingKeyError):
+            return self._record(
+                entry.id, 'skipped',
+                'No such processor "{}" for media with id "{}"'.format(
+                    self.action, entry.id))
+
+        processor_class, request = processor
+        if not processor_class.media_is_eligible(entry=entry):
+            return self._record(
+                entry.id, 'skipped',
+                'Processor "{}" exists but media "{}" is not eligible'.format(
+                    self.action, entry.id))
+
+        self._wait_for_turn()
+        if not self._eager and entry.queued_task_id:
+            # Processing reuses the task id of the upload, which may have a
+            # result left from before
+            try:
+                ProcessMedia().AsyncResult(entry.queued_task_id).forget()
+            except NotImplementedError:
+                pass
+
+        try:
+            result = run_process_media(
+                entry,
+                reprocess_action=self.action,
+                reprocess_info=request)
+        except Exception as exc:
+            return self._record(
+                entry.id, 'failed',
+                f'Media "{entry.id}" failed to process: {exc}')
+        self._dispatched += 1
+        self._record(entry.id, 'dispatched')
+        if result is not None and self.max_in_flight:
+            self._in_flight[entry.id] = result
+
+    def _wait_for_turn(self):
+        """Wait until the limits allow another media to be dispatched"""
+        while self.max_in_flight and \
+                len(self._in_flight) >= self.max_in_flight:
+            if not self._reap():
+                time.sleep(self.poll_interval)
+
+        if self.rate:
+            delay = self._started + self._dispatched / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _reap(self):
+        """Record the processing that is finished, and return how much"""
+        done = [media_id for media_id, result in self._in_flight.items()
+                if result.ready()]
+        if not done:
+            return 0
+
+        states = dict(MediaEntry.query.filter(
+            MediaEntry.id.in_(done)).with_entities(
+                MediaEntry.id, MediaEntry.state))
+        for media_id in done:
+            result = self._in_flight.pop(media_id)
+            if result.failed() or states.get(media_id) == 'failed':
+                self._record(media_id, 'failed',
+                             f'Media "{media_id}" failed to process')
+            else:
+                self._record(media_id, 'processed')
+        return len(done)
+
+
 def bulk_run(args):
     """
     Bulk reprocessing of a given media_type
@@ -213,8 +464,13 @@ def bulk_run(args):
     query = MediaEntry.query.filter_by(media_type=args.type,
                                        state=args.state)
 
-    for entry in query:
-        run(args, entry.id)
+    def get_request(processor_class):
+        reprocess_parser = processor_class.generate_parser()
+        reprocess_args = reprocess_parser.parse_args(args.reprocess_args)
+        return processor_class.args_to_request(reprocess_args)
+
+    ReprocessScheduler.from_args(
+        args.reprocess_command, args, get_request).run(query)
 
 
 def thumbs(args):
@@ -223,44 +479,22 @@ def thumbs(args):
     """
     query = MediaEntry.query.filter_by(state='processed')
 
-    for entry in query:
-        try:
-            media_entry, manager = get_entry_and_processing_manager(entry.id)
+    def get_request(processor_class):
+        reprocess_parser = processor_class.generate_parser()
 
-            # TODO: (maybe?) This could probably be handled entirely by the
-            # processor class...
-            try:
-                processor_class = manager.get_processor(
-                    'resize', media_entry)
-            except ProcessorDoesNotExist:
-                print('No such processor "{}" for media with id "{}"'.format(
-                    'resize', media_entry.id))
-                return
-            except ProcessorNotEligible:
-                print('Processor "{}" exists but media "{}" is not eligible'.format(
-                    'resize', media_entry.id))
-                return
-
-            reprocess_parser = processor_class.generate_parser()
-
-            # prepare filetype and size to be passed into reprocess_parser
-            if args.size:
-                extra_args = 'thumb --{} {} {}'.format(
-                    processor_class.thumb_size,
-                    args.size[0],
-                    args.size[1])
-            else:
-                extra_args = 'thumb'
+        # prepare filetype and size to be passed into reprocess_parser
+        if args.size:
+            extra_args = 'thumb --{} {} {}'.format(
+                processor_class.thumb_size,
+                args.size[0],
+                args.size[1])
+        else:
+            extra_args = 'thumb'
 
-            reprocess_args = reprocess_parser.parse_args(extra_args.split())
-            reprocess_request = processor_class.args_to_request(reprocess_args)
-            run_process_media(
-                media_entry,
-                reprocess_action='resize',
-                reprocess_info=reprocess_request)
+        reprocess_args = reprocess_parser.parse_args(extra_args.split())
+        return processor_class.args_to_request(reprocess_args)
 
-        except ProcessingManagerDoesNotExist:
-            print(f'No such processing manager for {entry.media_type}')
+    ReprocessScheduler.from_args('resize', args, get_request).run(query)
 
 
 def initial(args):
@@ -269,14 +503,7 @@ def initial(args):
     """
     query = MediaEntry.query.filter_by(state='failed')
 
-    for entry in query:
-        try:
-            media_entry, manager = get_entry_and_processing_manager(entry.id)
-            run_process_media(
-                media_entry,
-                reprocess_action='initial')
-        except ProcessingManagerDoesNotExist:
-            print(f'No such processing manager for {entry.media_type}')
+    ReprocessScheduler.from_args('initial', args).run(query)
 
 
 def reprocess(args):
@@ -32,6 +32,7 @@ MANDATORY_CELERY_IMPORTS = [
     'mediagoblin.notifications.task',
     'mediagoblin.submit.task',
     'mediagoblin.media_types.video.processing',
+    'mediagoblin.tools.files',
 ]
 
 DEFAULT_SETTINGS_MODULE = 'mediagoblin.init.celery.dummy_settings_module'
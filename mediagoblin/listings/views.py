@@ -18,12 +18,12 @@ from mediagoblin import mg_globals
 from mediagoblin.db.models import MediaEntry
 from mediagoblin.db.util import media_entries_for_tag_slug
 from mediagoblin.decorators import uses_pagination
-from mediagoblin.plugins.api.tools import get_media_file_paths
-from mediagoblin.tools.feeds import AtomFeedWithLinks
-from mediagoblin.tools.pagination import Pagination
-from mediagoblin.tools.response import render_to_response
-from mediagoblin.tools.translate import pass_to_ugettext as _
+from mediagoblin.meddleware.page_cache import page_cacheable
+from mediagoblin.tools.feeds import AtomFeedWithLinks, add_media_entries
+from mediagoblin.tools.pagination import get_media_pagination
+from mediagoblin.tools.response import render_to_response, CacheValidators
 
+from sqlalchemy import func
 from werkzeug.wrappers import Response
 
 
@@ -43,6 +43,7 @@ def _get_tag_name_from_entries(media_entries, tag_slug):
     return tag_name
 
 
+@page_cacheable
 @uses_pagination
 def tag_listing(request, page):
     """'Gallery'/listing for this tag slug"""
@@ -51,7 +52,8 @@ def tag_listing(request, page):
     cursor = media_entries_for_tag_slug(request.db, tag_slug)
     cursor = cursor.order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = get_media_pagination(
+        request, page, cursor, (MediaEntry.created, MediaEntry.id))
     media_entries = pagination()
 
     tag_name = _get_tag_name_from_entries(media_entries, tag_slug)
@@ -83,6 +85,13 @@ def atom_feed(request):
         feed_title += " for all recent items"
         link = request.urlgen('index', qualified=True)
         cursor = MediaEntry.query.filter_by(state='processed')
+
+    validators = CacheValidators(*cursor.with_entities(
+        func.max(MediaEntry.updated), func.count(MediaEntry.id)).one())
+    response = validators.not_modified(request)
+    if response is not None:
+        return response
+
     cursor = cursor.order_by(MediaEntry.created.desc())
     cursor = cursor.limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
 
@@ -104,34 +113,10 @@ def atom_feed(request):
         links=atomlinks,
     )
 
-    for entry in cursor:
-        # Include a thumbnail image in content.
-        file_urls = get_media_file_paths(entry.media_files, request.urlgen)
-        if 'thumb' in file_urls:
-            content = '<img src="{thumb}" alt='' /> {desc}'.format(
-                thumb=file_urls['thumb'], desc=entry.description_html)
-        else:
-            content = entry.description_html
-
-        feed.add_item(
-            # AtomFeed requires a non-blank title. This situation can occur if
-            # you edit a media item and blank out the existing title.
-            title=entry.get('title') or _('Untitled'),
-            link=entry.url_for_self(
-                request.urlgen,
-                qualified=True),
-            description=content,
-            unique_id=entry.url_for_self(request.urlgen, qualified=True),
-            author_name=entry.get_actor.username,
-            author_link=request.urlgen(
-                    'mediagoblin.user_pages.user_home',
-                    qualified=True,
-                    user=entry.get_actor.username),
-            updateddate=entry.get('created'),
-        )
+    add_media_entries(feed, request, cursor)
 
     response = Response(
         feed.writeString(encoding='utf-8'),
         mimetype='application/atom+xml'
     )
-    return response
+    return validators.apply(response)
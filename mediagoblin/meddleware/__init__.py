@@ -16,6 +16,7 @@
 
 ENABLED_MEDDLEWARE = [
     'mediagoblin.meddleware.csrf:CsrfMeddleware',
+    'mediagoblin.meddleware.page_cache:PageCacheMeddleware',
     ]
 
 
@@ -0,0 +1,178 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import uuid
+import weakref
+from itertools import chain
+
+import celery
+from sqlalchemy import event
+from sqlalchemy.orm import Session as ORMSession
+from werkzeug.wrappers import Response
+
+from mediagoblin.db.models import (
+    User, MediaEntry, MediaFile, MediaTag, Tag, Comment, TextComment,
+    Collection, CollectionItem, Graveyard)
+from mediagoblin.init import ImproperlyConfigured
+from mediagoblin.meddleware import BaseMeddleware
+from mediagoblin.tools.cache import get_cache
+
+_log = logging.getLogger(__name__)
+
+# Cached pages are only served while this key holds the value it had
+# when they were rendered
+GENERATION_KEY = 'page_cache:generation'
+
+# The enabled PageCacheMeddleware instances, whose pages are expired by
+# the commits of this process
+_page_caches = weakref.WeakSet()
+
+
+def page_cacheable(func):
+    """Decorate a Controller to let PageCacheMeddleware cache its pages."""
+
+    func.page_cacheable = True
+    return func
+
+
+class PageCacheMeddleware(BaseMeddleware):
+    """Page Cache Meddleware
+
+    Serves the pages of page_cacheable controllers to anonymous visitors
+    from a cache, if enabled in the [page_cache] config section.  Pages
+    are cached by path, locale and theme; any committed change to media,
+    comments, collections or users makes all of them stale.
+    """
+
+    SAFE_HTTP_METHODS = ("GET", "HEAD")
+
+    # Changes to these show on cacheable pages.  Bulk deletions skip the
+    # session, but leave Graveyard tombstones in it.
+    WATCHED_MODELS = (User, MediaEntry, MediaFile, MediaTag, Tag, Comment,
+                      TextComment, Collection, CollectionItem, Graveyard)
+
+    def __init__(self, mg_app):
+        super().__init__(mg_app)
+        config = mg_app.global_config['page_cache']
+        self.enabled = config['enabled']
+        if not self.enabled:
+            return
+
+        # Media is processed by the celery workers, whose commits could
+        # not expire the pages kept in the memory of this process
+        if config['backend'] == 'memory' and \
+                not celery.app.default_app.conf['CELERY_ALWAYS_EAGER']:
+            raise ImproperlyConfigured(
+                'The "memory" page_cache backend only works in a single '
+                'process, with celery always eager.  Use the "filesystem" '
+                'backend or a shared one.')
+
+        self.ttl = config['ttl']
+        self.cache = get_cache(config['backend'],
+                               max_entries=config['max_entries'],
+                               cache_dir=config['cache_dir'])
+        _page_caches.add(self)
+
+    def process_request(self, request, controller):
+        """Answer from the cache if we can, or mark the page for caching.
+        """
+        if not (self.enabled and getattr(controller, 'page_cacheable', False)
+                and request.method in self.SAFE_HTTP_METHODS):
+            return
+
+        # Anything in the session (like messages) could show on the page
+        if request.user is not None or request.session:
+            return
+
+        key = self._key(request)
+        generation = self._generation()
+        page = self.cache.get(key)
+        if page is not None and page['generation'] == generation:
+            response = Response(page['body'], status=page['status'],
+                                headers=page['headers'])
+            response.vary = ['Cookie']
+            return response
+
+        request.environ['gmg.page_cache'] = (key, generation)
+
+    def process_response(self, request, response):
+        """Cache the page if nothing about it is particular to the visitor.
+        """
+        if 'gmg.page_cache' not in request.environ:
+            return
+
+        if response.status_code != 200 or request.session:
+            return
+
+        body = response.get_data()
+        # Pages with forms carry the visitor's CSRF token
+        csrf_token = request.environ.get('CSRF_TOKEN')
+        if csrf_token and csrf_token.encode('ascii') in body:
+            return
+
+        key, generation = request.environ['gmg.page_cache']
+        headers = [(name, value) for name, value in response.headers
+                   if name.lower() != 'set-cookie']
+        self.cache.set(key, {
+            'generation': generation,
+            'status': response.status,
+            'headers': headers,
+            'body': body}, self.ttl)
+
+    def _key(self, request):
+        page = '\n'.join([
+            self.app.app_config.get('theme') or '',
+            request.locale,
+            request.full_path,
+            request.query_string.decode('ascii', 'replace')])
+        return 'page_cache:' + hashlib.sha1(page.encode('utf-8')).hexdigest()
+
+    def _generation(self):
+        generation = self.cache.get(GENERATION_KEY)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.cache.set(GENERATION_KEY, generation)
+        return generation
+
+    def expire_pages(self):
+        _log.debug('Expiring cached pages')
+        self.cache.set(GENERATION_KEY, uuid.uuid4().hex)
+
+
+def _note_changes(session, flush_context):
+    if not _page_caches:
+        return
+    changed = chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(obj, PageCacheMeddleware.WATCHED_MODELS)
+           for obj in changed):
+        session.info['page_cache_stale'] = True
+
+
+def _expire_pages(session):
+    if session.info.pop('page_cache_stale', False):
+        for page_cache in list(_page_caches):
+            page_cache.expire_pages()
+
+
+def _forget_changes(session):
+    session.info.pop('page_cache_stale', None)
+
+
+event.listen(ORMSession, 'after_flush', _note_changes)
+event.listen(ORMSession, 'after_commit', _expire_pages)
+event.listen(ORMSession, 'after_rollback', _forget_changes)
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import os
 import logging
 import shutil
@@ -136,28 +137,65 @@ def type_match_handler(media_file, filename):
     raise TypeNotFound(_('Sorry, I don\'t support that file type :('))
 
 
+class LazyNamedFile:
+    """
+    Wraps a file-like object for sniffing, copying it to a .name-enabled
+    temporary file only once a sniffer asks for its name on disk.
+
+    Files which are already on disk are used as they are, and sniffers
+    only looking at the filename never cause a copy at all.
+    """
+
+    def __init__(self, media_file):
+        self.media_file = media_file
+        self.tmp_media_file = None
+
+    @property
+    def name(self):
+        name = getattr(self.media_file, 'name', None)
+        if isinstance(self.media_file, io.IOBase) and \
+           isinstance(name, str) and os.path.isfile(name):
+            return name
+
+        if self.tmp_media_file is None:
+            _log.debug('Copying the upload to a temporary file for sniffing')
+            self.tmp_media_file = tempfile.NamedTemporaryFile()
+            shutil.copyfileobj(self.media_file, self.tmp_media_file)
+            self.media_file.seek(0)
+            self.tmp_media_file.seek(0)
+        return self.tmp_media_file.name
+
+    def __getattr__(self, attr):
+        return getattr(self.media_file, attr)
+
+    def close(self):
+        if self.tmp_media_file is not None:
+            self.tmp_media_file.close()
+            self.tmp_media_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def sniff_media(media_file, filename):
     '''
     Iterate through the enabled media types and find those suited
     for a certain file.
     '''
-    # copy the contents to a .name-enabled temporary file for further checks
-    # TODO: there are cases when copying is not required
-    tmp_media_file = tempfile.NamedTemporaryFile()
-    shutil.copyfileobj(media_file, tmp_media_file)
-    media_file.seek(0)
-    tmp_media_file.seek(0)
-    try:
-        return type_match_handler(tmp_media_file, filename)
-    except TypeNotFound as e:
-        _log.info('No plugins using two-step checking found')
-
-    # keep trying, using old `get_media_type_and_manager`
-    try:
-        return get_media_type_and_manager(filename)
-    except TypeNotFound as e:
-        # again, no luck. Do it expensive way
-        _log.info('No media handler found by file extension')
-    _log.info('Doing it the expensive way...')
-    return sniff_media_contents(tmp_media_file, filename)
-
+    with LazyNamedFile(media_file) as sniff_file:
+        try:
+            return type_match_handler(sniff_file, filename)
+        except TypeNotFound as e:
+            _log.info('No plugins using two-step checking found')
+
+        # keep trying, using old `get_media_type_and_manager`
+        try:
+            return get_media_type_and_manager(filename)
+        except TypeNotFound as e:
+            # again, no luck. Do it expensive way
+            _log.info('No media handler found by file extension')
+        _log.info('Doing it the expensive way...')
+        return sniff_media_contents(sniff_file, filename)
@@ -43,12 +43,43 @@ SPECTROGRAM_WIDTH_PERSECOND = [(240, (  0,     20)),
                                                      # duration will still get assigned to the last bucket
 SPECTROGRAM_HEIGHT = 500
 
-class AudioBlocksFFT:
+class SoundFileSource:
+    """
+    Blocks of PCM data of an audio file read with soundfile
+    """
 
-    def __init__(self, fileName, blockSize, overlap, minFreq, maxFreq, numBins = None, windowFunction = numpy.hanning):
+    def __init__(self, fileName):
         self.audioData = soundfile.SoundFile(fileName, 'r')
         self.numChannels = self.audioData.channels
         self.sampleRate = self.audioData.samplerate
+        try:
+            # PySoundFile V0.10.0 adds SoundFile.frames property and deprecates __len__()
+            self.totalSamples = self.audioData.frames
+        except AttributeError:
+            self.totalSamples = len(self.audioData)
+
+    def blocks(self, blockSize, overlap):
+        """
+        Yield (samples, position) pairs, samples being a frames x channels
+        array and position the number of frames read so far
+        """
+        self.audioData.seek(0)
+        for fileBlock in self.audioData.blocks(blocksize = blockSize, overlap = overlap, always_2d = True):
+            yield (fileBlock, self.audioData.tell())
+
+class AudioBlocksFFT:
+
+    def __init__(self, audioSource, blockSize, overlap, minFreq, maxFreq, numBins = None, windowFunction = numpy.hanning):
+        """
+        audioSource is a file name to read with soundfile, or anything
+        with the interface of SoundFileSource
+        """
+        if isinstance(audioSource, str):
+            audioSource = SoundFileSource(audioSource)
+        self.audioSource = audioSource
+        self.numChannels = audioSource.numChannels
+        self.sampleRate = audioSource.sampleRate
+        self.totalSamples = audioSource.totalSamples
         self.minFreq = minFreq
         self.maxFreq = maxFreq
         self.blockSize = blockSize
@@ -56,11 +87,6 @@ class AudioBlocksFFT:
         self.overlap = overlap
         self.windowValues = windowFunction(blockSize)
         self.peakFFTValue = 0
-        try:
-            # PySoundFile V0.10.0 adds SoundFile.frames property and deprecates __len__()
-            self.totalSamples = self.audioData.frames
-        except AttributeError:
-            self.totalSamples = len(self.audioData)
 
     def peakFFTAmplitude(self):
         """
@@ -97,25 +123,21 @@ class AudioBlocksFFT:
             return amplitudeValues
         if newSize > len(amplitudeValues):
             # Resize up
-            result = numpy.zeros(newSize)
-            for idx in range(0, newSize):
-                srcIdx = (idx * len(amplitudeValues)) // newSize
-                result[idx] = amplitudeValues[srcIdx]
-            return result
-        # Resize down keeping peaks
-        result = numpy.zeros(newSize)
-        idx = 0
-        for slice in numpy.array_split(amplitudeValues, newSize):
-            result[idx] = slice.max()
-            idx = idx + 1
-        return result
+            srcIdx = (numpy.arange(newSize) * len(amplitudeValues)) // newSize
+            return numpy.asarray(amplitudeValues, dtype=float)[srcIdx]
+        # Resize down keeping peaks, in the same slices as numpy.array_split
+        sliceSize, numBigger = divmod(len(amplitudeValues), newSize)
+        sliceSizes = numpy.full(newSize, sliceSize)
+        sliceSizes[:numBigger] += 1
+        sliceStarts = numpy.concatenate(([0], numpy.cumsum(sliceSizes)[:-1]))
+        return numpy.maximum.reduceat(
+            numpy.asarray(amplitudeValues, dtype=float), sliceStarts)
 
     def __iter__(self):
         """
         Read a block of audio data and compute FFT amplitudes
         """
-        self.audioData.seek(0)
-        for fileBlock in self.audioData.blocks(blocksize = self.blockSize, overlap = self.overlap):
+        for fileBlock, position in self.audioSource.blocks(self.blockSize, self.overlap):
             # Mix down all channels to mono
             audioBlock = fileBlock[:,0]
             for channel in range(1, self.numChannels):
@@ -129,7 +151,7 @@ class AudioBlocksFFT:
             # Resize if requested
             if not self.numBins is None:
                 fftAmplitude = self._resizeAmplitudeArray(fftAmplitude, self.numBins)
-            yield (fftAmplitude, self.audioData.tell() / self.sampleRate)
+            yield (fftAmplitude, position / self.sampleRate)
 
 class SpectrogramColorMap:
 
@@ -162,27 +184,28 @@ class SpectrogramColorMap:
         for i in range(1, len(colorPoints)):
             for p in range(0, 200):
                 self.colors.append(self._colorBetween(colorPoints[i - 1], colorPoints[i], p / 200))
+        self.palette = numpy.array(self.colors, dtype=numpy.uint8)
 
     def getColorData(self, progressCallback = None):
         """
         Map spectrogram data to pixel colors
+
+        Returns a (height, width, 3) array of RGB bytes, with the lowest
+        frequencies in the bottom row.
         """
-        pixels = [self.colors[0]] * (self.width * self.height)
-        for x in range(0, self.width):
-            for y in range(0, self.height):
-                idx = x + self.width * y
-                amplitudeVal = self.columnData[x][self.height - y - 1]
-                colorIdx = int(len(self.colors) * amplitudeVal)
-                colorIdx = colorIdx if colorIdx > 0 else 0
-                colorIdx = colorIdx if colorIdx < len(self.colors) else len(self.colors) - 1
-                pixels[idx] = self.colors[colorIdx]
-            if progressCallback:
-                progressCallback(100 * x / self.width)
+        # Columns are stored from the lowest frequency up
+        amplitudes = numpy.asarray(self.columnData, dtype=float)[:, ::-1].T
+        colorIdx = (len(self.colors) * amplitudes).astype(int)
+        colorIdx = colorIdx.clip(0, len(self.colors) - 1)
+        pixels = self.palette[colorIdx]
+        if progressCallback:
+            progressCallback(100)
         return pixels
 
-def drawSpectrogram(audioFileName, imageFileName, fftSize = 1024, fftOverlap = 0, progressCallback = None):
+def drawSpectrogram(audioSource, imageFileName, fftSize = 1024, fftOverlap = 0, progressCallback = None):
     """
-    Draw a spectrogram of the audio file
+    Draw a spectrogram of the audio file, or of another audio source as
+    accepted by AudioBlocksFFT
     """
 
     # Fraction of total work for each step
@@ -211,7 +234,7 @@ def drawSpectrogram(audioFileName, imageFileName, fftSize = 1024, fftOverlap = 0
     imageHeight = SPECTROGRAM_HEIGHT
 
     # Load audio file and compute FFT amplitudes
-    fftBlocksSource = AudioBlocksFFT(audioFileName,
+    fftBlocksSource = AudioBlocksFFT(audioSource,
                                      fftSize, overlap = fftOverlap,
                                      minFreq = SPECTROGRAM_MIN_FREQUENCY, maxFreq = SPECTROGRAM_MAX_FREQUENCY,
                                      numBins = imageHeight)
@@ -220,17 +243,18 @@ def drawSpectrogram(audioFileName, imageFileName, fftSize = 1024, fftOverlap = 0
     for fftAmplitude, positionSeconds in fftBlocksSource:
         fftAmplitudeBlocks.append(fftAmplitude)
         wrapProgressCallback(STEP_PERCENTAGE_FFT * (positionSeconds / soundLength))
+    # One row per block, one column per frequency bin
+    fftAmplitudeBlocks = numpy.array(fftAmplitudeBlocks)
 
     totalProgress = STEP_PERCENTAGE_FFT
 
     # Normalize FFT amplitude and convert to log scale
     specRange = SPECTROGRAM_DB_RANGE
-    for i in range(0, len(fftAmplitudeBlocks)):
-        normalized = numpy.divide(fftAmplitudeBlocks[i], fftBlocksSource.peakFFTAmplitude())
-        fftAmplitudeBlocks[i] = ((20*(numpy.log10(normalized + 1e-60))).clip(-specRange, 0.0) + specRange)/specRange
-        wrapProgressCallback(totalProgress + STEP_PERCENTAGE_NORMALIZE * (i / len(fftAmplitudeBlocks)))
+    normalized = numpy.divide(fftAmplitudeBlocks, fftBlocksSource.peakFFTAmplitude())
+    fftAmplitudeBlocks = ((20*(numpy.log10(normalized + 1e-60))).clip(-specRange, 0.0) + specRange)/specRange
 
     totalProgress = totalProgress + STEP_PERCENTAGE_NORMALIZE
+    wrapProgressCallback(totalProgress)
 
     # Compute spectrogram width in pixels
     imageWidthPerSecond, lengthRage = imageWidthLookup[-1]
@@ -241,22 +265,15 @@ def drawSpectrogram(audioFileName, imageFileName, fftSize = 1024, fftOverlap = 0
             break
     imageWidth = int(imageWidthPerSecond * soundLength)
 
-    # Compute spectrogram values
-    columnValues = numpy.zeros(imageHeight)
-    spectrogram = []
-    x = 0
-    for idx in range(0, len(fftAmplitudeBlocks)):
-        newX = (idx * imageWidth) // len(fftAmplitudeBlocks)
-        if newX != x:
-            # Save column
-            spectrogram.append(numpy.copy(columnValues))
-            x = newX
-            columnValues.fill(0)
-        columnValues = numpy.maximum(columnValues, fftAmplitudeBlocks[idx])
-        wrapProgressCallback(totalProgress + STEP_PERCENTAGE_ACCUMULATE * (idx / len(fftAmplitudeBlocks)))
-    spectrogram.append(numpy.copy(columnValues))
+    # Compute spectrogram values: each column keeps the peaks of the run
+    # of consecutive blocks falling into it
+    numBlocks = len(fftAmplitudeBlocks)
+    blockColumns = (numpy.arange(numBlocks) * imageWidth) // numBlocks
+    columnStarts = numpy.flatnonzero(numpy.diff(blockColumns, prepend=-1))
+    spectrogram = numpy.maximum.reduceat(fftAmplitudeBlocks, columnStarts, axis=0)
 
     totalProgress = totalProgress + STEP_PERCENTAGE_ACCUMULATE
+    wrapProgressCallback(totalProgress)
 
     # Draw spectrogram
     imageWidth = len(spectrogram)
@@ -265,8 +282,7 @@ def drawSpectrogram(audioFileName, imageFileName, fftSize = 1024, fftOverlap = 0
     totalProgress = totalProgress + STEP_PERCENTAGE_DRAW
 
     # Save final image
-    image = Image.new('RGB', (imageWidth, imageHeight))
-    image.putdata(colorData)
+    image = Image.frombuffer('RGB', (imageWidth, imageHeight), colorData, 'raw', 'RGB', 0, 1)
     image.save(imageFileName)
 
     if progressCallback:
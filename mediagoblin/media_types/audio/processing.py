@@ -123,6 +123,7 @@ class CommonAudioProcessor(MediaProcessor):
             webm_audio_tmp,
             quality=quality,
             progress_callback=progress_callback)
+        progress_callback.flush()
 
         self._keep_best()
 
@@ -141,16 +142,11 @@ class CommonAudioProcessor(MediaProcessor):
         if self._skip_processing('spectrogram', max_width=max_width,
                                  fft_size=fft_size):
             return
-        wav_tmp = os.path.join(self.workbench.dir, self.name_builder.fill(
-            '{basename}.ogg'))
-        _log.info('Creating OGG source for spectrogram')
-        self.transcoder.transcode(self.process_filename, wav_tmp,
-                                  mux_name='oggmux')
         spectrogram_tmp = os.path.join(self.workbench.dir,
                                        self.name_builder.fill(
                                            '{basename}-spectrogram.jpg'))
         self.thumbnailer.spectrogram(
-            wav_tmp,
+            self.process_filename,
             spectrogram_tmp,
             width=max_width,
             fft_size=fft_size)
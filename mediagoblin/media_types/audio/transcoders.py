@@ -15,6 +15,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import os
+
+import numpy
 try:
     from PIL import Image
 except ImportError:
@@ -43,15 +46,118 @@ gi.require_version('Gst', '1.0')
 from gi.repository import GObject, Gst
 Gst.init(None)
 
+class GstPCMSource:
+    '''
+    Decoded PCM data of any audio file GStreamer can play
+
+    Samples are pulled from an appsink as they are decoded, with the
+    same interface as audiotospectrogram.SoundFileSource.
+    '''
+    def __init__(self, src):
+        self.pipeline = Gst.Pipeline()
+        decoder = Gst.ElementFactory.make('uridecodebin', None)
+        decoder.set_property('uri', 'file://{}'.format(os.path.abspath(src)))
+        convert = Gst.ElementFactory.make('audioconvert', None)
+        decoder.connect('pad-added', self._on_pad_added,
+                        convert.get_static_pad('sink'))
+
+        caps = Gst.Caps.from_string(
+            'audio/x-raw,format=F32LE,layout=interleaved')
+        self.appsink = Gst.ElementFactory.make('appsink', None)
+        self.appsink.set_property('caps', caps)
+        self.appsink.set_property('sync', False)
+        # Let the decoder wait for us instead of queueing the whole file
+        self.appsink.set_property('max-buffers', 16)
+
+        for element in [decoder, convert, self.appsink]:
+            self.pipeline.add(element)
+        convert.link(self.appsink)
+
+        self.pipeline.set_state(Gst.State.PAUSED)
+        state = self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
+        if state[0] != Gst.StateChangeReturn.SUCCESS:
+            self.pipeline.set_state(Gst.State.NULL)
+            raise Exception(f'Could not decode {src}: {state}')
+
+        structure = self.appsink.get_static_pad('sink') \
+            .get_current_caps().get_structure(0)
+        self.sampleRate = structure.get_int('rate')[1]
+        self.numChannels = structure.get_int('channels')[1]
+
+        (success, duration) = self.pipeline.query_duration(Gst.Format.TIME)
+        if not success:
+            self.pipeline.set_state(Gst.State.NULL)
+            raise Exception(f'Could not get the duration of {src}')
+        self.totalSamples = duration * self.sampleRate // Gst.SECOND
+
+    def _on_pad_added(self, element, pad, connect_to):
+        name = pad.query_caps(None).to_string()
+        if name.startswith('audio') and not connect_to.is_linked():
+            pad.link(connect_to)
+
+    def _error(self):
+        message = self.pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+        if message is None:
+            return 'unknown error'
+        error, debug = message.parse_error()
+        return error.message
+
+    def blocks(self, blockSize, overlap):
+        '''
+        Yield (samples, position) pairs, samples being a frames x channels
+        array and position the number of frames decoded so far
+
+        Raises an exception if decoding fails on the way.
+        '''
+        self.pipeline.set_state(Gst.State.PLAYING)
+        try:
+            pending = numpy.zeros((0, self.numChannels), dtype=numpy.float32)
+            position = 0
+            # The frames kept for overlapping have been yielded already
+            seen = 0
+            while True:
+                sample = self.appsink.emit('pull-sample')
+                if sample is None:
+                    # Decoding errors end the samples too
+                    if not self.appsink.get_property('eos'):
+                        raise Exception(
+                            'Decoding stopped before the end: {}'.format(
+                                self._error()))
+                    break
+                buf = sample.get_buffer()
+                frames = numpy.frombuffer(
+                    buf.extract_dup(0, buf.get_size()),
+                    dtype=numpy.float32).reshape(-1, self.numChannels)
+                pending = numpy.concatenate((pending, frames))
+                position += len(frames)
+                while len(pending) >= blockSize:
+                    yield (pending[:blockSize],
+                           position - len(pending) + blockSize)
+                    pending = pending[blockSize - overlap:]
+                    seen = overlap
+            if len(pending) > seen:
+                yield (pending, position)
+        finally:
+            self.pipeline.set_state(Gst.State.NULL)
+
+
 class Python3AudioThumbnailer:
     def __init__(self):
         _log.info(f'Initializing {self.__class__.__name__}')
 
     def spectrogram(self, src, dst, **kw):
+        '''
+        Draws a spectrogram of SRC, decoding it as it goes
+        '''
         from mediagoblin.media_types.audio import audiotospectrogram
         fft_size = kw.get('fft_size', 1024)
         callback = kw.get('progress_callback')
-        audiotospectrogram.drawSpectrogram(src, dst, fftSize = fft_size, progressCallback = callback)
+        try:
+            source = audiotospectrogram.SoundFileSource(src)
+        except RuntimeError:
+            # Not a format libsndfile can read, let GStreamer decode it
+            source = GstPCMSource(src)
+        audiotospectrogram.drawSpectrogram(source, dst, fftSize = fft_size, progressCallback = callback)
 
     def thumbnail_spectrogram(self, src, dst, thumb_size):
         '''
@@ -45,24 +45,73 @@ PIL_FILTERS = {
 MEDIA_TYPE = 'mediagoblin.media_types.image'
 
 
+class SourceImage:
+    """
+    The image being processed, decoded at most once per processing run.
+
+    Large JPEGs are decoded in draft mode at a reduced scale which is
+    still well above the largest size they get resized to, and the EXIF
+    orientation is fixed once, for all the resized versions.
+    """
+    def __init__(self, filename, exif_tags):
+        self.filename = filename
+        self.exif_tags = exif_tags
+        self._image = None
+        self._size = None
+        self._decoded = None
+
+    def _open(self):
+        if self._image is None:
+            try:
+                self._image = Image.open(self.filename)
+            except OSError:
+                raise BadMediaFail()
+            # Decoding in draft mode changes the size of the image
+            self._size = self._image.size
+        return self._image
+
+    @property
+    def size(self):
+        """Size of the original image, as stored in the file"""
+        self._open()
+        return self._size
+
+    def needs_rotation(self):
+        return exif_image_needs_rotation(self.exif_tags)
+
+    def decode(self, max_size):
+        """
+        Return the image, oriented, decoded at no less than twice MAX_SIZE
+        if the format supports decoding at a reduced scale.
+
+        The image is only decoded on the first call, so MAX_SIZE should
+        be the largest size any version will be resized to.
+        """
+        if self._decoded is None:
+            im = self._open()
+            # Orientation may swap width and height, so cover both
+            draft_side = 2 * max(max_size)
+            im.draft(im.mode, (draft_side, draft_side))
+            self._decoded = exif_fix_image_orientation(im, self.exif_tags)
+            self._decoded.load()
+        return self._decoded
+
+
 def resize_image(entry, resized, keyname, target_name, new_size,
-                 exif_tags, workdir, quality, filter):
+                 workdir, quality, filter):
     """
-    Store a resized version of an image and return its pathname.
+    Store a resized version of an image and return the resized image.
 
     Arguments:
-    proc_state -- the processing state for the image to resize
-    resized -- an image from Image.open() of the original image being resized
+    entry -- the media entry of the image to resize
+    resized -- a copy of the oriented image being resized, resized in place
     keyname -- Under what key to save in the db.
     target_name -- public file path for the new resized image
-    exif_tags -- EXIF data for the original image
     workdir -- directory path for storing converted image files
     new_size -- 2-tuple size for the resized image
     quality -- level of compression used when resizing images
     filter -- One of BICUBIC, BILINEAR, NEAREST, ANTIALIAS
     """
-    resized = exif_fix_image_orientation(resized, exif_tags)  # Fix orientation
-
     try:
         resize_filter = PIL_FILTERS[filter.upper()]
     except KeyError:
@@ -85,10 +134,19 @@ def resize_image(entry, resized, keyname, target_name, new_size,
 
     entry.set_file_metadata(keyname, **image_info)
 
+    return resized
+
 
 def resize_tool(entry,
-                force, keyname, orig_file, target_name,
-                conversions_subdir, exif_tags, quality, filter, new_size=None):
+                force, keyname, source, target_name,
+                conversions_subdir, quality, filter, new_size=None,
+                resize_from=None):
+    """
+    Resize the SourceImage SOURCE if needed, returning the resized image.
+
+    RESIZE_FROM is an already oriented and downscaled version of the
+    source to resize instead of decoding the source.
+    """
     # Use the default size if new_size was not given
     if not new_size:
         max_width = mgg.global_config['media:' + keyname]['max_width']
@@ -100,25 +158,34 @@ def resize_tool(entry,
     if _skip_resizing(entry, keyname, new_size, quality, filter):
         _log.info('{} of same size and quality already in use, skipping '
                   'resizing of media {}.'.format(keyname, entry.id))
-        return
+        return None
 
     # If the size of the original file exceeds the specified size for the desized
     # file, a target_name file is created and later associated with the media
     # entry.
     # Also created if the file needs rotation, or if forced.
-    try:
-        im = Image.open(orig_file)
-    except OSError:
-        raise BadMediaFail()
     if force \
-        or im.size[0] > new_size[0]\
-        or im.size[1] > new_size[1]\
-        or exif_image_needs_rotation(exif_tags):
-        resize_image(
-            entry, im, str(keyname), target_name,
-            tuple(new_size),
-            exif_tags, conversions_subdir,
+        or source.size[0] > new_size[0]\
+        or source.size[1] > new_size[1]\
+        or source.needs_rotation():
+        if resize_from is None:
+            resize_from = source.decode(_largest_size(new_size))
+        return resize_image(
+            entry, resize_from.copy(), str(keyname), target_name,
+            tuple(new_size), conversions_subdir,
             quality, filter)
+    return None
+
+
+def _largest_size(new_size):
+    """
+    The largest size an image gets resized to, for decoding it only once
+    """
+    sizes = [tuple(new_size)]
+    for keyname in ('medium', 'thumb'):
+        config = mgg.global_config['media:' + keyname]
+        sizes.append((config['max_width'], config['max_height']))
+    return (max(size[0] for size in sizes), max(size[1] for size in sizes))
 
 
 def _skip_resizing(entry, keyname, size, quality, filter):
@@ -193,6 +260,10 @@ class CommonImageProcessor(MediaProcessor):
         # Exif extraction
         self.exif_tags = extract_exif(self.process_filename)
 
+        # Decoded once, for both the medium and the thumbnail
+        self.source_image = SourceImage(self.process_filename, self.exif_tags)
+        self.medium_image = None
+
     def generate_medium_if_applicable(self, size=None, quality=None,
                                       filter=None):
         if not quality:
@@ -200,10 +271,10 @@ class CommonImageProcessor(MediaProcessor):
         if not filter:
             filter = self.image_config['resize_filter']
 
-        resize_tool(self.entry, False, 'medium', self.process_filename,
-                    self.name_builder.fill('{basename}.medium{ext}'),
-                    self.conversions_subdir, self.exif_tags, quality,
-                    filter, size)
+        self.medium_image = resize_tool(
+            self.entry, False, 'medium', self.source_image,
+            self.name_builder.fill('{basename}.medium{ext}'),
+            self.conversions_subdir, quality, filter, size)
 
     def generate_thumb(self, size=None, quality=None, filter=None):
         if not quality:
@@ -211,10 +282,23 @@ class CommonImageProcessor(MediaProcessor):
         if not filter:
             filter = self.image_config['resize_filter']
 
-        resize_tool(self.entry, True, 'thumb', self.process_filename,
+        if not size:
+            size = (mgg.global_config['media:thumb']['max_width'],
+                    mgg.global_config['media:thumb']['max_height'])
+
+        # The medium makes a good enough source for the thumbnail if it
+        # is still at least twice as big in the dimension which limits
+        # the thumbnail, that is if it gets scaled down by half or more
+        resize_from = None
+        if self.medium_image is not None:
+            width, height = self.medium_image.size
+            if min(size[0] / width, size[1] / height) <= 0.5:
+                resize_from = self.medium_image
+
+        resize_tool(self.entry, True, 'thumb', self.source_image,
                     self.name_builder.fill('{basename}.thumbnail{ext}'),
-                    self.conversions_subdir, self.exif_tags, quality,
-                    filter, size)
+                    self.conversions_subdir, quality, filter, size,
+                    resize_from=resize_from)
 
     def copy_original(self):
         copy_original(
@@ -236,14 +320,9 @@ class CommonImageProcessor(MediaProcessor):
             self.entry.media_data_init(exif_all=exif_all)
 
         # Extract file metadata
-        try:
-            im = Image.open(self.process_filename)
-        except OSError:
-            raise BadMediaFail()
-
         metadata = {
-            "width": im.size[0],
-            "height": im.size[1],
+            "width": self.source_image.size[0],
+            "height": self.source_image.size[1],
         }
 
         self.entry.set_file_metadata(file, **metadata)
@@ -197,6 +197,28 @@ def main_task(entry_id, resolution, medium_size, **process_info):
     _log.debug('MediaEntry processed')
 
 
+@celery.shared_task()
+def single_pass_task(entry_id, resolutions, **process_info):
+    """
+    Celery task to transcode the video to all the resolutions at once,
+    decoding it only once, and store original video metadata.
+    """
+    entry, manager = get_entry_and_processing_manager(entry_id)
+    with CommonVideoProcessor(manager, entry) as processor:
+        processor.common_setup()
+        processor.transcode_resolutions(
+            resolutions,
+            vp8_quality=process_info['vp8_quality'],
+            vp8_threads=process_info['vp8_threads'],
+            vorbis_quality=process_info['vorbis_quality'])
+        processor.generate_thumb(thumb_size=process_info['thumb_size'])
+        processor.store_orig_metadata()
+    entry.state = 'processed'
+    entry.save()
+    _log.info('MediaEntry ID {} is transcoded to {}'.format(
+        entry.id, ', '.join(resolutions)))
+
+
 @celery.shared_task()
 def complementary_task(entry_id, resolution, medium_size, **process_info):
     """
@@ -237,9 +259,10 @@ class CommonVideoProcessor(MediaProcessor):
         self.video_config = mgg \
             .global_config['plugins'][MEDIA_TYPE]
 
-        # Pull down and set up the processing file
+        # Pull down and set up the processing file, shared by the tasks
+        # transcoding to the different resolutions
         self.process_filename = get_process_filename(
-            self.entry, self.workbench, self.acceptable_files)
+            self.entry, self.workbench, self.acceptable_files, shared=True)
         self.name_builder = FilenameBuilder(self.process_filename)
 
         self.transcoder = transcoders.VideoTranscoder()
@@ -354,7 +377,12 @@ class CommonVideoProcessor(MediaProcessor):
             _log.debug('Entered transcoder')
             video_config = (mgg.global_config['plugins']
                             ['mediagoblin.media_types.video'])
-            num_res = len(video_config['available_resolutions'])
+            # Resolutions bigger than the video are skipped, and don't
+            # count towards the progress
+            num_res = max(1, sum(
+                1 for resolution in video_config['available_resolutions']
+                if not skip_transcode(metadata,
+                                      ACCEPTED_RESOLUTIONS[resolution])))
             default_res = video_config['default_resolution']
             self.transcoder.transcode(self.process_filename, tmp_dst,
                                       default_res, num_res,
@@ -363,6 +391,7 @@ class CommonVideoProcessor(MediaProcessor):
                                       vorbis_quality=vorbis_quality,
                                       progress_callback=progress_callback,
                                       dimensions=tuple(medium_size))
+            progress_callback.flush()
             if self.transcoder.dst_data:
                 # Push transcoded video to public storage
                 _log.debug('Saving medium...')
@@ -373,6 +402,74 @@ class CommonVideoProcessor(MediaProcessor):
 
                 self.did_transcode = True
 
+    def transcode_resolutions(self, resolutions, vp8_quality=None,
+                              vp8_threads=None, vorbis_quality=None):
+        """
+        Transcode to all RESOLUTIONS with a single decode of the video
+        """
+        progress_callback = ProgressCallback(self.entry)
+
+        if not vp8_quality:
+            vp8_quality = self.video_config['vp8_quality']
+        if not vp8_threads:
+            vp8_threads = self.video_config['vp8_threads']
+        if not vorbis_quality:
+            vorbis_quality = self.video_config['vorbis_quality']
+
+        metadata = transcoders.discover(self.process_filename)
+
+        outputs = []
+        for resolution in resolutions:
+            medium_size = ACCEPTED_RESOLUTIONS[resolution]
+            curr_file = 'webm_' + resolution
+            file_metadata = {'medium_size': medium_size,
+                             'vp8_threads': vp8_threads,
+                             'vp8_quality': vp8_quality,
+                             'vorbis_quality': vorbis_quality}
+
+            if self._skip_processing(curr_file, **file_metadata):
+                continue
+
+            if skip_transcode(metadata, medium_size):
+                _log.debug(f'Skipping transcoding to {resolution}')
+                if self.entry.media_files.get('original') and \
+                   self.entry.media_files.get(curr_file):
+                    self.entry.media_files[curr_file].delete()
+                continue
+
+            part_filename = self.name_builder.fill(
+                '{basename}.' + resolution + '.webm')
+            outputs.append((resolution, curr_file, part_filename,
+                            file_metadata))
+
+        if not outputs:
+            return
+
+        _log.debug('Entered transcoder')
+        self.transcoder.transcode_resolutions(
+            self.process_filename,
+            [(resolution, ACCEPTED_RESOLUTIONS[resolution],
+              os.path.join(self.workbench.dir, part_filename))
+             for resolution, curr_file, part_filename, file_metadata
+             in outputs],
+            self.video_config['default_resolution'],
+            len(outputs),
+            vp8_quality=vp8_quality,
+            vp8_threads=vp8_threads,
+            vorbis_quality=vorbis_quality,
+            progress_callback=progress_callback)
+        progress_callback.flush()
+
+        for resolution, curr_file, part_filename, file_metadata in outputs:
+            if not self.transcoder.dst_data.get(resolution):
+                continue
+            _log.debug(f'Saving {resolution}...')
+            store_public(self.entry, curr_file,
+                         os.path.join(self.workbench.dir, part_filename),
+                         part_filename)
+            self.entry.set_file_metadata(curr_file, **file_metadata)
+            self.did_transcode = True
+
     def generate_thumb(self, thumb_size=None):
         _log.debug("Enter generate_thumb()")
         # Temporary file for the video thumbnail (cleaned up with workbench)
@@ -607,6 +704,16 @@ class VideoProcessingManager(ProcessingManager):
         if 'thumb_size' not in reprocess_info:
             reprocess_info['thumb_size'] = None
 
+        if video_config['single_pass_transcode']:
+            tasks_list = [single_pass_task.signature(
+                args=(entry.id, video_config['available_resolutions']),
+                kwargs=reprocess_info, queue='default',
+                priority=priority_num, immutable=True)]
+            transcoding_tasks = group(tasks_list)
+            cleanup_task = processing_cleanup.signature(
+                args=(entry.id,), queue='default', immutable=True)
+            return (transcoding_tasks, cleanup_task)
+
         tasks_list = [main_task.signature(args=(entry.id, def_res,
                                           ACCEPTED_RESOLUTIONS[def_res]),
                                           kwargs=reprocess_info, queue='default',
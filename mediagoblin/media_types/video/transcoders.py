@@ -200,6 +200,139 @@ class VideoTranscoder:
         _log.debug('Initializing MainLoop()')
         self.loop.run()
 
+    def transcode_resolutions(self, src, outputs, default_res, num_res,
+                              **kwargs):
+        '''
+        Transcode a video file into several sizes at once.
+
+        OUTPUTS is a list of (resolution, dimensions, destination) tuples.
+        The source is only demuxed and decoded once; the decoded video is
+        split with a ``tee`` into one scaling and VP8 encoding branch per
+        output, and the audio is encoded once and muxed into every
+        output.
+
+        Afterwards ``self.dst_data`` maps every resolution which was
+        transcoded successfully to the discovered info of its file.
+        '''
+        self.source_path = src
+        self.outputs = outputs
+
+        self.vp8_quality = kwargs.get('vp8_quality', 8)
+        self.vp8_threads = kwargs.get('vp8_threads', CPU_COUNT - 1)
+        if self.vp8_threads == 0:
+            self.vp8_threads = CPU_COUNT
+        self.vorbis_quality = kwargs.get('vorbis_quality', 0.3)
+
+        self._progress_callback = kwargs.get('progress_callback') or None
+
+        self.num_of_resolutions = num_res
+        self.default_resolution = default_res
+
+        for resolution, dimensions, destination in outputs:
+            if not type(dimensions) == tuple:
+                raise Exception('dimensions must be tuple: (width, height)')
+
+        self.data = discover(self.source_path)
+        self._setup_multi_pipeline()
+        self.pipeline.set_state(Gst.State.PLAYING)
+        _log.info('Transcoding to {}...'.format(
+            ', '.join(output[0] for output in outputs)))
+        self.loop.run()
+
+    def _setup_multi_pipeline(self):
+        _log.debug('Setting up multi-output transcoding pipeline')
+        self.pipeline = Gst.Pipeline.new('VideoTranscoderPipeline')
+
+        def make(factory, name, **properties):
+            element = Gst.ElementFactory.make(factory, name)
+            for key, value in properties.items():
+                element.set_property(key.replace('_', '-'), value)
+            self.pipeline.add(element)
+            return element
+
+        def link(*elements):
+            for upstream, downstream in zip(elements, elements[1:]):
+                upstream.link(downstream)
+
+        self.filesrc = make('filesrc', 'filesrc', location=self.source_path)
+        self.decoder = make('decodebin', 'decoder')
+        self.decoder.connect('pad-added', self._on_dynamic_pad)
+        self.filesrc.link(self.decoder)
+
+        # Decoded video is converted once, then split per output
+        self.videoqueue = make('queue', 'videoqueue')
+        self.videorate = make('videorate', 'videorate')
+        self.videoconvert = make('videoconvert', 'videoconvert')
+        videotee = make('tee', 'videotee')
+        link(self.videoqueue, self.videorate, self.videoconvert, videotee)
+
+        # Like in _link_elements the audio queue stays unlinked when
+        # there is no audio to transcode
+        self.audioqueue = make('queue', 'audioqueue')
+        has_audio = bool(self.data.get_audio_streams())
+        if has_audio:
+            # Every output gets the same audio, so encode it only once
+            audiorate = make('audiorate', 'audiorate', tolerance=80000000)
+            audioconvert = make('audioconvert', 'audioconvert')
+            audiocaps = Gst.Caps.new_empty()
+            audiocaps.append_structure(Gst.Structure.new_empty('audio/x-raw'))
+            audiocapsfilter = make('capsfilter', 'audiocapsfilter',
+                                   caps=audiocaps)
+            vorbisenc = make('vorbisenc', 'vorbisenc',
+                             quality=self.vorbis_quality)
+            audiotee = make('tee', 'audiotee')
+            link(self.audioqueue, audiorate, audioconvert, audiocapsfilter,
+                 vorbisenc, audiotee)
+
+        # Progress is reported per output, keyed by progressreport name
+        self.branches = {}
+        for resolution, dimensions, destination in self.outputs:
+            videoqueue = make('queue', f'videoqueue-{resolution}')
+            videoscale = make('videoscale', f'videoscale-{resolution}')
+            capsfilter = make('capsfilter', f'capsfilter-{resolution}',
+                              caps=self._scaled_caps(dimensions))
+            vp8enc = make('vp8enc', f'vp8enc-{resolution}',
+                          threads=self.vp8_threads)
+            webmmux = make('webmmux', f'webmmux-{resolution}')
+            progressreport = make('progressreport',
+                                  f'progressreport-{resolution}',
+                                  update_freq=1, silent=True)
+            filesink = make('filesink', f'filesink-{resolution}',
+                            location=destination)
+            link(videotee, videoqueue, videoscale, capsfilter, vp8enc,
+                 webmmux, progressreport, filesink)
+
+            if has_audio:
+                audioqueue = make('queue', f'audioqueue-{resolution}')
+                link(audiotee, audioqueue, webmmux)
+
+            self.branches[progressreport.get_name()] = {
+                'resolution': resolution,
+                'dimensions': dimensions,
+                'destination': destination,
+                'percent': 0}
+
+        self.dst_data = {}
+        self._setup_bus(self._on_multi_message)
+
+    def _scaled_caps(self, dimensions):
+        '''
+        Caps scaling the video to fit in DIMENSIONS, keeping its aspect
+        '''
+        caps_struct = Gst.Structure.new_empty('video/x-raw')
+        caps_struct.set_value('pixel-aspect-ratio', Gst.Fraction(1, 1))
+        caps_struct.set_value('framerate', Gst.Fraction(30, 1))
+        video_info = self.data.get_video_streams()[0]
+        if video_info.get_height() > video_info.get_width():
+            # portrait
+            caps_struct.set_value('height', dimensions[1])
+        else:
+            # landscape
+            caps_struct.set_value('width', dimensions[0])
+        caps = Gst.Caps.new_empty()
+        caps.append_structure(caps_struct)
+        return caps
+
 
     def _setup_pipeline(self):
         _log.debug('Setting up transcoding pipeline')
@@ -323,28 +456,17 @@ class VideoTranscoder:
             _log.debug('linking video to the pad dynamically')
             pad.link(self.videoqueue.get_static_pad('sink'))
 
-    def _setup_bus(self):
+    def _setup_bus(self, on_message=None):
         self.bus = self.pipeline.get_bus()
         self.bus.add_signal_watch()
-        self.bus.connect('message', self._on_message)
+        self.bus.connect('message', on_message or self._on_message)
 
     def __setup_videoscale_capsfilter(self):
         '''
         Sets up the output format (width, height) for the video
         '''
-        caps_struct = Gst.Structure.new_empty('video/x-raw')
-        caps_struct.set_value('pixel-aspect-ratio', Gst.Fraction(1, 1))
-        caps_struct.set_value('framerate', Gst.Fraction(30, 1))
-        video_info = self.data.get_video_streams()[0]
-        if video_info.get_height() > video_info.get_width():
-            # portrait
-            caps_struct.set_value('height', self.destination_dimensions[1])
-        else:
-            # landscape
-            caps_struct.set_value('width', self.destination_dimensions[0])
-        caps = Gst.Caps.new_empty()
-        caps.append_structure(caps_struct)
-        self.capsfilter.set_property('caps', caps)
+        self.capsfilter.set_property(
+            'caps', self._scaled_caps(self.destination_dimensions))
 
     def _on_message(self, bus, message):
         _log.debug((bus, message, message.type))
@@ -376,6 +498,45 @@ class VideoTranscoder:
             self.dst_data = None
             self.__stop()
 
+    def _on_multi_message(self, bus, message):
+        _log.debug((bus, message, message.type))
+        if message.type == Gst.MessageType.EOS:
+            # All the outputs are finished once the pipeline is
+            for branch in self.branches.values():
+                self.dst_data[branch['resolution']] = discover(
+                    branch['destination'])
+            self.__stop()
+            _log.info('Done')
+        elif message.type == Gst.MessageType.ELEMENT:
+            if message.has_name('progress'):
+                branch = self.branches.get(message.src.get_name())
+                if branch is None:
+                    return
+                structure = message.get_structure()
+                (success, percent) = structure.get_int('percent')
+                if branch['percent'] != percent and success:
+                    # Same workaround as in _on_message for the final
+                    # progress being reported as 0
+                    if branch['percent'] > percent and percent == 0:
+                        percent = 100
+                    percent_increment = percent - branch['percent']
+                    branch['percent'] = percent
+                    if self._progress_callback:
+                        if branch['resolution'] == self.default_resolution:
+                            self._progress_callback(
+                                percent_increment / self.num_of_resolutions,
+                                percent)
+                        else:
+                            self._progress_callback(
+                                percent_increment / self.num_of_resolutions)
+                    _log.info('{percent}% of {dest} resolution done..'
+                              '.'.format(percent=percent,
+                                         dest=branch['dimensions']))
+        elif message.type == Gst.MessageType.ERROR:
+            _log.error(f'Got error: {message.parse_error()}')
+            self.dst_data = {}
+            self.__stop()
+
     def __stop(self):
         _log.debug(self.loop)
 
@@ -18,6 +18,7 @@ import logging
 
 from mediagoblin.db.models import Notification, CommentSubscription, User, \
                                   Comment, GenericModelReference
+from mediagoblin.db.util import preload_references
 from mediagoblin.notifications.task import email_notification_task
 from mediagoblin.notifications.tools import generate_comment_message
 
@@ -101,7 +102,7 @@ def get_comment_subscription(user_id, media_entry_id):
         user_id=user_id,
         media_entry_id=media_entry_id).first()
 
-def add_comment_subscription(user, media_entry):
+def add_comment_subscription(user, media_entry, commit=True):
     '''
     Create a comment subscription for a User on a MediaEntry.
 
@@ -120,7 +121,7 @@ def add_comment_subscription(user, media_entry):
     if not user.wants_comment_notification:
         cn.send_email = False
 
-    cn.save()
+    cn.save(commit=commit)
 
 
 def silence_comment_subscription(user, media_entry):
@@ -158,8 +159,14 @@ def get_notifications(user_id, only_unseen=True):
     if only_unseen:
         query = query.filter_by(seen=False)
 
-    notifications = query.limit(
-        NOTIFICATION_FETCH_LIMIT).all()
+    notifications = preload_references(
+        query.limit(NOTIFICATION_FETCH_LIMIT), 'object_helper')
+
+    # Comment notifications are shown with the comment and what it is on
+    objects = [notification.obj() for notification in notifications]
+    preload_references(
+        [obj for obj in objects if isinstance(obj, Comment)],
+        'comment_helper', 'target_helper')
 
     return notifications
 
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import binascii
 import logging
 import re
 
@@ -26,6 +28,7 @@ from mediagoblin.auth.tools import check_login_simple
 from mediagoblin.submit.lib import \
     submit_media, check_file_field, \
     FileUploadLimit, UserUploadLimit, UserPastUploadLimit
+from mediagoblin.submit.resumable import UploadSession, UploadSessionError
 
 from mediagoblin.user_pages.lib import add_media_to_collection
 from mediagoblin.db.models import Collection
@@ -110,30 +113,12 @@ def pwg_images_exist(request):
     return {}
 
 
-@CmdTable("pwg.images.addSimple", True)
-def pwg_images_addSimple(request):
-    form = AddSimpleForm(request.form)
-    if not form.validate():
-        _log.error("addSimple: form failed")
-        raise BadRequest()
-    dump = []
-    for f in form:
-        dump.append(f"{f.name}={f.data!r}")
-    _log.info("addSimple: %r %s %r", request.form, " ".join(dump),
-              request.files)
-
-    if not check_file_field(request, 'image'):
-        raise BadRequest()
-
+def _submit(request, collection_id, **kwargs):
+    """submit_media with the upload limits reported to the client"""
     try:
         entry = submit_media(
-            mg_app=request.app, user=request.user,
-            submitted_file=request.files['image'],
-            filename=request.files['image'].filename,
-            title=str(form.name.data),
-            description=str(form.comment.data))
+            mg_app=request.app, user=request.user, **kwargs)
 
-        collection_id = form.category.data
         if collection_id > 0:
             collection = Collection.query.get(collection_id)
             if collection is not None and collection.actor == request.user.id:
@@ -158,6 +143,29 @@ def pwg_images_addSimple(request):
             _('Sorry, you have reached your upload limit.'))
 
 
+@CmdTable("pwg.images.addSimple", True)
+def pwg_images_addSimple(request):
+    form = AddSimpleForm(request.form)
+    if not form.validate():
+        _log.error("addSimple: form failed")
+        raise BadRequest()
+    dump = []
+    for f in form:
+        dump.append(f"{f.name}={f.data!r}")
+    _log.info("addSimple: %r %s %r", request.form, " ".join(dump),
+              request.files)
+
+    if not check_file_field(request, 'image'):
+        raise BadRequest()
+
+    return _submit(
+        request, form.category.data,
+        submitted_file=request.files['image'],
+        filename=request.files['image'].filename,
+        title=str(form.name.data),
+        description=str(form.comment.data))
+
+
 md5sum_matcher = re.compile(r"^[0-9a-fA-F]{32}$")
 
 
@@ -172,6 +180,11 @@ def fetch_md5(request, parm_name, optional_parm=False):
     return val
 
 
+def _chunk_session_id(request, original_sum):
+    # The client names the image by its md5 in every call
+    return "pwg-{}-{}".format(request.user.id, original_sum.lower())
+
+
 @CmdTable("pwg.images.addChunk", True)
 def pwg_images_addChunk(request):
     o_sum = fetch_md5(request, 'original_sum')
@@ -191,6 +204,46 @@ def pwg_images_addChunk(request):
         _log.info("addChunk: Ignoring thumb, because we create our own")
         return True
 
+    if not request.user:
+        return PwgError(401, 'Access denied')
+
+    try:
+        data = base64.b64decode(data, validate=True)
+    except binascii.Error:
+        raise BadRequest("Parameter data is not base64")
+
+    session_id = _chunk_session_id(request, o_sum)
+    with UploadSession.lock(request.app.queue_store, session_id):
+        return _add_chunk(request, session_id, o_sum, pos, data)
+
+
+def _add_chunk(request, session_id, o_sum, pos, data):
+    session = UploadSession.load(request.app.queue_store, session_id)
+    try:
+        if session is None:
+            session = UploadSession.start(
+                request.app.queue_store, request.user, o_sum,
+                md5=o_sum, session_id=session_id)
+
+        # Chunks come in order, the client may only send one again
+        chunks = session.state.get('chunks', 0)
+        if pos < chunks:
+            return True
+        if pos > chunks:
+            return PwgError(500, 'Missing chunk %d' % chunks)
+
+        # Saved together with the new offset by append(), so a chunk
+        # can't be counted without its data or the other way round
+        session.state['chunks'] = pos + 1
+        session.append(session.offset, data)
+    except FileUploadLimit:
+        if session is not None:
+            session.delete()
+        raise BadRequest(
+            _('Sorry, the file size is too big.'))
+    except UploadSessionError as exc:
+        return PwgError(500, str(exc))
+
     return True
 
 
@@ -200,7 +253,42 @@ def pwg_images_add(request):
     form = AddForm(request.form)
     check_form(form)
 
-    return {'image_id': 123456, 'url': ''}
+    if not request.user:
+        return PwgError(401, 'Access denied')
+
+    session_id = _chunk_session_id(request, form.original_sum.data)
+    with UploadSession.lock(request.app.queue_store, session_id):
+        return _add_image(request, form, session_id)
+
+
+def _add_image(request, form, session_id):
+    session = UploadSession.load(request.app.queue_store, session_id)
+    if session is None:
+        return PwgError(500, 'No chunks were sent for this image')
+
+    try:
+        data = session.finish()
+    except UploadSessionError as exc:
+        session.delete()
+        return PwgError(500, str(exc))
+
+    # "id[,rank];id[,rank]..."
+    collection_id = 0
+    category = (form.categories.data or "").split(";")[0].split(",")[0]
+    if category.isdigit():
+        collection_id = int(category)
+
+    try:
+        with data:
+            return _submit(
+                request, collection_id,
+                submitted_file=data,
+                filename=(request.form.get('original_filename')
+                          or form.name.data or form.original_sum.data),
+                title=form.name.data or None,
+                description=request.form.get('comment'))
+    finally:
+        session.delete()
 
 
 @csrf_exempt
@@ -19,7 +19,7 @@ import logging
 import os
 
 from mediagoblin.tools.pluginapi import get_config
-from mediagoblin.db.models import MediaEntry
+from mediagoblin.db.models import MediaStateCount
 from mediagoblin.tools import pluginapi
 
 _log = logging.getLogger(__name__)
@@ -36,12 +36,9 @@ def make_stats(context):
     request = context['request']
     user = request.user
     if user:
-        num_queued = MediaEntry.query.filter_by(
-                actor=user.id, state='processing').count()
-        context['num_queued'] = num_queued
-        num_failed = MediaEntry.query.filter_by(
-                actor=user.id, state='failed').count()
-        context['num_failed'] = num_failed
+        counts = MediaStateCount.for_user(user.id)
+        context['num_queued'] = counts.get('processing', 0)
+        context['num_failed'] = counts.get('failed', 0)
     return context
 
 
@@ -23,10 +23,15 @@ except:
 
 import logging
 import os
+import time
+
+from sqlalchemy import case, func
 
 from mediagoblin import mg_globals as mgg
 from mediagoblin.db.util import atomic_update
-from mediagoblin.db.models import MediaEntry
+from mediagoblin.db.models import MediaEntry, update_media_state_counts
+from mediagoblin.storage import clean_listy_filepath
+from mediagoblin.tools.files import shared_file_paths
 from mediagoblin.tools.pluginapi import hook_handle
 from mediagoblin.tools.translate import lazy_pass_to_ugettext as _
 
@@ -34,18 +39,56 @@ _log = logging.getLogger(__name__)
 
 
 class ProgressCallback:
-    def __init__(self, entry):
+    """
+    Records the transcoding progress of an entry
+
+    Transcoders report progress far more often than it is worth writing
+    it down, so increments are collected and written at most once per
+    INTERVAL seconds or once they add up to STEP percent.  Only the
+    progress columns are updated, and relative to what's stored, so
+    several tasks transcoding the same entry don't overwrite each
+    other.  Call flush() when done to write what's left.
+    """
+    def __init__(self, entry, interval=2, step=5):
         self.entry = entry
+        self.entry_id = entry.id
+        self.interval = interval
+        self.step = step
+        self.pending_progress = 0
+        self.default_quality_progress = None
+        self.last_write = None
 
     def __call__(self, progress, default_quality_progress=None):
         if progress:
-            if 100 - (self.entry.transcoding_progress + progress) < 0.01:
-                self.entry.transcoding_progress = 100
-            else:
-                self.entry.transcoding_progress += round(progress, 2)
+            self.pending_progress += progress
             if default_quality_progress:
-                self.entry.main_transcoding_progress = default_quality_progress
-            self.entry.save()
+                self.default_quality_progress = default_quality_progress
+            if (self.last_write is None
+                    or self.pending_progress >= self.step
+                    or default_quality_progress == 100
+                    or time.monotonic() - self.last_write >= self.interval):
+                self.flush()
+
+    def flush(self):
+        """
+        Write the collected progress, if any
+        """
+        if not self.pending_progress:
+            return
+
+        progress = (func.coalesce(MediaEntry.transcoding_progress, 0)
+                    + round(self.pending_progress, 2))
+        update_values = {
+            'transcoding_progress': case(
+                [(progress > 99.99, 100)], else_=progress)}
+        if self.default_quality_progress:
+            update_values['main_transcoding_progress'] = \
+                self.default_quality_progress
+
+        atomic_update(MediaEntry, {'id': self.entry_id}, update_values)
+        self.pending_progress = 0
+        self.default_quality_progress = None
+        self.last_write = time.monotonic()
 
 
 def create_pub_filepath(entry, filename):
@@ -182,6 +225,10 @@ class MediaProcessor:
             mgg.queue_store.delete_dir(queued_filepath[:-1])  # rm dir
             self.entry.queued_media_file = []
 
+            # ... and any local copy shared by get_process_filename()
+            mgg.workbench_manager.shared_files.discard(
+                shared_file_key(queued_filepath))
+
 
 class ProcessingKeyError(Exception): pass
 class ProcessorDoesNotExist(ProcessingKeyError): pass
@@ -322,6 +369,17 @@ def mark_entry_failed(entry_id, exc):
     :param exc: An instance of BaseProcessingFail
 
     """
+    # atomic_update goes around the session, so the entry has to be
+    # moved between the state counters by hand.  Its row stays locked
+    # until then, so that its state can't change in between.
+    query = MediaEntry.query.filter_by(id=entry_id)
+    entry = query.with_for_update().with_entities(
+        MediaEntry.actor, MediaEntry.state).first()
+    if entry is not None and entry.state != 'failed':
+        update_media_state_counts(query.session, {
+            (entry.actor, entry.state): -1,
+            (entry.actor, 'failed'): 1})
+
     # Was this a BaseProcessingFail?  In other words, was this a
     # type of error that we know how to handle?
     if isinstance(exc, BaseProcessingFail):
@@ -344,11 +402,23 @@ def mark_entry_failed(entry_id, exc):
              'fail_metadata': {}})
 
 
-def get_process_filename(entry, workbench, acceptable_files):
+def shared_file_key(filepath):
+    """
+    Key for the local copy of filepath shared between workbenches
+    """
+    # The leading components make it unique, keep it a valid filename
+    return '-'.join(clean_listy_filepath(filepath))[:200]
+
+
+def get_process_filename(entry, workbench, acceptable_files, shared=False):
     """
     Try and get the queued file if available, otherwise return the first file
     in the acceptable_files that we have.
 
+    If shared is set, a local copy of a remote file is shared with the
+    other processors of this entry on this machine, rather than every
+    processor fetching its own (see Workbench.localized_file).
+
     If no acceptable_files, raise ProcessFileNotFound
     """
     if entry.queued_media_file:
@@ -366,7 +436,8 @@ def get_process_filename(entry, workbench, acceptable_files):
 
     filename = workbench.localized_file(
         storage, filepath,
-        'source')
+        'source',
+        shared_key=shared_file_key(filepath) if shared else None)
 
     if not os.path.exists(filename):
         raise ProcessFileNotFound()
@@ -384,8 +455,10 @@ def store_public(entry, keyname, local_file, target_name=None,
         _log.warn("store_public: keyname %r already used for file %r, "
                   "replacing with %r", keyname,
                   entry.media_files[keyname], target_filepath)
-        if delete_if_exists:
-            mgg.public_store.delete_file(entry.media_files[keyname])
+        old_filepath = entry.media_files[keyname]
+        if delete_if_exists and \
+                not shared_file_paths(entry, [old_filepath]):
+            mgg.public_store.delete_file(old_filepath)
     try:
         mgg.public_store.copy_local_to_storage(local_file, target_filepath)
     except Exception as e:
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
 import uuid
 from os.path import splitext
@@ -24,14 +25,17 @@ from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
 
 from mediagoblin import mg_globals
-from mediagoblin.tools.response import json_response
+from mediagoblin.tools.response import json_response, json_error
 from mediagoblin.tools.text import convert_to_tag_list_of_dicts
 from mediagoblin.tools.federation import create_activity, create_generator
-from mediagoblin.db.models import Collection, MediaEntry, ProcessingMetaData
-from mediagoblin.processing import mark_entry_failed, get_entry_and_processing_manager
-from mediagoblin.processing.task import ProcessMedia
+from mediagoblin.db.models import Collection, MediaEntry, MediaFile, \
+    ProcessingMetaData
+from mediagoblin.processing import mark_entry_failed, \
+    get_processing_manager_for_type
+from mediagoblin.processing.task import ProcessMedia, handle_push_urls
+from mediagoblin.tools.processing import json_processing_callback
 from mediagoblin.notifications import add_comment_subscription
-from mediagoblin.media_types import sniff_media
+from mediagoblin.media_types import sniff_media, FileTypeNotSupported
 from mediagoblin.user_pages.lib import add_media_to_collection
 
 
@@ -100,6 +104,56 @@ class UserPastUploadLimit(UploadLimitError):
     pass
 
 
+# Uploads are copied in blocks of this size
+UPLOAD_BLOCK_SIZE = 64 * 1024
+
+
+def get_upload_byte_limits(user):
+    """
+    The limits on the size of an upload by USER, for copy_upload
+    """
+    upload_limit, max_file_size = get_upload_file_limits(user)
+    limits = []
+    if max_file_size:
+        limits.append((max_file_size * 1024 * 1024, FileUploadLimit))
+    if upload_limit:
+        limits.append(((upload_limit - user.uploaded) * 1024 * 1024,
+                       UserUploadLimit))
+    return limits
+
+
+def copy_upload(source, destination, limits=()):
+    """
+    Copy the uploaded file object SOURCE to the queue file DESTINATION
+
+    The copy stops with FileUploadLimit or UserUploadLimit as soon as it
+    reaches one of LIMITS, from get_upload_byte_limits, so a file which
+    is too big is not written out whole first.  Returns the size of the
+    file in bytes and the sha256 hex digest of its data.
+    """
+    size = 0
+    sha256 = hashlib.sha256()
+    while True:
+        block = source.read(UPLOAD_BLOCK_SIZE)
+        if not block:
+            break
+        size += len(block)
+        for limit, error in limits:
+            if size >= limit:
+                raise error()
+        sha256.update(block)
+        destination.write(block)
+    return size, sha256.hexdigest()
+
+
+def discard_queued_file(app, entry):
+    """
+    Delete the queued file of an ENTRY which won't be processed
+    """
+    app.queue_store.delete_file(entry.queued_media_file)
+    app.queue_store.delete_dir(entry.queued_media_file[:-1])
+
+
 
 def submit_media(mg_app, user, submitted_file, filename,
                  title=None, description=None, collection_slug=None,
@@ -128,18 +182,84 @@ def submit_media(mg_app, user, submitted_file, filename,
     if upload_limit and user.uploaded >= upload_limit:
         raise UserPastUploadLimit()
 
+    entry = queue_media(mg_app, submitted_file, filename,
+                        get_upload_byte_limits(user))
+    feed_url = submit_queued_media(
+        mg_app, user, entry, title=title, description=description,
+        collection_slug=collection_slug, license=license,
+        metadata=metadata, tags_string=tags_string,
+        callback_url=callback_url, urlgen=urlgen)
+
+    # Pass off to processing
+    #
+    # (... don't change entry after this point to avoid race
+    # conditions with changes to the document via processing code)
+    start_processing(mg_app, entry, feed_url)
+
+    return entry
+
+
+def queue_media(mg_app, submitted_file, filename, limits=()):
+    """
+    Copy SUBMITTED_FILE to the queue store and find out its media type,
+    for a new MediaEntry which is returned unsaved
+
+    Nothing here uses the database, so files can be queued by several
+    threads at once.  If the file reaches one of LIMITS (see
+    get_upload_byte_limits) or is of no known type, it is deleted again
+    and the error raised.
+    """
     # If the filename contains non ascii generate a unique name
     if not all(ord(c) < 128 for c in filename):
         filename = str(uuid.uuid4()) + splitext(filename)[-1]
 
-    # Sniff the submitted media to determine which
-    # media plugin should handle processing
-    media_type, media_manager = sniff_media(submitted_file, filename)
+    entry = MediaEntry()
+    entry.title = str(splitext(filename)[0])
+
+    # Queue the file first and sniff it there, so that the upload is only
+    # written to disk once
+    queue_file = prepare_queue_task(mg_app, entry, filename)
 
-    # create entry and save in database
-    entry = new_upload_entry(user)
-    entry.media_type = media_type
-    entry.title = (title or str(splitext(filename)[0]))
+    try:
+        with queue_file:
+            size, entry.file_hash = copy_upload(
+                submitted_file, queue_file, limits)
+
+        # Sniff the submitted media to determine which
+        # media plugin should handle processing
+        with mg_app.queue_store.get_file(
+                entry.queued_media_file, 'rb') as queued_file:
+            entry.media_type, media_manager = sniff_media(
+                queued_file, filename)
+    except (UploadLimitError, FileTypeNotSupported):
+        discard_queued_file(mg_app, entry)
+        raise
+
+    # Get file size and round to 2 decimal places
+    entry.file_size = float(f'{size / (1024.0 * 1024):.2f}')
+    return entry
+
+
+def submit_queued_media(mg_app, user, entry, title=None, description=None,
+                        collection_slug=None, license=None, metadata=None,
+                        tags_string="", callback_url=None, urlgen=None,
+                        commit=True):
+    """
+    Save ENTRY, from queue_media, as media of USER, see submit_media for
+    the other arguments
+
+    Processing is left to the caller, see start_processing, which must
+    wait for the commit if COMMIT is False.  Returns the feed URL to
+    pass on to it.
+    """
+    upload_limit, max_file_size = get_upload_file_limits(user)
+    # Others may have been submitted since the file was queued
+    if upload_limit and (user.uploaded + entry.file_size) >= upload_limit:
+        discard_queued_file(mg_app, entry)
+        raise UserUploadLimit()
+
+    entry.actor = user.id
+    entry.title = title or entry.title
 
     entry.description = description or ""
 
@@ -153,31 +273,11 @@ def submit_media(mg_app, user, submitted_file, filename,
     # Generate a slug from the title
     entry.generate_slug()
 
-    queue_file = prepare_queue_task(mg_app, entry, filename)
-
-    with queue_file:
-        queue_file.write(submitted_file)
-
-    # Get file size and round to 2 decimal places
-    file_size = mg_app.queue_store.get_file_size(
-        entry.queued_media_file) / (1024.0 * 1024)
-    file_size = float(f'{file_size:.2f}')
-
-    # Check if file size is over the limit
-    if max_file_size and file_size >= max_file_size:
-        raise FileUploadLimit()
-
-    # Check if user is over upload limit
-    if upload_limit and (user.uploaded + file_size) >= upload_limit:
-        raise UserUploadLimit()
-
-    user.uploaded = user.uploaded + file_size
-    user.save()
-
-    entry.file_size = file_size
+    user.uploaded = user.uploaded + entry.file_size
+    user.save(commit=commit)
 
     # Save now so we have this data before kicking off processing
-    entry.save()
+    entry.save(commit=commit)
 
     # Various "submit to stuff" things, callbackurl and this silly urlgen
     # thing
@@ -185,7 +285,7 @@ def submit_media(mg_app, user, submitted_file, filename,
         metadata = ProcessingMetaData()
         metadata.media_entry = entry
         metadata.callback_url = callback_url
-        metadata.save()
+        metadata.save(commit=commit)
 
     if urlgen:
         # Generate the public_id, this is very importent, especially relating
@@ -199,26 +299,66 @@ def submit_media(mg_app, user, submitted_file, filename,
     else:
         feed_url = None
 
-    add_comment_subscription(user, entry)
+    add_comment_subscription(user, entry, commit=commit)
 
     # Create activity
-    create_activity("post", entry, entry.actor)
-    entry.save()
+    create_activity("post", entry, entry.actor, commit=commit)
+    entry.save(commit=commit)
 
     # add to collection
     if collection_slug:
         collection = Collection.query.filter_by(slug=collection_slug,
                                                 actor=user.id).first()
         if collection:
-            add_media_to_collection(collection, entry)
+            add_media_to_collection(collection, entry, commit=commit)
 
-    # Pass off to processing
-    #
-    # (... don't change entry after this point to avoid race
-    # conditions with changes to the document via processing code)
-    run_process_media(entry, feed_url)
+    return feed_url
 
-    return entry
+
+def start_processing(app, entry, feed_url=None):
+    """
+    Pass ENTRY off to processing, unless the same file was processed
+    before
+    """
+    if not reuse_processed_media(app, entry, feed_url):
+        run_process_media(entry, feed_url)
+
+
+def reuse_processed_media(app, entry, feed_url=None):
+    """
+    Give ENTRY the files of an entry processed from the same data, if
+    there is one, instead of processing it again
+
+    Returns whether there was one.
+    """
+    if not entry.file_hash:
+        return False
+    # Locked until ENTRY is saved, so the copy can't be deleted with the
+    # files in between: deleting it locks its row before looking for
+    # entries sharing its files, see tools.files.delete_media_files
+    copy = MediaEntry.query.filter(
+        MediaEntry.file_hash == entry.file_hash,
+        MediaEntry.state == 'processed',
+        MediaEntry.media_type == entry.media_type,
+        MediaEntry.id != entry.id).order_by(
+            MediaEntry.id).with_for_update().first()
+    if copy is None:
+        return False
+    MediaFile.query.filter_by(media_entry=copy.id).with_for_update().all()
+
+    _log.info('{} was uploaded before as {}, reusing its files'.format(
+        entry, copy))
+    entry.reuse_files_of(copy)
+    discard_queued_file(app, entry)
+    entry.queued_media_file = None
+    entry.state = 'processed'
+    entry.save()
+
+    # What ProcessMedia does once done
+    if mg_globals.app_config["push_urls"] and feed_url:
+        handle_push_urls.subtask().delay(feed_url)
+    json_processing_callback(entry)
+    return True
 
 
 def prepare_queue_task(app, entry, filename):
@@ -261,18 +401,20 @@ def run_process_media(entry, feed_url=None,
             user=request.user.username)`
     :param reprocess_action: What particular action should be run.
     :param reprocess_info: A dict containing all of the necessary reprocessing
-        info for the given media_type"""
+        info for the given media_type
 
-    entry, manager = get_entry_and_processing_manager(entry.id)
+    Returns the celery result of the processing."""
+
+    manager = get_processing_manager_for_type(entry.media_type)
 
     try:
         wf = manager.workflow(entry, feed_url, reprocess_action, reprocess_info)
         if wf is None:
-            ProcessMedia().apply_async(
+            return ProcessMedia().apply_async(
                 [entry.id, feed_url, reprocess_action, reprocess_info], {},
                 task_id=entry.queued_task_id)
         else:
-            chord(wf[0])(wf[1])
+            return chord(wf[0])(wf[1])
     except BaseException as exc:
         # The purpose of this section is because when running in "lazy"
         # or always-eager-with-exceptions-propagated celery mode that
@@ -299,8 +441,17 @@ def api_upload_request(request, file_data, entry):
     entry.get_public_id(request.urlgen)
 
     queue_file = prepare_queue_task(request.app, entry, file_data.filename)
-    with queue_file:
-        queue_file.write(request.data)
+    try:
+        with queue_file:
+            size, entry.file_hash = copy_upload(
+                file_data.stream, queue_file,
+                get_upload_byte_limits(request.user))
+    except FileUploadLimit:
+        discard_queued_file(request.app, entry)
+        return json_error("File is too large.", status=413)
+    except UserUploadLimit:
+        discard_queued_file(request.app, entry)
+        return json_error("Upload limit reached.", status=413)
 
     entry.save()
     return json_response(entry.serialize(request))
@@ -322,6 +473,6 @@ def api_add_to_feed(request, entry):
         generator=create_generator(request)
     )
     entry.save()
-    run_process_media(entry, feed_url)
+    start_processing(request.app, entry, feed_url)
 
     return activity
@@ -0,0 +1,325 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resumable uploads
+
+An UploadSession collects a file in the queue store chunk by chunk,
+over as many requests as the client likes, so that neither a big upload
+nor a dropped connection needs the whole file in memory or sent again.
+Once complete, its data is submitted like any other upload.
+"""
+
+import datetime
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+from mediagoblin.submit.lib import get_upload_file_limits, FileUploadLimit
+from mediagoblin.tools.cache import MemoryCache
+
+
+_log = logging.getLogger(__name__)
+
+SESSIONS_DIR = 'upload_sessions'
+
+# Chunks are copied in blocks of this size
+BLOCK_SIZE = 64 * 1024
+
+_session_id_matcher = re.compile(r'^[\w-]+$')
+
+# The (offset, hashes) of the data of the sessions this process appended
+# to last.  The data of the others is hashed once they are finished.
+_hashes = MemoryCache(max_entries=100)
+
+
+class UploadSessionError(Exception):
+    """
+    The chunk doesn't fit what the session has received so far
+    """
+    pass
+
+
+class ChecksumMismatch(UploadSessionError):
+    """
+    The data received is not what the client says it sent
+    """
+    pass
+
+
+class UploadSession:
+    """
+    A resumable upload, kept in the queue store until it is finished
+
+    Chunks are written straight to the data file at their offset and
+    the md5 and sha256 of the data are computed as it comes in, as long
+    as it comes to the same process, or else once it is finished.  The
+    state of the session is saved as json next to it.
+
+    Whatever loads a session to change it holds its lock, see lock().
+    """
+
+    def __init__(self, queue_store, session_id, state):
+        self.queue_store = queue_store
+        self.id = session_id
+        self.state = state
+
+    @classmethod
+    def _path(cls, session_id, name):
+        return [SESSIONS_DIR, session_id, name]
+
+    @property
+    def data_path(self):
+        return self._path(self.id, 'data')
+
+    @property
+    def offset(self):
+        """Length of the data received so far"""
+        return self.state['offset']
+
+    @property
+    def size(self):
+        """Length of the whole upload, if the client told"""
+        return self.state['size']
+
+    @property
+    def complete(self):
+        return self.size is not None and self.offset == self.size
+
+    @classmethod
+    def start(cls, queue_store, user, filename, size=None,
+              content_type=None, md5=None, sha256=None, session_id=None):
+        """
+        Start an upload of FILENAME by USER
+
+        SIZE, MD5 and SHA256 are checked as the data comes in or when
+        the upload is finished; SESSION_ID defaults to a new uuid.
+        """
+        upload_limit, max_file_size = get_upload_file_limits(user)
+        max_size = None
+        if max_file_size:
+            max_size = int(max_file_size * 1024 * 1024)
+            if size is not None and size >= max_size:
+                raise FileUploadLimit()
+
+        session = cls(queue_store, session_id or str(uuid.uuid4()), {
+            'user': user.id,
+            'filename': filename,
+            'content_type': content_type,
+            'size': size,
+            'max_size': max_size,
+            'md5': md5 and md5.lower(),
+            'sha256': sha256 and sha256.lower(),
+            'offset': 0,
+            'created': datetime.datetime.utcnow().isoformat()})
+        with queue_store.get_file(session.data_path, 'wb'):
+            pass
+        session.save()
+        _log.info('Started upload session %s for %r', session.id, filename)
+        return session
+
+    @classmethod
+    def _lock_path(cls, queue_store, session_id):
+        if queue_store.local_storage:
+            sessions_dir = queue_store.get_local_path([SESSIONS_DIR])
+        else:
+            sessions_dir = os.path.join(
+                tempfile.gettempdir(), 'mediagoblin_' + SESSIONS_DIR)
+        os.makedirs(sessions_dir, exist_ok=True)
+        return os.path.join(sessions_dir, session_id + '.lock')
+
+    @classmethod
+    @contextmanager
+    def lock(cls, queue_store, session_id):
+        """
+        Keep the other requests (and processes on this machine) from
+        changing the session SESSION_ID meanwhile
+        """
+        if not _session_id_matcher.match(session_id):
+            # There is no such session to protect
+            yield
+            return
+
+        with open(cls._lock_path(queue_store, session_id), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @classmethod
+    def load(cls, queue_store, session_id):
+        """Return the session SESSION_ID, or None if there is none"""
+        if not _session_id_matcher.match(session_id):
+            return None
+        path = cls._path(session_id, 'session.json')
+        if not queue_store.file_exists(path):
+            return None
+        with queue_store.get_file(path, 'rb') as state_file:
+            state = json.loads(state_file.read().decode('utf-8'))
+        return cls(queue_store, session_id, state)
+
+    def save(self):
+        with self.queue_store.get_file(
+                self._path(self.id, 'session.json'), 'wb') as state_file:
+            state_file.write(json.dumps(self.state).encode('utf-8'))
+
+    def delete(self):
+        """Throw the session and its data away"""
+        for name in ('data', 'session.json'):
+            path = self._path(self.id, name)
+            if self.queue_store.file_exists(path):
+                self.queue_store.delete_file(path)
+        self.queue_store.delete_dir([SESSIONS_DIR, self.id])
+        _hashes.delete(self.id)
+
+    def _hashes(self):
+        """The md5 and sha256 of the data received so far"""
+        cached = _hashes.get(self.id)
+        if cached is not None and cached[0] == self.offset:
+            return cached[1]
+
+        hashes = [hashlib.md5(), hashlib.sha256()]
+        remaining = self.offset
+        with self.queue_store.get_file(self.data_path, 'rb') as data:
+            while remaining:
+                block = data.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    raise UploadSessionError(
+                        'Data of upload session %s is missing' % self.id)
+                remaining -= len(block)
+                for hash in hashes:
+                    hash.update(block)
+        return hashes
+
+    def append(self, offset, chunk, md5=None):
+        """
+        Write CHUNK, bytes or a file object, at OFFSET of the upload
+
+        What was received already is skipped, so a chunk may be sent
+        again after a dropped connection, but there may be no gap.  MD5,
+        if given, is checked against the hex digest of the chunk.
+        Returns the length of the data received so far.
+        """
+        if offset > self.offset:
+            raise UploadSessionError(
+                'Expected data from offset %d, not %d' % (self.offset, offset))
+        if isinstance(chunk, bytes):
+            chunk = io.BytesIO(chunk)
+
+        # Only taken over once the chunk turns out fine.  Unless this
+        # process has the hashes of the data so far, they are left to
+        # finish(), rather than reading all of it again for every chunk
+        hashes = None
+        cached = _hashes.get(self.id)
+        if self.offset == 0:
+            hashes = [hashlib.md5(), hashlib.sha256()]
+        elif cached is not None and cached[0] == self.offset:
+            hashes = [hash.copy() for hash in cached[1]]
+        chunk_md5 = hashlib.md5()
+        skip = self.offset - offset
+        received = self.offset
+        with self.queue_store.get_file(self.data_path, 'r+b') as data:
+            data.seek(received)
+            while True:
+                block = chunk.read(BLOCK_SIZE)
+                if not block:
+                    break
+                chunk_md5.update(block)
+                if skip >= len(block):
+                    skip -= len(block)
+                    continue
+                block, skip = block[skip:], 0
+
+                received += len(block)
+                if self.size is not None and received > self.size:
+                    raise UploadSessionError(
+                        'More data than the %d bytes announced' % self.size)
+                if self.state['max_size'] and \
+                        received >= self.state['max_size']:
+                    raise FileUploadLimit()
+
+                data.write(block)
+                for hash in hashes or []:
+                    hash.update(block)
+            # Leftovers of a chunk that failed before
+            data.truncate()
+
+        if md5 and chunk_md5.hexdigest() != md5.lower():
+            raise ChecksumMismatch('Chunk at offset %d is corrupt' % offset)
+
+        self.state['offset'] = received
+        self.save()
+        if hashes is not None:
+            _hashes.set(self.id, (received, hashes))
+        else:
+            _hashes.delete(self.id)
+        return received
+
+    def finish(self):
+        """
+        Check the upload is complete and what the client started it with,
+        and return its data file, opened for reading
+        """
+        if self.size is not None and not self.complete:
+            raise UploadSessionError(
+                'Only %d of %d bytes received' % (self.offset, self.size))
+
+        md5, sha256 = (hash.hexdigest() for hash in self._hashes())
+        if self.state['md5'] and self.state['md5'] != md5:
+            raise ChecksumMismatch('md5 of the upload is %s' % md5)
+        if self.state['sha256'] and self.state['sha256'] != sha256:
+            raise ChecksumMismatch('sha256 of the upload is %s' % sha256)
+        return self.queue_store.get_file(self.data_path, 'rb')
+
+
+def clean_upload_sessions(queue_store, max_age=datetime.timedelta(days=1)):
+    """
+    Delete the upload sessions started more than MAX_AGE ago
+
+    Only local queue stores can be searched for them.
+    """
+    if not queue_store.local_storage:
+        return
+
+    sessions_dir = queue_store.get_local_path([SESSIONS_DIR])
+    if not os.path.isdir(sessions_dir):
+        return
+
+    cutoff = (datetime.datetime.utcnow() - max_age).isoformat()
+    for session_id in os.listdir(sessions_dir):
+        session = UploadSession.load(queue_store, session_id)
+        if session is not None and session.state['created'] < cutoff:
+            _log.info('Deleting abandoned upload session %s', session_id)
+            session.delete()
+
+    # The lock files stay with the sessions gone, as somebody may be
+    # waiting on them, until nobody could be any more
+    for name in os.listdir(sessions_dir):
+        session_id, ext = os.path.splitext(name)
+        path = os.path.join(sessions_dir, name)
+        if ext == '.lock' and \
+                UploadSession.load(queue_store, session_id) is None and \
+                datetime.datetime.utcfromtimestamp(
+                    os.path.getmtime(path)).isoformat() < cutoff:
+            os.remove(path)
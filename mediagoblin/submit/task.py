@@ -18,7 +18,9 @@ import celery
 import datetime
 import pytz
 
+from mediagoblin import mg_globals
 from mediagoblin.db.models import MediaEntry
+from mediagoblin.submit.resumable import clean_upload_sessions
 
 @celery.shared_task()
 def collect_garbage():
@@ -36,3 +38,6 @@ def collect_garbage():
 
     for entry in garbage.all():
         entry.delete()
+
+    # Uploads nobody finished
+    clean_upload_sessions(mg_globals.queue_store)
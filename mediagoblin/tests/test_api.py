@@ -13,7 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
 import json
+import threading
 
 try:
     from unittest import mock
@@ -26,6 +28,7 @@ from webtest import AppError
 from .resources import GOOD_JPG
 from mediagoblin import mg_globals
 from mediagoblin.db.models import User, MediaEntry, TextComment
+from mediagoblin.submit import resumable
 from mediagoblin.tests.tools import fixture_add_user
 from mediagoblin.moderation.tools import take_away_privileges
 
@@ -180,6 +183,142 @@ class TestAPI:
         assert response.status_code == 200
         assert data["object"]["tags"] == ["hello", "world"]
 
+    def test_resumable_upload(self, test_app):
+        """ Tests an image can be uploaded in chunks, over several requests """
+        data = open(GOOD_JPG, "rb").read()
+        headers = {
+            "Content-Type": "image/jpeg",
+            "X-File-Name": "chunked.jpg",
+            "X-Upload-Content-Length": str(len(data)),
+            "X-Upload-Content-SHA256": hashlib.sha256(data).hexdigest(),
+        }
+
+        with self.mock_oauth():
+            response = test_app.post(
+                f"/api/user/{self.active_user.username}/uploads",
+                headers=headers
+            )
+            assert response.status_code == 201
+            session = json.loads(response.body.decode())
+            assert session["offset"] == 0
+            url = session["url"]
+
+            half = len(data) // 2
+            response = test_app.put(url, data[:half], headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"bytes 0-{half - 1}/{len(data)}",
+            })
+            assert json.loads(response.body.decode())["offset"] == half
+
+            # After a dropped connection the client asks where to go on
+            response = test_app.get(url)
+            assert json.loads(response.body.decode())["offset"] == half
+
+            # A gap is refused
+            with pytest.raises(AppError) as excinfo:
+                test_app.put(url, data[half + 1:], headers={
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range":
+                        f"bytes {half + 1}-{len(data) - 1}/{len(data)}",
+                })
+            assert "409 CONFLICT" in excinfo.value.args[0]
+
+            response = test_app.put(url, data[half:], headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"bytes {half}-{len(data) - 1}/{len(data)}",
+                "X-Upload-Chunk-MD5": hashlib.md5(data[half:]).hexdigest(),
+            })
+            image = json.loads(response.body.decode())
+            assert image["objectType"] == "image"
+
+            # The session is gone with its upload
+            with pytest.raises(AppError) as excinfo:
+                test_app.get(url)
+            assert "404 NOT FOUND" in excinfo.value.args[0]
+
+        media = MediaEntry.query.filter_by(title="chunked.jpg").one()
+        with mg_globals.queue_store.get_file(
+                media.queued_media_file, "rb") as queued:
+            assert queued.read() == data
+
+    def test_resumable_upload_elsewhere(self, test_app):
+        """ Tests chunks handled by other processes are checked at the end """
+        data = open(GOOD_JPG, "rb").read()
+        headers = {
+            "Content-Type": "image/jpeg",
+            "X-File-Name": "chunked.jpg",
+            "X-Upload-Content-Length": str(len(data)),
+            "X-Upload-Content-SHA256": hashlib.sha256(b"other").hexdigest(),
+        }
+
+        with self.mock_oauth():
+            response = test_app.post(
+                f"/api/user/{self.active_user.username}/uploads",
+                headers=headers
+            )
+            session = json.loads(response.body.decode())
+
+            half = len(data) // 2
+            hashes = mock.patch.object(
+                resumable.UploadSession, "_hashes", autospec=True,
+                side_effect=resumable.UploadSession._hashes)
+            with hashes as hashed:
+                test_app.put(session["url"], data[:half], headers={
+                    "Content-Type": "application/octet-stream",
+                })
+                # As if the next chunk went to another process
+                resumable._hashes.delete(session["id"])
+                with pytest.raises(AppError) as excinfo:
+                    test_app.put(session["url"], data[half:], headers={
+                        "Content-Type": "application/octet-stream",
+                    })
+            assert "422 UNPROCESSABLE ENTITY" in excinfo.value.args[0]
+            # The data is read through once, not for every chunk
+            assert hashed.call_count == 1
+
+    def test_upload_session_lock(self, test_app):
+        """ Tests a session is changed by one request at a time """
+        order = []
+
+        def other_request():
+            with resumable.UploadSession.lock(
+                    mg_globals.queue_store, "some-session"):
+                order.append("other")
+
+        with resumable.UploadSession.lock(
+                mg_globals.queue_store, "some-session"):
+            thread = threading.Thread(target=other_request)
+            thread.start()
+            thread.join(0.2)
+            order.append("first")
+        thread.join()
+        assert order == ["first", "other"]
+
+    def test_upload_seen_before(self, test_app):
+        """ Tests an image uploaded again reuses the files of the first """
+        response, image = self._upload_image(test_app, GOOD_JPG)
+        self._post_image_to_feed(test_app, image)
+
+        response, image = self._upload_image(test_app, GOOD_JPG)
+        with mock.patch("mediagoblin.submit.lib.run_process_media") as run:
+            self._post_image_to_feed(test_app, image)
+        assert not run.called
+
+        first, second = MediaEntry.query.order_by(MediaEntry.id).all()
+        assert second.state == "processed"
+        assert second.queued_media_file is None
+        assert dict(second.media_files) == dict(first.media_files)
+        assert second.media_data.width == first.media_data.width
+
+        # The files stay while an entry still uses them
+        filepaths = list(first.media_files.values())
+        first.delete()
+        for filepath in filepaths:
+            assert mg_globals.public_store.file_exists(filepath)
+        second.delete()
+        for filepath in filepaths:
+            assert not mg_globals.public_store.file_exists(filepath)
+
     def test_unable_to_upload_as_someone_else(self, test_app):
         """ Test that can't upload as someoen else """
         data = open(GOOD_JPG, "rb").read()
@@ -384,6 +523,82 @@ class TestAPI:
         # Test that the response is what we should be given
         assert comment.content == comment_data["object"]["content"]
 
+    def test_comments_are_capped(self, test_app):
+        """ Tests only the newest comments are embedded in the media """
+        response, data = self._upload_image(test_app, GOOD_JPG)
+        response, data = self._post_image_to_feed(test_app, data)
+
+        for number in range(3):
+            activity = {
+                "verb": "post",
+                "object": {
+                    "objectType": "comment",
+                    "content": f"Comment number {number}",
+                    "inReplyTo": data["object"],
+                }
+            }
+            self._activity_to_feed(test_app, activity)
+
+        object_uri = data["object"]["links"]["self"]["href"]
+
+        limit = mg_globals.app_config["api_comments_limit"]
+        mg_globals.app_config["api_comments_limit"] = 2
+        try:
+            with self.mock_oauth():
+                response = test_app.get(object_uri)
+        finally:
+            mg_globals.app_config["api_comments_limit"] = limit
+
+        replies = json.loads(response.body.decode())["replies"]
+        assert replies["totalItems"] == 3
+        assert [comment["content"] for comment in replies["items"]] == [
+            "Comment number 2", "Comment number 1"]
+        for comment in replies["items"]:
+            assert comment["inReplyTo"]["id"] == data["object"]["id"]
+            assert comment["author"]["id"] == "acct:{}@localhost".format(
+                self.user.username)
+
+    def test_comments_are_paged(self, test_app):
+        """ Tests all the comments can be had from the replies url """
+        response, data = self._upload_image(test_app, GOOD_JPG)
+        response, data = self._post_image_to_feed(test_app, data)
+
+        for number in range(3):
+            activity = {
+                "verb": "post",
+                "object": {
+                    "objectType": "comment",
+                    "content": f"Comment number {number}",
+                    "inReplyTo": data["object"],
+                }
+            }
+            self._activity_to_feed(test_app, activity)
+
+        # The comments are looked up by the public id of the media
+        comments_uri = data["object"]["links"]["self"]["href"] + "comments/"
+
+        limit = mg_globals.app_config["api_comments_limit"]
+        mg_globals.app_config["api_comments_limit"] = 1
+        try:
+            with self.mock_oauth():
+                response = test_app.get(comments_uri, {"count": 2})
+                first_page = json.loads(response.body.decode())
+                response = test_app.get(first_page["links"]["next"])
+                second_page = json.loads(response.body.decode())
+        finally:
+            mg_globals.app_config["api_comments_limit"] = limit
+
+        assert first_page["totalItems"] == 3
+        assert [comment["content"] for comment in first_page["items"]] == [
+            "Comment number 2", "Comment number 1"]
+        assert "prev" not in first_page["links"]
+
+        assert [comment["content"] for comment in second_page["items"]] == [
+            "Comment number 0"]
+        assert "next" not in second_page["links"]
+        assert second_page["links"]["prev"] == comments_uri + \
+            "?count=2&offset=0"
+
     def test_unable_to_post_comment_as_someone_else(self, test_app):
         """ Tests that you're unable to post a comment as someone else. """
         # Upload some media to comment on
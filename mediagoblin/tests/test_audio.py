@@ -22,6 +22,10 @@ from contextlib import contextmanager
 import logging
 import imghdr
 
+import numpy
+import soundfile
+from PIL import Image
+
 #os.environ['GST_DEBUG'] = '4,python:4'
 
 pytest.importorskip("gi.repository.Gst")
@@ -31,7 +35,9 @@ from gi.repository import Gst
 Gst.init(None)
 
 from mediagoblin.media_types.audio.transcoders import (AudioTranscoder,
-        AudioThumbnailer)
+        AudioThumbnailer, GstPCMSource)
+from mediagoblin.media_types.audio.audiotospectrogram import (
+        SoundFileSource, drawSpectrogram, SPECTROGRAM_HEIGHT)
 from mediagoblin.media_types.tools import discover
 
 
@@ -102,3 +108,85 @@ def test_thumbnails():
         thumbnailer.spectrogram(new_name, thumbnail.name, width=100,
                                 fft_size=4096)
         assert imghdr.what(thumbnail.name) == 'jpeg'
+
+
+def test_gstreamer_spectrogram():
+    '''Test a spectrogram is drawn of what only GStreamer can decode'''
+    transcoder = AudioTranscoder()
+    with create_data_for_test() as (audio_name, new_name):
+        transcoder.transcode(audio_name, new_name, mux_name='webmmux')
+        with pytest.raises(RuntimeError):
+            SoundFileSource(new_name)
+
+        source = GstPCMSource(new_name)
+        spectrogram = tempfile.NamedTemporaryFile(suffix='.png')
+        drawSpectrogram(source, spectrogram.name, fftSize=1024)
+        assert imghdr.what(spectrogram.name) == 'png'
+        with Image.open(spectrogram.name) as image:
+            width, height = image.size
+        assert height == SPECTROGRAM_HEIGHT
+        # A column per block of a second or so of audio
+        assert width >= source.totalSamples // 1024 - 1
+
+
+class BrokenSink:
+    '''An appsink whose decoder failed before the end'''
+    def emit(self, signal):
+        return None
+
+    def get_property(self, name):
+        assert name == 'eos'
+        return False
+
+
+def test_gstreamer_decoding_error():
+    '''Test a decoding error isn't taken for the end of the audio'''
+    with create_audio() as audio_name:
+        source = GstPCMSource(audio_name)
+        source.appsink = BrokenSink()
+        with pytest.raises(Exception) as excinfo:
+            list(source.blocks(1024, 0))
+        assert 'Decoding stopped before the end' in str(excinfo.value)
+
+
+def _sine_wav(channels):
+    '''One second of a 2 kHz sine at 16 kHz, as a wav file'''
+    rate = 16000
+    signal = numpy.sin(2 * numpy.pi * 2000 * numpy.arange(rate) / rate)
+    audio = tempfile.NamedTemporaryFile(suffix='.wav')
+    soundfile.write(audio.name, numpy.tile(signal[:, None], channels), rate)
+    return audio
+
+
+def _draw_spectrogram(audio_name):
+    spectrogram = tempfile.NamedTemporaryFile(suffix='.png')
+    drawSpectrogram(audio_name, spectrogram.name, fftSize=1024)
+    with Image.open(spectrogram.name) as image:
+        return numpy.asarray(image.convert('RGB'))
+
+
+def test_spectrogram_of_sine():
+    '''Test the spectrogram of a pure tone, of mono and stereo audio'''
+    with _sine_wav(1) as mono:
+        pixels = _draw_spectrogram(mono.name)
+    # A column per block of 1024 samples, as there are fewer than the
+    # 240 pixels per second short sounds get
+    assert pixels.shape == (SPECTROGRAM_HEIGHT, 16, 3)
+
+    # The tone is the brightest, white, row of each column. It is in
+    # FFT bin 2000 / (16000 / 1024) = 128 of 513, bin 127 once those
+    # under 20 Hz are dropped, which goes to bin 114 of the 500 rows as
+    # the first 13 of them take two bins.  The lowest row is at the
+    # bottom.
+    brightness = pixels.astype(int).sum(axis=2)
+    assert (brightness.argmax(axis=0) == SPECTROGRAM_HEIGHT - 1 - 114).all()
+    # The last block is padded with silence, the others are all alike
+    full = brightness[:, :15]
+    assert (full == full[:, :1]).all()
+    assert (full.max(axis=0) >= 3 * 250).all()
+    # Far above it, it is dark
+    assert (full[:50] < 3 * 100).all()
+
+    # Channels are mixed down, the same tone on two looks the same
+    with _sine_wav(2) as stereo:
+        assert (_draw_spectrogram(stereo.name) == pixels).all()
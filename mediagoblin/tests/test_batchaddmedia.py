@@ -0,0 +1,135 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2013 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+import shutil
+
+import pytest
+
+from mediagoblin import mg_globals
+from mediagoblin.db.models import MediaEntry
+from mediagoblin.gmg_commands import batchaddmedia as command
+from mediagoblin.gmg_commands import util as commands_util
+from .resources import GOOD_JPG, GOOD_PNG, MED_PNG
+from .tools import fixture_add_user
+
+
+class TestBatchAddMedia:
+    @pytest.fixture(autouse=True)
+    def setup(self, test_app, tmpdir, monkeypatch):
+        self.test_app = test_app
+        self.user = fixture_add_user()
+        monkeypatch.setattr(
+            commands_util, 'setup_app', lambda args: mg_globals.app)
+        # Set by the command
+        monkeypatch.setenv('CELERY_ALWAYS_EAGER', 'true')
+
+        self.tmpdir = str(tmpdir)
+        lines = ['location,dc:title']
+        for index, path in enumerate([GOOD_JPG, GOOD_PNG, MED_PNG]):
+            filename = 'file%d%s' % (index, os.path.splitext(path)[1])
+            shutil.copy(path, os.path.join(self.tmpdir, filename))
+            lines.append('{},Row {}'.format(filename, index))
+        self.metadata_path = os.path.join(self.tmpdir, 'metadata.csv')
+        with open(self.metadata_path, 'w') as metadata:
+            metadata.write('\n'.join(lines) + '\n')
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+
+    def run_command(self, **kwargs):
+        args = dict(
+            username='chris', metadata_path=self.metadata_path,
+            celery=False, parallel=1, batch_size=1, checkpoint=None,
+            dry_run=False)
+        args.update(kwargs)
+        command.batchaddmedia(argparse.Namespace(**args))
+
+    def titles(self):
+        return sorted(entry.title for entry in MediaEntry.query)
+
+    def test_batches(self):
+        self.run_command(batch_size=2, parallel=2)
+        assert self.titles() == ['Row 0', 'Row 1', 'Row 2']
+        assert all(entry.state == 'processed' for entry in MediaEntry.query)
+
+    def test_resume(self, monkeypatch):
+        submit_queued_media = command.submit_queued_media
+        calls = []
+
+        def failing_submit(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 3:
+                raise RuntimeError('interrupted')
+            return submit_queued_media(*args, **kwargs)
+
+        monkeypatch.setattr(command, 'submit_queued_media', failing_submit)
+        with pytest.raises(RuntimeError):
+            self.run_command(batch_size=2, checkpoint=self.checkpoint)
+        # The first batch is in, and recorded as such
+        assert self.titles() == ['Row 0', 'Row 1']
+        assert command._read_checkpoint(self.checkpoint) == 2
+
+        monkeypatch.setattr(
+            command, 'submit_queued_media', submit_queued_media)
+        self.run_command(batch_size=2, checkpoint=self.checkpoint)
+        assert self.titles() == ['Row 0', 'Row 1', 'Row 2']
+        assert not os.path.exists(self.checkpoint)
+
+    def test_processing_failure(self, monkeypatch, capsys):
+        start_processing = command.start_processing
+        calls = []
+
+        def failing_start(app, entry, *args):
+            calls.append(entry.id)
+            if len(calls) == 1:
+                raise RuntimeError('broken')
+            return start_processing(app, entry, *args)
+
+        monkeypatch.setattr(command, 'start_processing', failing_start)
+        self.run_command(batch_size=2, checkpoint=self.checkpoint)
+        assert 'could not be processed: broken' in capsys.readouterr().out
+
+        # The run carried on, and kept the files of what was committed
+        assert len(calls) == 3
+        entries = MediaEntry.query.order_by(MediaEntry.id).all()
+        assert [entry.title for entry in entries] == [
+            'Row 0', 'Row 1', 'Row 2']
+        assert [entry.state for entry in entries] == [
+            'unprocessed', 'processed', 'processed']
+        assert mg_globals.app.queue_store.file_exists(
+            entries[0].queued_media_file)
+        assert not os.path.exists(self.checkpoint)
+
+    def test_dry_run(self, capsys):
+        self.run_command(dry_run=True, checkpoint=self.checkpoint)
+        assert MediaEntry.query.count() == 0
+        assert not os.path.exists(self.checkpoint)
+        assert capsys.readouterr().out.count('can be submitted') == 3
+
+
+def test_imap_discards_unused_results():
+    computed, discarded = [], []
+
+    def double(item):
+        computed.append(item)
+        return item * 2
+
+    results = command._imap(double, range(10), 2, discarded.append)
+    assert next(results) == 0
+    results.close()
+    # What was computed all the same is handed back, the rest never runs
+    assert sorted(discarded) == [item * 2 for item in sorted(computed)[1:]]
+    assert len(computed) <= 4
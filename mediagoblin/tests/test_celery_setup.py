@@ -50,7 +50,8 @@ def test_setup_celery_from_config():
     assert fake_celery_module.CELERY_IMPORTS == [
         'foo.bar.baz', 'this.is.an.import', 'mediagoblin.processing.task',
         'mediagoblin.notifications.task', 'mediagoblin.submit.task',
-        'mediagoblin.media_types.video.processing']
+        'mediagoblin.media_types.video.processing',
+        'mediagoblin.tools.files']
     assert fake_celery_module.CELERY_RESULT_BACKEND == 'database'
     assert fake_celery_module.CELERY_RESULT_DBURI == (
         'sqlite:///' +
@@ -1,4 +1,10 @@
-from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
+from unittest import mock
+
+from mediagoblin.db.models import MediaEntry, TextComment
+from mediagoblin.tests.tools import (
+    fixture_add_user, fixture_media_entry, fixture_add_collection,
+    fixture_add_comment)
+from mediagoblin.user_pages.lib import add_media_to_collection
 
 
 class TestFeeds:
@@ -17,3 +23,76 @@ class TestFeeds:
         res = test_app.get('/u/terence/atom/')
         assert res.status_int == 200
         assert res.content_type == 'application/atom+xml'
+
+
+def test_feed_not_modified(test_app):
+    user = fixture_add_user(username='terence', privileges=['active'])
+    fixture_media_entry(uploader=user.id, state='processed')
+
+    res = test_app.get('/atom/')
+    etag = res.headers['ETag']
+    last_modified = res.headers['Last-Modified']
+    res = test_app.get('/atom/', headers={'If-None-Match': etag})
+    assert res.status_int == 304
+    assert res.body == b''
+    res = test_app.get('/atom/', headers={'If-Modified-Since': last_modified})
+    assert res.status_int == 304
+
+    fixture_media_entry(uploader=user.id, state='processed')
+    res = test_app.get('/atom/', headers={'If-None-Match': etag})
+    assert res.status_int == 200
+    assert res.headers['ETag'] != etag
+
+
+def test_feed_entries_reused(test_app):
+    user = fixture_add_user(username='terence', privileges=['active'])
+    media_id = fixture_media_entry(
+        title='First title', uploader=user.id, state='processed').id
+
+    feed = test_app.get('/atom/').body
+    assert b'First title' in feed
+    with mock.patch('mediagoblin.tools.feeds.get_media_file_paths') as paths:
+        assert test_app.get('/atom/').body == feed
+    assert not paths.called
+
+    media = MediaEntry.query.get(media_id)
+    media.title = 'Second title'
+    media.save()
+    feed = test_app.get('/atom/').body
+    assert b'First title' not in feed
+    assert b'Second title' in feed
+
+
+def test_media_page_not_modified(test_app):
+    user = fixture_add_user(username='terence', privileges=['active'])
+    media = fixture_media_entry(uploader=user.id, state='processed',
+                                expunge=False)
+    media_id = media.id
+    url = '/u/terence/m/{}/'.format(media.slug)
+    text_comment = fixture_add_comment(author=user.id, media_entry=media)
+    text_comment_id = text_comment.id
+
+    def etag_changes(etag):
+        res = test_app.get(url, headers={'If-None-Match': etag})
+        if res.status_int == 304:
+            return False
+        assert res.headers['ETag'] != etag
+        return True
+
+    etag = test_app.get(url).headers['ETag']
+    assert not etag_changes(etag)
+
+    # A newer upload shows up in the links to the neighbours
+    fixture_media_entry(uploader=user.id, state='processed')
+    assert etag_changes(etag)
+
+    etag = test_app.get(url).headers['ETag']
+    collection = fixture_add_collection(user=user)
+    add_media_to_collection(collection, MediaEntry.query.get(media_id))
+    assert etag_changes(etag)
+
+    etag = test_app.get(url).headers['ETag']
+    text_comment = TextComment.query.get(text_comment_id)
+    text_comment.content = 'Edited comment'
+    text_comment.save()
+    assert etag_changes(etag)
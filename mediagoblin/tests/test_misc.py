@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
 import pytz
 import datetime
 
@@ -21,7 +23,7 @@ from werkzeug.datastructures import FileStorage
 
 from .resources import GOOD_JPG
 from mediagoblin.db.base import Session
-from mediagoblin.media_types import sniff_media
+from mediagoblin.media_types import sniff_media, LazyNamedFile
 from mediagoblin.submit.lib import new_upload_entry
 from mediagoblin.submit.task import collect_garbage
 from mediagoblin.db.models import User, MediaEntry, TextComment, Comment
@@ -169,3 +171,24 @@ def test_comments_removed_when_graveyarded(test_app):
     # Verify this also deleted the Comment link, ergo there is no comment left.
     assert Comment.query.filter_by(target_id=link.target_id).first() is None
  
+
+
+def test_sniffing_copies_uploads_lazily():
+    """ Checks files are only copied for sniffing when really needed """
+    # Files on disk are sniffed where they are
+    with open(GOOD_JPG, 'rb') as media_file:
+        with LazyNamedFile(media_file) as sniff_file:
+            assert sniff_file.name == GOOD_JPG
+            assert sniff_file.tmp_media_file is None
+
+    # Others get copied once a sniffer wants a name on disk
+    with open(GOOD_JPG, 'rb') as media_file:
+        data = media_file.read()
+    file_data = FileStorage(stream=io.BytesIO(data), filename="mah_test.jpg")
+    with LazyNamedFile(file_data) as sniff_file:
+        assert sniff_file.tmp_media_file is None
+        with open(sniff_file.name, 'rb') as tmp_file:
+            assert tmp_file.read() == data
+        assert file_data.stream.tell() == 0
+        tmp_name = sniff_file.name
+    assert not os.path.exists(tmp_name)
@@ -20,17 +20,23 @@
 
 from mediagoblin.db.base import Session
 from mediagoblin.db.models import MediaEntry, User, LocalUser, Privilege, \
-                                  Activity, Generator
+                                  Activity, Generator, Collection, \
+                                  MediaStateCount, Graveyard, Tag, \
+                                  GenericModelReference, Comment
+from mediagoblin.db.util import preload_media_files, preload_references, \
+                                rebuild_counters, delete_media_entries
 
 from mediagoblin.tests import MGClientTestCase
 from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry, \
-                                    fixture_add_activity
+                                    fixture_add_activity, fixture_add_collection, \
+                                    fixture_add_comment
 
 try:
     from unittest import mock
 except ImportError:
     import unittest.mock as mock
 import pytest
+from sqlalchemy import event
 
 
 class FakeUUID:
@@ -197,6 +203,215 @@ class TestUserHasPrivilege:
         # Test that we can look this out ignoring that she's an admin
         assert not self.natalie_user.has_privilege('commenter', allow_admin=False)
 
+    def test_privileges_queried_once(self, test_app):
+        self._setup()
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = Session.get_bind()
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            for privilege in ('admin', 'active', 'commenter', 'uploader'):
+                self.natalie_user.has_privilege(privilege)
+                self.aeva_user.has_privilege(privilege)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        # One load of all_privileges per user
+        assert len(statements) == 2
+
+def test_file_metadata_from_preloaded_files(test_app):
+    user = fixture_add_user('kai')
+    entry_ids = []
+    for i in range(3):
+        entry = fixture_media_entry(uploader=user.id, expunge=False,
+                                    title='Media {}'.format(i))
+        entry.set_file_metadata('thumb', width=i)
+        entry.set_file_metadata('medium', width=10 * i)
+        entry_ids.append(entry.id)
+    Session.remove()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = Session.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        entries = preload_media_files(
+            MediaEntry.query.filter(MediaEntry.id.in_(entry_ids))
+            .order_by(MediaEntry.id))
+        widths = [(entry.get_file_metadata('thumb', 'width'),
+                   entry.get_file_metadata('medium')['width'],
+                   entry.get_file_metadata('original'))
+                  for entry in entries]
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    assert widths == [(0, 0, None), (1, 10, None), (2, 20, None)]
+    # One query for the entries, one for all of their files
+    assert len(statements) == 2
+
+
+def test_references_resolved_in_bulk(test_app):
+    user = fixture_add_user('kai')
+    collection = fixture_add_collection(user=user)
+    for i in range(3):
+        entry = fixture_media_entry(uploader=user.id, expunge=False,
+                                    title='Media {}'.format(i))
+        activity = Activity(verb='post', actor=user.id)
+        activity.object = entry
+        activity.target = collection
+        activity.save()
+    Session.remove()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = Session.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        activities = preload_references(
+            Activity.query.order_by(Activity.id),
+            'object_helper', 'target_helper')
+        resolved = [(activity.object().title, activity.target().title)
+                    for activity in activities]
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    assert resolved == [('Media {}'.format(i), collection.title)
+                        for i in range(3)]
+    # The activities, their references, the media and the collection
+    assert len(statements) == 4
+
+
+def test_counters(test_app):
+    user = fixture_add_user('kai')
+    collection = Collection.query.get(fixture_add_collection(user=user).id)
+    media = fixture_media_entry(uploader=user.id, expunge=False)
+    other = fixture_media_entry(uploader=user.id, title='Other',
+                                state='processed', expunge=False)
+    assert MediaStateCount.for_user(user.id) == {
+        'unprocessed': 1, 'processed': 1}
+
+    comments = [fixture_add_comment(user.id, media) for i in range(3)]
+    collection.add_to_collection(media)
+    collection.add_to_collection(other)
+    assert media.comment_count == 3
+    assert collection.num_items == 2
+
+    comments[0].delete()
+    other.delete()
+    assert media.comment_count == 2
+    assert collection.num_items == 1
+
+    media.state = 'processing'
+    media.save()
+    assert MediaStateCount.for_user(user.id) == {
+        'unprocessed': 0, 'processed': 0, 'processing': 1}
+
+    # Counters that drifted are set right again
+    MediaEntry.query.update({'comment_count': 7})
+    Collection.query.update({'num_items': None})
+    MediaStateCount.query.delete()
+    rebuild_counters()
+    assert media.comment_count == 2
+    assert collection.num_items == 1
+    assert MediaStateCount.for_user(user.id) == {'processing': 1}
+
+
+def test_media_neighbours(test_app):
+    user = fixture_add_user('kai')
+    entries = [fixture_media_entry(uploader=user.id, state='processed',
+                                   title='Media {}'.format(i), expunge=False)
+               for i in range(3)]
+    fixture_media_entry(uploader=user.id, title='Failed', state='failed')
+    fixture_media_entry(uploader=fixture_add_user('bob').id,
+                        state='processed')
+    urlgen = lambda endpoint, **kw: '/u/{user}/m/{media}/'.format(**kw)
+
+    first, middle, last = entries
+    # As on its page, the entry and its uploader are loaded already
+    assert middle.get_actor.username == 'kai'
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = Session.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        assert middle.url_to_prev(urlgen) == '/u/kai/m/media-2/'
+        assert middle.url_to_next(urlgen) == '/u/kai/m/media-0/'
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert len(statements) == 1
+
+    assert first.url_to_next(urlgen) is None
+    assert first.url_to_prev(urlgen) == '/u/kai/m/media-1/'
+    assert last.url_to_prev(urlgen) is None
+    assert last.neighbours == (None, (middle.id, 'media-1'))
+
+
+def test_delete_media_entries(test_app):
+    user = fixture_add_user('kai')
+    collection = Collection.query.get(fixture_add_collection(user=user).id)
+    entries = []
+    for i in range(3):
+        entry = fixture_media_entry(uploader=user.id, state='processed',
+                                    title='Media {}'.format(i),
+                                    expunge=False)
+        entry.tags = [{'name': 'Tag {}'.format(i), 'slug': 'tag-%d' % i}]
+        entry.save()
+        fixture_add_comment(user.id, entry)
+        collection.add_to_collection(entry)
+        entries.append(entry)
+    kept = entries.pop()
+    # Only the original is the same upload
+    kept.media_files['thumb'] = ['k', 'thumb.jpg']
+    kept.media_files['medium'] = ['k', 'medium.jpg']
+    kept.save()
+    ids = [entry.id for entry in entries]
+    public_ids = []
+    for entry in entries:
+        entry.public_id = 'http://localhost/media/{}/'.format(entry.id)
+        entry.save()
+        public_ids.append(entry.public_id)
+    GenericModelReference.find_or_new(entries[0]).save()
+
+    with mock.patch(
+            'mediagoblin.tools.files.delete_files_task.delay') as delay:
+        delete_media_entries(ids)
+
+    assert MediaEntry.query.filter(MediaEntry.id.in_(ids)).count() == 0
+    assert collection.num_items == 1
+    assert kept.comment_count == 1
+    assert Comment.query.count() == 1
+    assert MediaStateCount.for_user(user.id) == {'processed': 1}
+    assert [tag.slug for tag in Tag.query] == ['tag-2']
+
+    # Whatever referred to the entries now finds their tombstones
+    assert sorted(tombstone.public_id for tombstone in
+                  Graveyard.query.filter_by(object_type='image')) == \
+        sorted(public_ids)
+    assert GenericModelReference.query.filter_by(
+        model_type=MediaEntry.__tablename__).count() == 1
+    assert sorted(ref.get_object().public_id for ref in
+                  GenericModelReference.query.filter_by(
+                      model_type=Graveyard.__tablename__)) == \
+        sorted(public_ids)
+
+    # Their files are deleted from storage after the commit, but for
+    # those the kept entry uses too
+    filepaths, = delay.call_args[0]
+    assert sorted(filepaths) == [('a', 'b', 'c.jpg'), ('d', 'e', 'f.png')]
+
+
 def test_media_data_init(test_app):
     Session.rollback()
     Session.remove()
@@ -0,0 +1,128 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+import celery
+import pkg_resources
+import pytest
+
+from mediagoblin.db.models import MediaEntry
+from mediagoblin.init import ImproperlyConfigured
+from mediagoblin.meddleware.page_cache import PageCacheMeddleware
+from mediagoblin.tests.tools import (
+    get_app, fixture_add_user, fixture_media_entry)
+from mediagoblin.tools import template
+from mediagoblin.tools.cache import MemoryCache, FileSystemCache
+
+
+@pytest.fixture()
+def page_cache_app(request):
+    return get_app(
+        request,
+        mgoblin_config=pkg_resources.resource_filename(
+            'mediagoblin.tests', 'appconfig_page_cache.ini'))
+
+
+def test_anonymous_pages_cached(page_cache_app):
+    fixture_add_user('chris', privileges=['active', 'uploader'])
+    media = fixture_media_entry(title='First title', state='processed',
+                                expunge=False)
+    media_id = media.id
+    url = '/u/chris/m/{}/'.format(media.slug)
+
+    template.clear_test_template_context()
+    response = page_cache_app.get(url)
+    assert 'mediagoblin/media_displays/image.html' in \
+        template.TEMPLATE_TEST_CONTEXT
+    assert b'First title' in response.body
+
+    # Served from the cache, without rendering or cookies
+    template.clear_test_template_context()
+    cached = page_cache_app.get(url)
+    assert template.TEMPLATE_TEST_CONTEXT == {}
+    assert cached.body == response.body
+    assert 'Set-Cookie' not in cached.headers
+    assert cached.headers['Vary'] == 'Cookie'
+
+    # Changing the media expires the page
+    media = MediaEntry.query.get(media_id)
+    media.title = 'Second title'
+    media.save()
+    template.clear_test_template_context()
+    response = page_cache_app.get(url)
+    assert 'mediagoblin/media_displays/image.html' in \
+        template.TEMPLATE_TEST_CONTEXT
+    assert b'Second title' in response.body
+
+
+def test_logged_in_pages_not_cached(page_cache_app):
+    fixture_add_user('chris', privileges=['active', 'uploader'])
+    page_cache_app.post('/auth/login/', {
+        'username': 'chris',
+        'password': 'toast'})
+
+    for i in range(2):
+        template.clear_test_template_context()
+        page_cache_app.get('/')
+        assert 'mediagoblin/root.html' in template.TEMPLATE_TEST_CONTEXT
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    cache.set('d', 4, timeout=0.01)
+    time.sleep(0.02)
+    assert cache.get('d') is None
+
+
+def test_filesystem_cache(tmpdir):
+    cache = FileSystemCache(str(tmpdir), max_entries=10)
+    cache.set('page', {'body': b'<html/>'})
+    assert cache.get('page') == {'body': b'<html/>'}
+    assert FileSystemCache(str(tmpdir)).get('page') == {'body': b'<html/>'}
+
+    cache.delete('page')
+    assert cache.get('page') is None
+
+    for i in range(11):
+        cache.set(str(i), i)
+    assert len(tmpdir.listdir()) <= 10
+
+
+def test_memory_backend_needs_one_process(page_cache_app):
+    mg_app = page_cache_app.app
+    config = mg_app.global_config['page_cache']
+    conf = celery.app.default_app.conf
+    backend, eager = config['backend'], conf['CELERY_ALWAYS_EAGER']
+    config['backend'] = 'memory'
+    try:
+        # Fine as long as the media is processed in this process
+        PageCacheMeddleware(mg_app)
+
+        conf['CELERY_ALWAYS_EAGER'] = False
+        with pytest.raises(ImproperlyConfigured):
+            PageCacheMeddleware(mg_app)
+    finally:
+        config['backend'], conf['CELERY_ALWAYS_EAGER'] = backend, eager
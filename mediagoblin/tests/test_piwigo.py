@@ -14,7 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import hashlib
+
 import pytest
+
+from mediagoblin.db.models import MediaEntry
+from .resources import GOOD_JPG
 from .tools import fixture_add_user
 
 
@@ -64,3 +70,31 @@ class Test_PWG:
 
         resp = self.do_get("pwg.session.getStatus")
         assert resp.body == (XML_PREFIX + '<rsp stat="ok"><username>guest</username></rsp>').encode('ascii')
+
+    def test_chunked_upload(self):
+        self.do_post("pwg.session.login",
+            {"username": self.username, "password": self.password})
+
+        data = open(GOOD_JPG, "rb").read()
+        o_sum = hashlib.md5(data).hexdigest()
+        chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+        # The first chunk is sent again, as after a dropped connection
+        for pos in [0] + list(range(len(chunks))):
+            resp = self.do_post("pwg.images.addChunk",
+                {"original_sum": o_sum, "type": "file", "position": str(pos),
+                 "data": base64.b64encode(chunks[pos]).decode('ascii')})
+            assert resp.body == (XML_PREFIX + '<rsp stat="ok">1</rsp>').encode('ascii')
+
+        resp = self.do_post("pwg.images.add",
+            {"original_sum": o_sum, "file_sum": o_sum, "name": "Chunked",
+             "original_filename": "chunked.jpg"})
+        media = MediaEntry.query.filter_by(title="Chunked").one()
+        assert '<image_id>{}</image_id>'.format(media.id).encode('ascii') \
+            in resp.body
+        assert media.file_size is not None
+
+        # The chunks are gone with the session
+        resp = self.test_app.post("/api/piwigo/ws.php",
+            {"method": "pwg.images.add", "original_sum": o_sum,
+             "file_sum": o_sum, "name": "Again"}, status=500)
+        assert b'stat="fail"' in resp.body
@@ -1,4 +1,12 @@
-from mediagoblin import processing
+import os
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from mediagoblin import mg_globals, processing
+from mediagoblin.media_types.image import processing as image_processing
+from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
 
 class TestProcessing:
     def run_fill(self, input, format, output=None):
@@ -14,3 +22,115 @@ class TestProcessing:
     def test_long_filename_fill(self):
         self.run_fill('{}.png'.format('A' * 300), 'image-{basename}{ext}',
                       'image-{}.png'.format('A' * 245))
+
+
+def test_progress_callback_coalesces_writes(test_app):
+    from mediagoblin.db.models import MediaEntry
+    from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
+
+    user = fixture_add_user()
+    entry = fixture_media_entry(uploader=user.id, expunge=False)
+    entry_id = entry.id
+
+    def stored():
+        return MediaEntry.query.get(entry_id)
+
+    callback = processing.ProgressCallback(entry, interval=3600, step=5)
+    callback(1)
+    # The first report is written right away
+    assert stored().transcoding_progress == 1
+
+    callback(1)
+    callback(2)
+    assert stored().transcoding_progress == 1
+    callback(2, 40)
+    # ... later ones once they add up to the step
+    assert stored().transcoding_progress == 6
+    assert stored().main_transcoding_progress == 40
+
+    callback(0.5)
+    callback.flush()
+    assert stored().transcoding_progress == 6.5
+
+    # Progress never goes past 100
+    callback(99.995, 100)
+    assert stored().transcoding_progress == 100
+    assert stored().main_transcoding_progress == 100
+
+
+class TestImageResizing:
+    @pytest.fixture(autouse=True)
+    def setup(self, test_app, tmpdir):
+        self.tmpdir = str(tmpdir)
+        user = fixture_add_user()
+        self.entry = fixture_media_entry(
+            uploader=user.id, fake_upload=False, expunge=False)
+        medium = mg_globals.global_config['media:medium']
+        self.medium_size = (medium['max_width'], medium['max_height'])
+
+    def process(self, size, thumb_size=None):
+        """
+        Make the medium and thumbnail of a JPEG of SIZE, and return the
+        sizes each was resized from and the number of times it was opened
+        """
+        filename = os.path.join(self.tmpdir, 'original.jpg')
+        Image.new('RGB', size, 'red').save(filename)
+
+        processor = image_processing.CommonImageProcessor(None, self.entry)
+        processor.image_config = mg_globals.global_config['plugins'][
+            'mediagoblin.media_types.image']
+        processor.conversions_subdir = self.tmpdir
+        processor.name_builder = processing.FilenameBuilder(filename)
+        processor.source_image = image_processing.SourceImage(filename, {})
+        processor.medium_image = None
+
+        resized_from = {}
+        original_resize_image = image_processing.resize_image
+
+        def resize_image(entry, resized, keyname, *args):
+            resized_from[keyname] = resized.size
+            return original_resize_image(entry, resized, keyname, *args)
+
+        with mock.patch.object(image_processing, 'resize_image',
+                               resize_image), \
+                mock.patch.object(Image, 'open', wraps=Image.open) as opened:
+            processor.generate_medium_if_applicable()
+            processor.generate_thumb(size=thumb_size)
+        return resized_from, opened.call_count
+
+    def stored_size(self, name):
+        with Image.open(os.path.join(self.tmpdir, name)) as image:
+            return image.size
+
+    def test_large_original(self):
+        resized_from, opened = self.process((6000, 4000))
+        assert opened == 1
+        # Decoded at a reduced scale, still above twice the medium size
+        decoded = resized_from['medium']
+        assert decoded < (6000, 4000)
+        assert min(decoded) >= 2 * max(self.medium_size)
+
+        medium = self.stored_size('original.medium.jpg')
+        assert max(medium) == max(self.medium_size)
+        # The medium is more than twice as big as the thumbnail
+        assert resized_from['thumb'] == medium
+        thumb = mg_globals.global_config['media:thumb']
+        assert max(self.stored_size('original.thumbnail.jpg')) == \
+            max(thumb['max_width'], thumb['max_height'])
+
+    def test_thumbnail_close_to_medium_size(self):
+        thumb_size = tuple(side * 2 // 3 for side in self.medium_size)
+        resized_from, opened = self.process((6000, 4000), thumb_size)
+        assert opened == 1
+        # Not from the medium, which is less than twice as big
+        assert resized_from['thumb'] == resized_from['medium']
+        assert max(self.stored_size('original.thumbnail.jpg')) == \
+            max(thumb_size)
+
+    def test_small_original(self):
+        resized_from, opened = self.process((300, 200))
+        assert opened == 1
+        # Too small for a medium
+        assert 'medium' not in resized_from
+        assert resized_from['thumb'] == (300, 200)
+        assert self.stored_size('original.thumbnail.jpg')[0] < 300
@@ -0,0 +1,111 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2013 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import pytest
+
+from mediagoblin.db.models import MediaEntry
+from mediagoblin.gmg_commands import reprocess
+from .tools import fixture_add_user, fixture_media_entry
+
+
+class FakeResult:
+    """A celery result which is ready once asked POLLS times"""
+    def __init__(self, polls):
+        self.polls = polls
+
+    def ready(self):
+        self.polls -= 1
+        return self.polls < 0
+
+    def failed(self):
+        return False
+
+
+class TestReprocessScheduler:
+    @pytest.fixture(autouse=True)
+    def setup(self, test_app, tmpdir, monkeypatch):
+        self.test_app = test_app
+        self.user = fixture_add_user()
+        self.journal = os.path.join(str(tmpdir), 'journal')
+        self.dispatched = []
+        self.in_flight = []
+        self.scheduler = None
+
+        def run_process_media(entry, **kwargs):
+            self.dispatched.append(entry.id)
+            self.in_flight.append(len(self.scheduler._in_flight))
+            return FakeResult(2)
+
+        monkeypatch.setattr(reprocess, 'run_process_media', run_process_media)
+        monkeypatch.setattr(reprocess.ReprocessScheduler, 'poll_interval', 0)
+
+    def add_media(self, count, state='processed'):
+        return [fixture_media_entry(uploader=self.user.id, state=state).id
+                for i in range(count)]
+
+    def run_scheduler(self, **kwargs):
+        self.scheduler = reprocess.ReprocessScheduler('resize', **kwargs)
+        self.scheduler.run(MediaEntry.query)
+        return self.scheduler.outcomes
+
+    def test_skips_ineligible_media(self):
+        eligible = self.add_media(2)
+        self.add_media(1, state='failed')
+        unknown = fixture_media_entry(uploader=self.user.id, expunge=False)
+        unknown.media_type = 'mediagoblin.media_types.nonexistent'
+        unknown.save()
+
+        outcomes = self.run_scheduler()
+        assert self.dispatched == eligible
+        assert outcomes == {'dispatched': 2, 'processed': 2, 'skipped': 2}
+
+    def test_max_in_flight(self):
+        media_ids = self.add_media(5)
+
+        outcomes = self.run_scheduler(max_in_flight=2, chunk_size=2)
+        assert self.dispatched == media_ids
+        # Each one waits for a place
+        assert max(self.in_flight) == 1
+        assert outcomes['processed'] == 5
+        assert not self.scheduler._in_flight
+
+    def test_journal_resume(self):
+        media_ids = self.add_media(6)
+        outcomes = ['processed', 'failed', 'skipped', 'dispatched',
+                    'processed']
+        with open(self.journal, 'w') as journal:
+            for media_id, outcome in zip(media_ids, outcomes):
+                journal.write(json.dumps(
+                    {'id': media_id, 'outcome': outcome}) + '\n')
+
+        self.run_scheduler(journal=self.journal)
+        # Those which failed or were not seen done are done again
+        assert self.dispatched == [media_ids[1], media_ids[3], media_ids[5]]
+
+        with open(self.journal) as journal:
+            records = [json.loads(line) for line in journal]
+        assert sorted((record['id'], record['outcome'])
+                      for record in records[len(outcomes):]) == [
+            (media_id, outcome) for media_id in self.dispatched
+            for outcome in ('dispatched', 'processed')]
+
+        # Nothing is left to do
+        self.dispatched = []
+        self.run_scheduler(journal=self.journal)
+        assert self.dispatched == []
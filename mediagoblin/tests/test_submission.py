@@ -55,7 +55,8 @@ from mediagoblin.media_types.video.processing import (
     VideoProcessingManager, main_task, complementary_task, group,
     processing_cleanup, CommonVideoProcessor)
 from mediagoblin.media_types.video.util import ACCEPTED_RESOLUTIONS
-from mediagoblin.submit.lib import new_upload_entry, run_process_media
+from mediagoblin.submit.lib import new_upload_entry, run_process_media, \
+    discard_queued_file
 
 from .resources import GOOD_JPG, GOOD_PNG, EVIL_FILE, EVIL_JPG, EVIL_PNG, \
     BIG_BLUE, GOOD_PDF, GPS_JPG, MED_PNG, BIG_PNG
@@ -280,13 +281,19 @@ class TestSubmissionBasics(BaseTestSubmission):
         assert self.our_user().uploaded == 499
 
     def test_big_file(self):
-        response, context = self.do_post({'title': 'Normal upload 7'},
-                                         do_follow=False,
-                                         **self.upload_data(BIG_PNG))
+        with mock.patch('mediagoblin.submit.lib.discard_queued_file',
+                        wraps=discard_queued_file) as discard:
+            response, context = self.do_post({'title': 'Normal upload 7'},
+                                             do_follow=False,
+                                             **self.upload_data(BIG_PNG))
 
         form = context['mediagoblin/submit/start.html']['submit_form']
         assert form.file.errors == ['Sorry, the file size is too big.']
 
+        # The copy stopped at the limit and what it wrote is gone
+        app, entry = discard.call_args[0]
+        assert not mg_globals.queue_store.file_exists(entry.queued_media_file)
+
     def check_media(self, request, find_data, count=None):
         media = MediaEntry.query.filter_by(**find_data)
         if count is not None:
@@ -14,17 +14,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
 
 try:
     from unittest import mock
 except ImportError:
     import unittest.mock as mock
 
+import pytest
 from werkzeug.wrappers import Request
 from werkzeug.test import EnvironBuilder
 
+from mediagoblin.db.models import MediaEntry, Comment
+from mediagoblin.tests.tools import (
+    fixture_add_user, fixture_media_entry, fixture_add_comment)
 from mediagoblin.tools.request import decode_request
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.pagination import (
+    Pagination, KeysetPagination, encode_pagination_token,
+    decode_pagination_token)
 
 class TestDecodeRequest:
     """Test the decode_request function."""
@@ -115,3 +122,139 @@ class TestPagination:
         paginator = self._create_paginator(num_items=31, page=1, per_page=30)
         assert paginator.total_count == 31
         assert paginator.pages == 2
+
+
+class TestKeysetPagination:
+    def _setup(self):
+        user = fixture_add_user('keyset_paginator')
+        created = datetime.datetime(2020, 1, 1)
+        self.entries = []
+        for i in range(7):
+            entry = fixture_media_entry(
+                title='Entry %d' % i, uploader=user.id, state='processed',
+                expunge=False)
+            # Every other entry shares its timestamp with the previous one
+            entry.created = created + datetime.timedelta(hours=i // 2)
+            entry.save()
+            self.entries.append(entry.id)
+        # Newest first, ties broken by id
+        self.expected = sorted(
+            self.entries, key=lambda i: ((i - self.entries[0]) // 2, i),
+            reverse=True)
+        self.cursor = MediaEntry.query.filter_by(actor=user.id)
+
+    def _paginate(self, token=None, page=1, count_ttl=0):
+        return KeysetPagination(
+            page, self.cursor, (MediaEntry.created, MediaEntry.id),
+            token=token, per_page=3, count_ttl=count_ttl)
+
+    def test_walks_forwards_and_backwards(self, test_app):
+        self._setup()
+
+        first = self._paginate()
+        assert [e.id for e in first()] == self.expected[:3]
+        assert not first.has_prev
+        assert first.has_next
+
+        second = self._paginate(first.next_token)
+        assert [e.id for e in second()] == self.expected[3:6]
+        assert second.page == 2
+        assert second.has_prev and second.has_next
+
+        third = self._paginate(second.next_token)
+        assert [e.id for e in third()] == self.expected[6:]
+        assert third.has_prev
+        assert not third.has_next
+
+        back = self._paginate(third.prev_token)
+        assert [e.id for e in back()] == self.expected[3:6]
+        assert back.page == 2
+
+        back = self._paginate(back.prev_token)
+        assert [e.id for e in back()] == self.expected[:3]
+        assert not back.has_prev
+
+    def test_total_count_is_optional(self, test_app):
+        self._setup()
+
+        assert self._paginate().total_count is None
+        assert self._paginate().pages is None
+        assert list(self._paginate().iter_pages()) == []
+
+        paginator = self._paginate(count_ttl=60)
+        assert paginator.total_count == 7
+        assert paginator.pages == 3
+
+    def test_page_without_token_uses_offset(self, test_app):
+        self._setup()
+
+        paginator = self._paginate(page=3)
+        assert [e.id for e in paginator()] == self.expected[6:]
+        assert paginator.has_prev
+
+    def test_token_values_of_wrong_type(self, test_app):
+        self._setup()
+
+        created = datetime.datetime(2020, 1, 1)
+        for values in ([[1], 5], [created, '5'], [created, True],
+                       [created.isoformat(), 5], [None, 5]):
+            with pytest.raises(ValueError):
+                self._paginate(encode_pagination_token('next', 2, values))
+
+        paginator = self._paginate(encode_pagination_token(
+            'next', 2, [created + datetime.timedelta(hours=2),
+                        self.expected[2]]))
+        assert [e.id for e in paginator()] == self.expected[3:6]
+
+    def test_token_roundtrip(self):
+        created = datetime.datetime(2020, 1, 1, 12, 30)
+        token = encode_pagination_token('next', 4, [created, 42])
+        assert decode_pagination_token(token) == ('next', 4, [created, 42])
+
+        with pytest.raises(ValueError):
+            decode_pagination_token('not a token')
+        with pytest.raises(ValueError):
+            decode_pagination_token(
+                encode_pagination_token('sideways', 1, [42]))
+
+
+class TestPaginationJumpToId:
+    def _setup(self):
+        self.entry = fixture_media_entry(state='processed')
+        for i in range(7):
+            fixture_add_comment(media_entry=self.entry)
+        self.links = [link.id for link in self.entry.get_comments(True)]
+
+    def _paginate(self, jump_to_id, ascending=True, keys=True):
+        if keys:
+            return Pagination(
+                1, self.entry.get_comments(ascending), 3, jump_to_id,
+                keys=(Comment.added, Comment.id), descending=not ascending)
+        return Pagination(
+            1, self.entry.get_comments(ascending), 3, jump_to_id)
+
+    def test_jumps_to_page_of_object(self, test_app):
+        self._setup()
+
+        for position, link_id in enumerate(self.links):
+            paginator = self._paginate(link_id)
+            assert paginator.page == 1 + position // 3
+            assert paginator.active_id == link_id
+            assert link_id in [link.id for link in paginator()]
+
+            # Same answer as walking through the cursor
+            assert paginator.page == self._paginate(link_id, keys=False).page
+
+    def test_jumps_in_descending_order(self, test_app):
+        self._setup()
+
+        paginator = self._paginate(self.links[0], ascending=False)
+        assert paginator.page == 3
+        assert self.links[0] in [link.id for link in paginator()]
+
+    def test_unknown_id_stays_on_page(self, test_app):
+        self._setup()
+
+        paginator = self._paginate(max(self.links) + 100)
+        assert paginator.page == 1
+        assert paginator.active_id is None
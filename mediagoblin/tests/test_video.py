@@ -135,6 +135,26 @@ def test_transcoder():
         assert len(discover(result_name).get_video_streams()) == 1
         assert len(discover(result_name).get_audio_streams()) == 1
 
+def test_transcoder_resolutions():
+    # both resolutions come from a single decode
+    with create_data(make_audio=True) as (video_name, result_name):
+        with tempfile.NamedTemporaryFile() as small_result:
+            transcoder = VideoTranscoder()
+            transcoder.transcode_resolutions(
+                    video_name,
+                    [('144p', (256, 144), small_result.name),
+                     ('480p', (858, 480), result_name)],
+                    '480p', 2,
+                    vp8_quality=8,
+                    vp8_threads=0,  # autodetect
+                    vorbis_quality=0.3)
+            assert set(transcoder.dst_data) == {'144p', '480p'}
+            for name, width in [(small_result.name, 256), (result_name, 858)]:
+                data = discover(name)
+                assert len(data.get_video_streams()) == 1
+                assert data.get_video_streams()[0].get_width() <= width
+                assert len(data.get_audio_streams()) == 1
+
 def test_accepted_resolutions():
     accepted_resolutions = {
         '144p': (256, 144),
@@ -106,6 +106,38 @@ class TestWorkbench:
         cleanup_storage(this_storage, tmpdir, ['dir1', 'dir2'])
         this_workbench.destroy()
 
+    def test_shared_localized_file(self):
+        tmpdir, this_storage = get_tmp_filestorage(fake_remote=True)
+        filepath = ['dir1', 'dir2', 'ourfile.txt']
+        with this_storage.get_file(filepath, 'w') as our_file:
+            our_file.write(b'Our file')
+
+        # Both workbenches get the same, single copy
+        first_workbench = self.workbench_manager.create()
+        second_workbench = self.workbench_manager.create()
+        first_filename = first_workbench.localized_file(
+            this_storage, filepath, shared_key='ourfile')
+        second_filename = second_workbench.localized_file(
+            this_storage, filepath, shared_key='ourfile')
+        assert first_filename == second_filename
+        assert not first_filename.startswith(first_workbench.dir)
+        with open(first_filename, 'rb') as our_file:
+            assert our_file.read() == b'Our file'
+
+        # It's kept until discarded and released by everyone
+        first_workbench.destroy()
+        assert os.path.exists(second_filename)
+        self.workbench_manager.shared_files.discard('ourfile')
+        assert os.path.exists(second_filename)
+        second_workbench.destroy()
+        assert not os.path.exists(second_filename)
+
+        this_storage.delete_file(filepath)
+        cleanup_storage(this_storage, tmpdir, ['dir1', 'dir2'])
+        shared_dir = self.workbench_manager.shared_files.base_dir
+        os.remove(os.path.join(shared_dir, 'ourfile.lock'))
+        os.rmdir(shared_dir)
+
     def test_workbench_decorator(self):
         """Test @get_workbench decorator and automatic cleanup"""
         # The decorator needs mg_globals.workbench_manager
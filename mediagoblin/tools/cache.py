@@ -0,0 +1,155 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Key/value caches whose values expire
+
+They all have the interface of a memcached client, get(key),
+set(key, value, timeout) and delete(key), a timeout of 0 meaning
+forever.  So a memcached client, or a wrapper giving a redis client that
+interface, can be used wherever they are.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from mediagoblin.tools.common import import_component
+
+_log = logging.getLogger(__name__)
+
+
+def _expiry(timeout):
+    if timeout:
+        return time.time() + timeout
+    return 0
+
+
+class MemoryCache:
+    """
+    Keeps the most recently used values in this process
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._values[key]
+            except KeyError:
+                return None
+            if expires and expires < time.time():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=0):
+        with self._lock:
+            self._values[key] = (_expiry(timeout), value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class FileSystemCache:
+    """
+    Keeps values in files, shared by every process using the same
+    directory
+
+    Once there are more than max_entries files the least recently
+    written half of them is removed.
+    """
+    def __init__(self, cache_dir, max_entries=1000):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as cache_file:
+                expires, value = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=0):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump((_expiry(timeout), value), cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+        # Readers see either the old file or the new one, never half of it
+        os.replace(tmp_path, self._path(key))
+        self._prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _prune(self):
+        names = os.listdir(self.cache_dir)
+        if len(names) <= self.max_entries:
+            return
+
+        paths = [os.path.join(self.cache_dir, name) for name in names]
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                pass
+        for path in sorted(mtimes, key=mtimes.get)[:len(mtimes) // 2]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_cache(backend, max_entries=1000, cache_dir=None):
+    """
+    Set up a cache
+
+    BACKEND is "memory", "filesystem" (keeping files in CACHE_DIR) or
+    the import path ("module:callable") of something returning a cache
+    when called without arguments, like a memcached client factory.
+    """
+    if backend == 'memory':
+        return MemoryCache(max_entries)
+    elif backend == 'filesystem':
+        return FileSystemCache(cache_dir, max_entries)
+
+    _log.debug('Using %s as cache', backend)
+    return import_component(backend)()
@@ -43,7 +43,8 @@ def create_generator(request):
 
 
 
-def create_activity(verb, obj, actor, target=None, generator=None):
+def create_activity(verb, obj, actor, target=None, generator=None,
+                    commit=True):
     """
     This will create an Activity object which for the obj if possible
     and save it. The verb should be one of the following:
@@ -53,6 +54,8 @@ def create_activity(verb, obj, actor, target=None, generator=None):
 
     If none of those fit you might not want/need to create an activity for
     the object. The list is in mediagoblin.db.models.Activity.VALID_VERBS
+
+    With commit=False everything is only flushed, for the caller to commit.
     """
     # exception when we try and generate an activity with an unknow verb
     # could change later to allow arbitrary verbs but at the moment we'll play
@@ -69,7 +72,7 @@ def create_activity(verb, obj, actor, target=None, generator=None):
                 name="GNU MediaGoblin",
                 object_type="service"
             )
-            generator.save()
+            generator.save(commit=commit)
 
     # Ensure the object has an ID which is needed by the activity.
     obj.save(commit=False)
@@ -84,11 +87,11 @@ def create_activity(verb, obj, actor, target=None, generator=None):
    # If they've set it override the actor from the obj.
     activity.actor = actor.id if isinstance(actor, User) else actor
     activity.generator = generator.id
-    activity.save()
+    activity.save(commit=commit)
 
     # Sigh want to do this prior to save but I can't figure a way to get
     # around relationship() not looking up object when model isn't saved.
     if activity.generate_content():
-        activity.save()
+        activity.save(commit=commit)
 
     return activity
@@ -14,7 +14,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from io import StringIO
+
 from feedgenerator.django.utils import feedgenerator
+from feedgenerator.django.utils.xmlutils import SimplerXMLGenerator
+
+from mediagoblin.db.util import preload_media_files
+from mediagoblin.plugins.api.tools import get_media_file_paths
+from mediagoblin.tools.cache import MemoryCache
+from mediagoblin.tools.translate import pass_to_ugettext as _
+
+# Rendered <entry> elements of media entries, by entry version
+_entry_fragments = MemoryCache(max_entries=1000)
 
 
 class AtomFeedWithLinks(feedgenerator.Atom1Feed):
@@ -36,3 +47,82 @@ class AtomFeedWithLinks(feedgenerator.Atom1Feed):
         super().add_root_elements(handler)
         for link in self.links:
             handler.addQuickElement('link', '', link)
+
+    def render_item(self, **kwargs):
+        """Render the <entry> of an item, taking the arguments of add_item"""
+        self.add_item(**kwargs)
+        item = self.items.pop()
+        fragment = StringIO()
+        handler = SimplerXMLGenerator(fragment, 'utf-8',
+                                      short_empty_elements=True)
+        handler.startElement('entry', self.item_attributes(item))
+        self.add_item_elements(handler, item)
+        handler.endElement('entry')
+        return fragment.getvalue()
+
+    def add_fragment(self, fragment, updateddate):
+        """Add an item rendered by render_item as it is"""
+        self.items.append({'fragment': fragment, 'updateddate': updateddate})
+
+    def write_items(self, handler):
+        for item in self.items:
+            if 'fragment' in item:
+                # Already XML, so written without escaping
+                handler.ignorableWhitespace(item['fragment'])
+            else:
+                handler.startElement('entry', self.item_attributes(item))
+                self.add_item_elements(handler, item)
+                handler.endElement('entry')
+
+
+def add_media_entries(feed, request, entries):
+    """
+    Add an item for each of the media ENTRIES to FEED
+
+    Entries render to the same <entry> until they are updated, so the
+    ones rendered before are reused and only the others need their files
+    and uploader loaded.
+    """
+    entries = list(entries)
+    fragments = {}
+    for entry in entries:
+        key = 'feed_entry:{}:{}:{}:{}'.format(
+            request.host_url, request.locale, entry.id,
+            entry.updated.isoformat())
+        fragments[entry.id] = key, _entry_fragments.get(key)
+
+    preload_media_files(
+        [entry for entry in entries if fragments[entry.id][1] is None])
+
+    for entry in entries:
+        key, fragment = fragments[entry.id]
+        if fragment is None:
+            fragment = _render_media_entry(feed, request, entry)
+            _entry_fragments.set(key, fragment)
+        feed.add_fragment(fragment, entry.created)
+
+
+def _render_media_entry(feed, request, entry):
+    # Include a thumbnail image in content.
+    file_urls = get_media_file_paths(entry.media_files, request.urlgen)
+    if 'thumb' in file_urls:
+        content = '<img src="{thumb}" alt='' /> {desc}'.format(
+            thumb=file_urls['thumb'], desc=entry.description_html)
+    else:
+        content = entry.description_html
+
+    url = entry.url_for_self(request.urlgen, qualified=True)
+    return feed.render_item(
+        # AtomFeed requires a non-blank title. This situation can occur if
+        # you edit a media item and blank out the existing title.
+        title=entry.get('title') or _('Untitled'),
+        link=url,
+        description=content,
+        unique_id=url,
+        author_name=entry.get_actor.username,
+        author_link=request.urlgen(
+            'mediagoblin.user_pages.user_home',
+            qualified=True,
+            user=entry.get_actor.username),
+        updateddate=entry.get('created'),
+    )
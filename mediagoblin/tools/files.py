@@ -14,18 +14,54 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
+
+import celery
+
 from mediagoblin import mg_globals
 
+_log = logging.getLogger(__name__)
+
+
+def shared_file_paths(media, filepaths):
+    """
+    Those of FILEPATHS which media entries other than MEDIA use too
+
+    Copies of an upload share the files of the first one processed,
+    see MediaEntry.reuse_files_of.
+    """
+    # Import here to prevent cyclic imports.
+    from mediagoblin.db.models import MediaFile
+
+    filepaths = [filepath for filepath in filepaths if filepath]
+    if not filepaths:
+        return set()
+    return {tuple(filepath) for (filepath,) in MediaFile.query.filter(
+        MediaFile.file_path.in_(filepaths),
+        MediaFile.media_entry != media.id).with_entities(MediaFile.file_path)}
+
 
 def delete_media_files(media):
     """
-    Delete all files associated with a MediaEntry
+    Delete all files associated with a MediaEntry, except those other
+    entries use too
 
     Arguments:
      - media: A MediaEntry document
     """
+    # Import here to prevent cyclic imports.
+    from mediagoblin.db.models import MediaEntry
+
+    # Waits for an entry taking over the files to be saved, see
+    # submit.lib.reuse_processed_media
+    MediaEntry.query.filter_by(id=media.id).with_for_update().with_entities(
+        MediaEntry.id).first()
+
     no_such_files = []
+    shared = shared_file_paths(media, media.media_files.values())
     for listpath in media.media_files.values():
+        if tuple(listpath) in shared:
+            continue
         try:
             mg_globals.public_store.delete_file(
                 listpath)
@@ -48,3 +84,22 @@ def delete_media_files(media):
 
     if no_such_files:
         raise OSError(", ".join(no_such_files))
+
+
+@celery.shared_task()
+def delete_files_task(filepaths):
+    """
+    Delete FILEPATHS from the public store, for media deleted in bulk
+
+    Files which are gone already are only logged.
+    """
+    no_such_files = []
+    for filepath in filepaths:
+        try:
+            mg_globals.public_store.delete_file(filepath)
+        except OSError:
+            no_such_files.append("/".join(filepath))
+
+    if no_such_files:
+        _log.error('No such files to delete: {}'.format(
+            ", ".join(no_such_files)))
@@ -14,15 +14,29 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import copy
+import json
+from datetime import datetime
 from math import ceil, floor
 from itertools import count
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import selectinload
 from werkzeug.datastructures import MultiDict
 
 import urllib
 
+from mediagoblin import mg_globals
+from mediagoblin.tools.cache import MemoryCache
+
 PAGINATION_DEFAULT_PER_PAGE = 30
 
+# GET parameter carrying the opaque KeysetPagination token
+PAGINATION_TOKEN_PARAM = 'cursor'
+
+# Keeps exact totals of keyset paginated listings around for a while
+_count_cache = MemoryCache(max_entries=1024)
+
 
 class Pagination:
     """
@@ -33,7 +47,8 @@ class Pagination:
     """
 
     def __init__(self, page, cursor, per_page=PAGINATION_DEFAULT_PER_PAGE,
-                 jump_to_id=False):
+                 jump_to_id=False, keys=None, descending=False,
+                 total_count=None):
         """
         Initializes Pagination
 
@@ -43,22 +58,54 @@ class Pagination:
          - cursor: db cursor
          - jump_to_id: object id, sets the page to the page containing the
            object with id == jump_to_id.
+         - keys: columns cursor is ordered by, the last one being the
+           id column jump_to_id refers to (e.g. (Comment.added,
+           Comment.id)).  Lets the database find jump_to_id's page
+           instead of walking through the whole cursor.
+         - descending: whether cursor is ordered by keys descending
+         - total_count: how many objects cursor has, if already known
+           (e.g. from a counter column), saves counting them
         """
         self.page = page
         self.per_page = per_page
         self.cursor = cursor
-        self.total_count = self.cursor.count()
+        if total_count is None:
+            total_count = self.cursor.count()
+        self.total_count = total_count
         self.active_id = None
 
         if jump_to_id:
-            cursor = copy.copy(self.cursor)
+            if keys is not None:
+                position = self._position_of(jump_to_id, keys, descending)
+            else:
+                position = self._scan_for(jump_to_id)
+
+            if position is not None:
+                self.page = 1 + int(floor(position / self.per_page))
+                self.active_id = jump_to_id
+
+    def _position_of(self, obj_id, keys, descending):
+        """
+        Number of objects ordered before obj_id, None if it's not there
+        """
+        values = self.cursor.filter(keys[-1] == obj_id).\
+            with_entities(*keys).first()
+        if values is None:
+            return None
 
-            for (doc, increment) in list(zip(cursor, count(0))):
-                if doc.id == jump_to_id:
-                    self.page = 1 + int(floor(increment / self.per_page))
+        return self.cursor.order_by(None).filter(
+            _keyset_clause(keys, values, less=not descending)).count()
 
-                    self.active_id = jump_to_id
-                    break
+    def _scan_for(self, obj_id):
+        """
+        Like _position_of(), for cursors without known keys
+        """
+        cursor = copy.copy(self.cursor)
+
+        for (doc, increment) in zip(cursor, count(0)):
+            if doc.id == obj_id:
+                return increment
+        return None
 
     def __call__(self):
         """
@@ -116,3 +163,296 @@ class Pagination:
         """
         return self.get_page_url_explicit(
             request.full_path, request.GET, page_no)
+
+    def get_prev_page_url_explicit(self, base_url, get_params):
+        """
+        Get the url of the previous page
+        """
+        return self.get_page_url_explicit(base_url, get_params, self.page - 1)
+
+    def get_next_page_url_explicit(self, base_url, get_params):
+        """
+        Get the url of the next page
+        """
+        return self.get_page_url_explicit(base_url, get_params, self.page + 1)
+
+
+class PageItems(list):
+    """
+    Objects on a KeysetPagination page
+
+    Templates call .count() on what Pagination returns (a query slice),
+    so support that here as well.
+    """
+
+    def count(self, *args):
+        if args:
+            return super().count(*args)
+        return len(self)
+
+
+class KeysetPagination(Pagination):
+    """
+    Keyset (cursor-based) pagination for database queries.
+
+    Instead of OFFSET slicing, a page is found by seeking past the sort
+    keys of the last (or first) row of its neighbouring page, so deep
+    pages cost as much as the first one.  Neighbouring pages are
+    addressed by opaque tokens passed in the PAGINATION_TOKEN_PARAM GET
+    parameter.
+
+    Counting all rows is optional (see count_ttl); without the total
+    there are no page numbers, only prev/next links.
+    """
+
+    def __init__(self, page, cursor, keys, token=None,
+                 per_page=PAGINATION_DEFAULT_PER_PAGE, descending=True,
+                 count_ttl=0):
+        """
+        Initializes KeysetPagination
+
+        Args:
+         - page: requested page, used when no token is given
+         - cursor: db cursor, its ordering gets replaced by keys
+         - keys: columns to order and seek on, the last one has to be
+           unique (e.g. (MediaEntry.created, MediaEntry.id))
+         - token: opaque token from a previous page, see next_token
+         - per_page: number of objects per page
+         - descending: whether keys are sorted in descending order
+         - count_ttl: seconds to cache the total count for, 0 doesn't
+           count at all
+
+        Raises ValueError on malformed tokens, see uses_pagination.
+        """
+        self.per_page = per_page
+        self.cursor = cursor.order_by(None)
+        self.keys = keys
+        self.descending = descending
+        self.active_id = None
+        self._items = None
+
+        self.direction, self.seek_values = None, None
+        self.page = page
+        if token:
+            direction, token_page, values = decode_pagination_token(token)
+            # Tokens of other listings don't fit our keys, ignore them
+            if len(values) == len(keys):
+                _check_seek_values(keys, values)
+                self.direction, self.page, self.seek_values = \
+                    direction, token_page, values
+
+        self.total_count = None
+        if count_ttl:
+            self.total_count = _cached_count(self.cursor, count_ttl)
+
+    def _make_token(self, direction, page, item):
+        return encode_pagination_token(
+            direction, page, [getattr(item, key.key) for key in self.keys])
+
+    def _fetch(self):
+        if self._items is not None:
+            return self._items
+
+        backwards = self.direction == 'prev'
+        query = self.cursor
+        if self.descending != backwards:
+            query = query.order_by(*[key.desc() for key in self.keys])
+        else:
+            query = query.order_by(*[key.asc() for key in self.keys])
+
+        if self.seek_values is not None:
+            # Going newer->older when descending
+            query = query.filter(_keyset_clause(
+                self.keys, self.seek_values,
+                less=self.descending != backwards))
+        elif self.page > 1:
+            # No token (e.g. a "Go to page" link), fall back to OFFSET
+            query = query.offset((self.page - 1) * self.per_page)
+
+        # Fetch one extra row to find out whether there's more
+        items = query.limit(self.per_page + 1).all()
+        more = len(items) > self.per_page
+        items = PageItems(items[:self.per_page])
+
+        if backwards:
+            items.reverse()
+            self._has_prev = more
+            self._has_next = True
+        else:
+            self._has_prev = self.page > 1
+            self._has_next = more
+
+        self._items = items
+        return items
+
+    def __call__(self):
+        """
+        Returns the objects on the requested page
+        """
+        return self._fetch()
+
+    @property
+    def pages(self):
+        if self.total_count is None:
+            return None
+        return super().pages
+
+    @property
+    def has_prev(self):
+        self._fetch()
+        return self._has_prev and bool(self._items)
+
+    @property
+    def has_next(self):
+        self._fetch()
+        return self._has_next and bool(self._items)
+
+    @property
+    def prev_token(self):
+        if not self.has_prev:
+            return None
+        return self._make_token(
+            'prev', max(self.page - 1, 1), self._items[0])
+
+    @property
+    def next_token(self):
+        if not self.has_next:
+            return None
+        return self._make_token('next', self.page + 1, self._items[-1])
+
+    def iter_pages(self, *args, **kwargs):
+        if self.total_count is None:
+            return iter(())
+        return super().iter_pages(*args, **kwargs)
+
+    def get_page_url_explicit(self, base_url, get_params, page_no):
+        """
+        Get a page url for page_no, dropping any pagination token
+        """
+        if isinstance(get_params, MultiDict):
+            get_params = get_params.to_dict()
+        get_params = dict(get_params or {})
+        get_params.pop(PAGINATION_TOKEN_PARAM, None)
+        return super().get_page_url_explicit(base_url, get_params, page_no)
+
+    def _get_token_url_explicit(self, base_url, get_params, token):
+        if isinstance(get_params, MultiDict):
+            new_get_params = get_params.to_dict()
+        else:
+            new_get_params = dict(get_params or {})
+
+        new_get_params.pop('page', None)
+        new_get_params[PAGINATION_TOKEN_PARAM] = token
+        return "{}?{}".format(
+            base_url, urllib.parse.urlencode(new_get_params))
+
+    def get_prev_page_url_explicit(self, base_url, get_params):
+        return self._get_token_url_explicit(
+            base_url, get_params, self.prev_token)
+
+    def get_next_page_url_explicit(self, base_url, get_params):
+        return self._get_token_url_explicit(
+            base_url, get_params, self.next_token)
+
+
+def _check_seek_values(keys, values):
+    """
+    Raise ValueError unless each of values is of the python type of its
+    key, as the database would choke on them
+    """
+    for key, value in zip(keys, values):
+        try:
+            python_type = key.type.python_type
+        except NotImplementedError:
+            continue
+        # bool is an int to python, not to the database
+        if isinstance(value, bool) or not isinstance(value, python_type):
+            raise ValueError('Invalid pagination token')
+
+
+def _keyset_clause(keys, values, less=True):
+    """
+    Row-value comparison (keys) < values (or > if not less), spelled
+    out with AND/OR since not every database supports row values
+    """
+    clause = None
+    for key, value in reversed(list(zip(keys, values))):
+        beyond = key < value if less else key > value
+        if clause is None:
+            clause = beyond
+        else:
+            clause = or_(beyond, and_(key == value, clause))
+    return clause
+
+
+def encode_pagination_token(direction, page, values):
+    """
+    Make an opaque KeysetPagination token
+
+    Args:
+     - direction: 'prev' or 'next'
+     - page: number of the page the token leads to
+     - values: sort key values to seek past
+    """
+    values = [{'dt': value.isoformat()} if isinstance(value, datetime)
+              else value for value in values]
+    payload = json.dumps([direction, page, values],
+                         separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_pagination_token(token):
+    """
+    Turn a token from encode_pagination_token() back into
+    (direction, page, values), raises ValueError if it's malformed
+    """
+    try:
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, page, values = json.loads(payload.decode('utf-8'))
+        values = [datetime.fromisoformat(value['dt'])
+                  if isinstance(value, dict) else value
+                  for value in values]
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise ValueError('Invalid pagination token')
+
+    if direction not in ('prev', 'next') or \
+       not isinstance(page, int) or page < 1:
+        raise ValueError('Invalid pagination token')
+
+    return direction, page, values
+
+
+def _cached_count(cursor, ttl):
+    """
+    cursor.count(), remembered for ttl seconds
+    """
+    statement = cursor.statement
+    key = (str(statement),
+           repr(sorted(statement.compile().params.items())))
+
+    total = _count_cache.get(key)
+    if total is None:
+        total = cursor.count()
+        _count_cache.set(key, total, ttl)
+    return total
+
+
+def get_media_pagination(request, page, cursor, keys,
+                         per_page=PAGINATION_DEFAULT_PER_PAGE):
+    """
+    Paginate a media listing the way the instance is configured to
+
+    Returns a KeysetPagination seeking on keys when keyset_pagination
+    is enabled, a plain Pagination otherwise.  The media files of a page
+    are loaded along with it, for the thumbnails.
+    """
+    config = mg_globals.app_config
+    cursor = cursor.options(selectinload('media_files_helper'))
+    if not config['keyset_pagination']:
+        return Pagination(page, cursor, per_page)
+
+    return KeysetPagination(
+        page, cursor, keys,
+        token=request.GET.get(PAGINATION_TOKEN_PARAM),
+        per_page=per_page,
+        count_ttl=config['keyset_pagination_count_ttl'])
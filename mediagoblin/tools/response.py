@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
 
 import werkzeug.utils
@@ -22,7 +23,7 @@ from mediagoblin.tools.template import render_template
 from mediagoblin.tools.translate import (lazy_pass_to_ugettext as _,
                                          pass_to_ugettext)
 from mediagoblin.db.models import UserBan, User
-from datetime import date
+from datetime import date, timezone
 
 class Response(wz_Response):
     """Set default response mimetype to HTML, otherwise we get text/plain"""
@@ -184,3 +185,42 @@ def form_response(data, *args, **kwargs):
             )
 
     return response
+
+
+class CacheValidators:
+    """
+    ETag and Last-Modified of a resource last changed at LAST_MODIFIED
+
+    STATE is anything else telling versions of the resource apart, like
+    how many items it lists, so they should be cheap to get: the point is
+    answering clients whose copy is current before doing the real work.
+    """
+    def __init__(self, last_modified, *state):
+        self.etag = hashlib.sha1(
+            repr((last_modified, state)).encode('utf-8')).hexdigest()
+        # HTTP dates only go down to the second
+        if last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0)
+        self.last_modified = last_modified
+
+    def not_modified(self, request):
+        """Return an empty 304 response if the client's copy is current"""
+        if request.if_none_match:
+            current = request.if_none_match.contains_weak(self.etag)
+        elif request.if_modified_since and self.last_modified is not None:
+            since = request.if_modified_since
+            if since.tzinfo is not None:
+                since = since.astimezone(timezone.utc).replace(tzinfo=None)
+            current = self.last_modified <= since
+        else:
+            current = False
+
+        if current:
+            return self.apply(wz_Response(status=304))
+
+    def apply(self, response):
+        """Set the validators on RESPONSE, returning it"""
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        return response
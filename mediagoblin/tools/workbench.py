@@ -14,9 +14,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import fcntl
 import os
 import shutil
 import tempfile
+import time
+from contextlib import contextmanager
+
+# Shared localized files nobody took or released for this long (in
+# seconds) are considered left over, e.g. by tasks of a media entry
+# which got finished on another node
+SHARED_FILE_MAX_AGE = 24 * 60 * 60
 
 # Actual workbench stuff
 # ----------------------
@@ -29,12 +37,14 @@ class Workbench:
     WARNING: DO NOT create Workbench objects on your own,
     let the WorkbenchManager do that for you!
     """
-    def __init__(self, dir):
+    def __init__(self, dir, shared_files=None):
         """
         WARNING: DO NOT create Workbench objects on your own,
         let the WorkbenchManager do that for you!
         """
         self.dir = dir
+        self.shared_files = shared_files
+        self.shared_keys = []
 
     def __str__(self):
         return str(self.dir)
@@ -50,7 +60,8 @@ class Workbench:
 
     def localized_file(self, storage, filepath,
                        filename_if_copying=None,
-                       keep_extension_if_copying=True):
+                       keep_extension_if_copying=True,
+                       shared_key=None):
         """
         Possibly localize the file from this storage system (for read-only
         purposes, modifications should be written to a new file.).
@@ -90,9 +101,18 @@ class Workbench:
           ...     '/our/workbench/subdir', remote_storage,
           ...     ['path', 'to', 'foobar.jpg'], 'source', True)
           '/our/workbench/subdir/foobar.jpg'
+
+        If shared_key is set, a copy is shared with all other workbenches
+        on this machine localizing the file under the same key, instead
+        of copying it into this workbench.  It's held until the
+        workbench is destroyed, see SharedFiles.
         """
         if storage.local_storage:
             return storage.get_local_path(filepath)
+        elif shared_key is not None and self.shared_files is not None:
+            filename = self.shared_files.take(storage, filepath, shared_key)
+            self.shared_keys.append(shared_key)
+            return filename
         else:
             if filename_if_copying is None:
                 dest_filename = filepath[-1]
@@ -123,6 +143,9 @@ class Workbench:
         shutil.rmtree(workbench)
         del self.dir
 
+        while self.shared_keys:
+            self.shared_files.release(self.shared_keys.pop())
+
     def __enter__(self):
         """Make Workbench a context manager so we can use `with Workbench() as bench:`"""
         return self
@@ -153,9 +176,134 @@ class WorkbenchManager:
         self.base_workbench_dir = os.path.abspath(base_workbench_dir)
         if not os.path.exists(self.base_workbench_dir):
             os.makedirs(self.base_workbench_dir)
+        self.shared_files = SharedFiles(
+            os.path.join(self.base_workbench_dir, 'shared'))
 
     def create(self):
         """
         Create and return the path to a new workbench (directory).
         """
-        return Workbench(tempfile.mkdtemp(dir=self.base_workbench_dir))
+        return Workbench(tempfile.mkdtemp(dir=self.base_workbench_dir),
+                         self.shared_files)
+
+
+class SharedFiles:
+    """
+    Reference counted local copies of files from (remote) storage, shared
+    between the workbenches of all processes on this machine.
+
+    Several tasks working on the same source (like the transcodes of a
+    video to different resolutions) can take the same key and only the
+    first one actually copies the file over.  The copy is deleted once
+    it's been discarded and the last holder released it; copies nobody
+    took or released for SHARED_FILE_MAX_AGE are cleaned up as well.
+
+    Bookkeeping is done with a lock file and a holder count file per
+    key, so that it works across worker processes.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def _paths(self, key):
+        key_dir = os.path.join(self.base_dir, key)
+        return (key_dir,
+                key_dir + '.lock',
+                os.path.join(key_dir, 'holders'),
+                os.path.join(key_dir, 'discard'))
+
+    @contextmanager
+    def _locked(self, key):
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir, exist_ok=True)
+        key_dir, lock_path, holders_path, discard_path = self._paths(key)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _add_holders(self, key, delta):
+        key_dir, lock_path, holders_path, discard_path = self._paths(key)
+        try:
+            with open(holders_path) as holders_file:
+                holders = int(holders_file.read() or 0)
+        except FileNotFoundError:
+            holders = 0
+        holders = max(holders + delta, 0)
+        with open(holders_path, 'w') as holders_file:
+            holders_file.write(str(holders))
+        return holders
+
+    def take(self, storage, filepath, key):
+        """
+        Get the local copy of filepath for key, copying it if needed
+        """
+        self.clean_stale()
+
+        key_dir, lock_path, holders_path, discard_path = self._paths(key)
+        filename = os.path.join(key_dir, filepath[-1])
+
+        # Copying while holding the lock makes others wait for it rather
+        # than fetching the file themselves
+        with self._locked(key):
+            if not os.path.exists(filename):
+                if not os.path.exists(key_dir):
+                    os.makedirs(key_dir)
+                storage.copy_locally(filepath, filename + '.part')
+                os.rename(filename + '.part', filename)
+            self._add_holders(key, 1)
+
+        return filename
+
+    def release(self, key):
+        """
+        Release a copy taken before, deleting it if it got discarded
+        """
+        key_dir, lock_path, holders_path, discard_path = self._paths(key)
+        with self._locked(key):
+            if not os.path.exists(key_dir):
+                return
+            holders = self._add_holders(key, -1)
+            if not holders and os.path.exists(discard_path):
+                shutil.rmtree(key_dir)
+
+    def discard(self, key):
+        """
+        Delete the copy for key once nobody holds it anymore
+        """
+        key_dir, lock_path, holders_path, discard_path = self._paths(key)
+        with self._locked(key):
+            if not os.path.exists(key_dir):
+                return
+            if self._add_holders(key, 0):
+                open(discard_path, 'w').close()
+            else:
+                shutil.rmtree(key_dir)
+
+    def clean_stale(self):
+        """
+        Delete copies which weren't taken or released for a long time
+        """
+        if not os.path.exists(self.base_dir):
+            return
+
+        now = time.time()
+        for key in os.listdir(self.base_dir):
+            key_dir, lock_path, holders_path, discard_path = \
+                self._paths(key)
+            if not os.path.isdir(key_dir):
+                # Lock files of copies that are long gone
+                if key.endswith('.lock') and \
+                   not os.path.exists(key_dir[:-len('.lock')]) and \
+                   now - os.path.getmtime(key_dir) > SHARED_FILE_MAX_AGE:
+                    os.remove(key_dir)
+                continue
+            try:
+                last_used = os.path.getmtime(holders_path)
+            except OSError:
+                last_used = os.path.getmtime(key_dir)
+            if now - last_used > SHARED_FILE_MAX_AGE:
+                with self._locked(key):
+                    shutil.rmtree(key_dir, ignore_errors=True)
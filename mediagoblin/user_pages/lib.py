@@ -68,9 +68,6 @@ def add_media_to_collection(collection, media, note=None, commit=True):
     if note:
         collection_item.note = note
     Session.add(collection_item)
-
-    collection.num_items = collection.num_items + 1
-    Session.add(collection)
     Session.add(media)
 
     hook_runall('collection_add_media', collection_item=collection_item)
@@ -20,21 +20,24 @@ import json
 
 from mediagoblin import messages, mg_globals
 from mediagoblin.db.models import (MediaEntry, MediaTag, Collection,
-                                   CollectionItem, LocalUser, Activity)
-from mediagoblin.plugins.api.tools import get_media_file_paths
+                                   CollectionItem, LocalUser, Activity,
+                                   Comment, TextComment,
+                                   GenericModelReference)
+from mediagoblin.db.util import preload_references
 from mediagoblin.tools.response import render_to_response, render_404, \
-    redirect, redirect_obj
+    redirect, redirect_obj, CacheValidators
 from mediagoblin.tools.text import cleaned_markdown_conversion
 from mediagoblin.tools.translate import pass_to_ugettext as _
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.pagination import Pagination, get_media_pagination
 from mediagoblin.tools.federation import create_activity
-from mediagoblin.tools.feeds import AtomFeedWithLinks
+from mediagoblin.tools.feeds import AtomFeedWithLinks, add_media_entries
 from mediagoblin.user_pages import forms as user_forms
 from mediagoblin.user_pages.lib import (
     add_media_to_collection, build_report_object)
 from mediagoblin.notifications import trigger_notification, \
     add_comment_subscription, mark_comment_notification_seen
 from mediagoblin.tools.pluginapi import hook_transform
+from mediagoblin.meddleware.page_cache import page_cacheable
 
 from mediagoblin.decorators import (uses_pagination, get_user_media_entry,
     get_media_entry_by_id, user_has_privilege, user_not_banned,
@@ -42,6 +45,8 @@ from mediagoblin.decorators import (uses_pagination, get_user_media_entry,
     get_user_collection, get_user_collection_item, active_user_from_url,
     get_optional_media_comment_by_id, allow_reporting)
 
+from sqlalchemy import and_, func
+from sqlalchemy.orm import aliased
 from werkzeug.exceptions import MethodNotAllowed
 from werkzeug.wrappers import Response
 
@@ -50,6 +55,7 @@ _log = logging.getLogger(__name__)
 _log.setLevel(logging.DEBUG)
 
 
+@page_cacheable
 @user_not_banned
 @uses_pagination
 def user_home(request, page):
@@ -66,7 +72,8 @@ def user_home(request, page):
     cursor = MediaEntry.query.\
         filter_by(actor=user.id).order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = get_media_pagination(
+        request, page, cursor, (MediaEntry.created, MediaEntry.id))
     media_entries = pagination()
 
     # if no data is available, return NotFound
@@ -85,6 +92,7 @@ def user_home(request, page):
          'media_entries': media_entries,
          'pagination': pagination})
 
+@page_cacheable
 @user_not_banned
 @active_user_from_url
 @uses_pagination
@@ -102,7 +110,8 @@ def user_gallery(request, page, url_user=None):
                 MediaTag.slug == request.matchdict['tag']))
 
     # Paginate gallery
-    pagination = Pagination(page, cursor)
+    pagination = get_media_pagination(
+        request, page, cursor, (MediaEntry.created, MediaEntry.id))
     media_entries = pagination()
 
     #if no data is available, return NotFound
@@ -120,6 +129,42 @@ def user_gallery(request, page, url_user=None):
 
 MEDIA_COMMENTS_PER_PAGE = 50
 
+
+def _media_home_validators(request, media):
+    """
+    The CacheValidators of the page of MEDIA as seen by visitors
+
+    Besides the entry, the page shows its comments, its uploader, the
+    collections it is in and links to the uploader's next and previous
+    media, which all have to be told apart.  There is no one time all
+    of them were last changed at, so only the ETag is of use.
+    """
+    target = aliased(GenericModelReference)
+    comment = aliased(GenericModelReference)
+    comments_updated = Comment.query.join(
+        target, Comment.target_helper).join(
+            comment, Comment.comment_helper).join(
+                TextComment, and_(
+                    comment.model_type == TextComment.__tablename__,
+                    comment.obj_pk == TextComment.id)).filter(
+                        target.model_type == media.__tablename__,
+                        target.obj_pk == media.id).with_entities(
+                            func.max(TextComment.updated)).scalar()
+
+    collections = Collection.query.join(Collection.collection_items).join(
+        CollectionItem.object_helper).filter(
+            GenericModelReference.model_type == media.__tablename__,
+            GenericModelReference.obj_pk == media.id).with_entities(
+                func.count(), func.max(Collection.updated)).one()
+
+    uploader = media.get_actor
+    return CacheValidators(
+        None, media.updated, media.comment_count, comments_updated,
+        tuple(collections), media.neighbours, uploader.username,
+        uploader.updated, request.locale,
+        request.environ.get('CSRF_TOKEN'))
+
+@page_cacheable
 @user_not_banned
 @get_user_media_entry
 @uses_pagination
@@ -127,21 +172,34 @@ def media_home(request, media, page, **kwargs):
     """
     'Homepage' of a MediaEntry()
     """
+    # The page looks different to logged in users (notifications and
+    # such), and shows messages once, so only validate it for visitors
+    validators = None
+    if request.user is None and not request.session.get('messages'):
+        validators = _media_home_validators(request, media)
+        response = validators.not_modified(request)
+        if response is not None:
+            return response
+
     comment_id = request.matchdict.get('comment', None)
     if comment_id:
         if request.user:
             mark_comment_notification_seen(comment_id, request.user)
 
+        ascending = mg_globals.app_config['comments_ascending']
         pagination = Pagination(
-            page, media.get_comments(
-                mg_globals.app_config['comments_ascending']),
+            page, media.get_comments(ascending),
             MEDIA_COMMENTS_PER_PAGE,
-            comment_id)
+            comment_id,
+            keys=(Comment.added, Comment.id),
+            descending=not ascending,
+            total_count=media.comment_count)
     else:
         pagination = Pagination(
             page, media.get_comments(
                 mg_globals.app_config['comments_ascending']),
-            MEDIA_COMMENTS_PER_PAGE)
+            MEDIA_COMMENTS_PER_PAGE,
+            total_count=media.comment_count)
 
     comments = pagination()
 
@@ -162,10 +220,13 @@ def media_home(request, media, page, **kwargs):
     context = hook_transform(
         "media_home_context", context)
 
-    return render_to_response(
+    response = render_to_response(
         request,
         media_template_name,
         context)
+    if validators is not None:
+        validators.apply(response)
+    return response
 
 
 @get_media_entry_by_id
@@ -400,8 +461,8 @@ def user_collection(request, page, url_user=None):
 
     cursor = collection.get_collection_items()
 
-    pagination = Pagination(page, cursor)
-    collection_items = pagination()
+    pagination = Pagination(page, cursor, total_count=collection.num_items)
+    collection_items = preload_references(pagination(), 'object_helper')
 
     # if no data is available, return NotFound
     # TODO: Should an empty collection really also return 404?
@@ -445,8 +506,6 @@ def collection_item_confirm_remove(request, collection_item):
             obj.save()
 
             collection_item.delete()
-            collection.num_items = collection.num_items - 1
-            collection.save()
 
             messages.add_message(
                 request,
@@ -543,10 +602,17 @@ def atom_feed(request):
         username=request.matchdict['user']).first()
     if not user or not user.has_privilege('active'):
         return render_404(request)
+
+    cursor = MediaEntry.query.filter_by(actor=user.id, state='processed')
+    validators = CacheValidators(*cursor.with_entities(
+        func.max(MediaEntry.updated), func.count(MediaEntry.id)).one())
+    response = validators.not_modified(request)
+    if response is not None:
+        return response
+
     feed_title = "MediaGoblin Feed for user '%s'" % request.matchdict['user']
     link = request.urlgen('mediagoblin.user_pages.user_home',
                           qualified=True, user=request.matchdict['user'])
-    cursor = MediaEntry.query.filter_by(actor=user.id, state='processed')
     cursor = cursor.order_by(MediaEntry.created.desc())
     cursor = cursor.limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
 
@@ -572,35 +638,13 @@ def atom_feed(request):
         links=atomlinks,
     )
 
-    for entry in cursor:
-        # Include a thumbnail image in content.
-        file_urls = get_media_file_paths(entry.media_files, request.urlgen)
-        if 'thumb' in file_urls:
-            content = '<img src="{thumb}" alt='' /> {desc}'.format(
-                thumb=file_urls['thumb'], desc=entry.description_html)
-        else:
-            content = entry.description_html
-
-        feed.add_item(
-            title=entry.get('title'),
-            link=entry.url_for_self(
-                    request.urlgen,
-                    qualified=True),
-            description=content,
-            unique_id=entry.url_for_self(request.urlgen, qualified=True),
-            author_name=entry.get_actor.username,
-            author_link=request.urlgen(
-                'mediagoblin.user_pages.user_home',
-                qualified=True,
-                user=entry.get_actor.username),
-            updateddate=entry.get('created'),
-        )
+    add_media_entries(feed, request, cursor)
 
     response = Response(
         feed.writeString(encoding='utf-8'),
         mimetype='application/atom+xml'
     )
-    return response
+    return validators.apply(response)
 
 
 def collection_atom_feed(request):
@@ -618,6 +662,12 @@ def collection_atom_feed(request):
     if not collection:
         return render_404(request)
 
+    # Adding or removing items updates the collection, through num_items
+    validators = CacheValidators(collection.updated, collection.num_items)
+    response = validators.not_modified(request)
+    if response is not None:
+        return response
+
     cursor = CollectionItem.query.filter_by(
                  collection=collection.id) \
                  .order_by(CollectionItem.added.desc()) \
@@ -650,7 +700,7 @@ def collection_atom_feed(request):
                     slug=collection.slug),
                 links=atomlinks)
 
-    for item in cursor:
+    for item in preload_references(cursor, 'object_helper'):
         obj = item.get_object()
         feed.add(
             obj.get('title'),
@@ -670,7 +720,7 @@ def collection_atom_feed(request):
                 'rel': 'alternate',
                 'type': 'text/html'}])
 
-    return feed.get_response()
+    return validators.apply(feed.get_response())
 
 @active_user_from_url
 @uses_pagination
@@ -16,19 +16,22 @@
 
 from mediagoblin import mg_globals
 from mediagoblin.db.models import MediaEntry
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.pagination import get_media_pagination
 from mediagoblin.tools.pluginapi import hook_handle
 from mediagoblin.tools.response import render_to_response, render_404
 from mediagoblin.decorators import uses_pagination, user_not_banned
+from mediagoblin.meddleware.page_cache import page_cacheable
 
 
+@page_cacheable
 @user_not_banned
 @uses_pagination
 def default_root_view(request, page):
     cursor = request.db.query(MediaEntry).filter_by(state='processed').\
         order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = get_media_pagination(
+        request, page, cursor, (MediaEntry.created, MediaEntry.id))
     media_entries = pagination()
     return render_to_response(
         request, 'mediagoblin/root.html',